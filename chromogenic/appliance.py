@@ -0,0 +1,231 @@
+"""
+imaging/appliance.py
+
+Build a fixed libguestfs appliance once per host, and point every
+libguestfs tool (virt-inspector, virt-sysprep) and handle
+(See chromogenic.sysprep) at it, so supermin does not rebuild or
+re-check its appliance for every image:
+
+>> warm_up()  # At worker start (See chromogenic.tasks)
+>> boot_latency()
+2.81
+
+The appliance lives in the LIBGUESTFS_APPLIANCE_DIR setting. It is built by
+'libguestfs-make-fixed-appliance' under a lock, so only one worker
+process on a host builds it, and it is rebuilt when the installed
+libguestfs version changes. Setting LIBGUESTFS_APPLIANCE_DIR to None
+leaves libguestfs to manage its own appliance.
+
+LIBGUESTFS_APPLIANCE_DIR is a symlink to a versioned directory next to it.
+A rebuild goes to a new directory, then the symlink is replaced in one
+rename, so appliances that are booting keep their files. The previous
+directory is kept until the next rebuild.
+
+The appliance is booted once, by the process that built it, and the boot
+time is saved with it for the other processes.
+"""
+import fcntl
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from chromogenic.common import run_command
+from chromogenic.settings import chromo_settings
+from chromogenic.sysprep import has_guestfs
+
+if has_guestfs:
+    import guestfs
+
+logger = logging.getLogger(__name__)
+
+BUILD_TOOL = 'libguestfs-make-fixed-appliance'
+# Written by the build tool, once the appliance is complete
+APPLIANCE_FILES = ('README.fixed', 'kernel', 'initrd', 'root')
+VERSION_FILE = '.chromogenic-version'
+BOOT_LATENCY_FILE = '.chromogenic-boot-latency'
+
+_boot_latency = None
+
+
+def appliance_dir():
+    return chromo_settings.LIBGUESTFS_APPLIANCE_DIR
+
+
+def libguestfs_version():
+    out, _ = run_command(['guestfish', '--version'])
+    return (out or '').strip()
+
+
+def is_complete(path):
+    return all(os.path.exists(os.path.join(path, name))
+               for name in APPLIANCE_FILES)
+
+
+def is_built(path, version):
+    if not is_complete(path):
+        return False
+    try:
+        with open(os.path.join(path, VERSION_FILE)) as version_file:
+            return version_file.read().strip() == version
+    except IOError:
+        return False
+
+
+def build_appliance(path=None):
+    """
+    Build the fixed appliance at <path> unless an up to date one is there,
+    and boot the new one once (See measure_boot).
+    Returns the path, or None if the appliance could not be built.
+    """
+    path = path or appliance_dir()
+    if not path:
+        return None
+    parent = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    with open('%s.lock' % path, 'a') as lock_file:
+        # Other worker processes wait here while the first one builds
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            version = libguestfs_version()
+            if is_built(path, version):
+                return path
+            logger.info("Building the fixed libguestfs appliance in %s"
+                        % path)
+            build_dir = tempfile.mkdtemp(
+                prefix='%s-' % os.path.basename(path), dir=parent)
+            try:
+                result = run_command([BUILD_TOOL, build_dir])
+                if result.returncode != 0 or not is_complete(build_dir):
+                    logger.warn("Could not build the libguestfs appliance"
+                                " (%s): %s" % (result.returncode, result.err))
+                    shutil.rmtree(build_dir, ignore_errors=True)
+                    return None
+            except Exception:
+                shutil.rmtree(build_dir, ignore_errors=True)
+                raise
+            with open(os.path.join(build_dir, VERSION_FILE), 'w') \
+                    as version_file:
+                version_file.write(version)
+            previous = _switch_appliance(path, build_dir)
+            logger.info("Built the fixed libguestfs appliance in %s (%s)"
+                        % (path, build_dir))
+            _remove_old_appliances(path, keep=(build_dir, previous))
+            use_appliance(path)
+            try:
+                latency = measure_boot()
+            except Exception as boot_error:
+                logger.warn("Could not boot the libguestfs appliance: %s"
+                            % boot_error)
+                return path
+            with open(os.path.join(build_dir, BOOT_LATENCY_FILE), 'w') \
+                    as latency_file:
+                latency_file.write('%s' % latency)
+            return path
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _switch_appliance(path, build_dir):
+    """
+    Point the <path> symlink at <build_dir>, in one rename.
+    Returns the directory it pointed at before, or None.
+    """
+    previous = None
+    if os.path.islink(path):
+        previous = os.path.realpath(path)
+    elif os.path.isdir(path):
+        # A directory left by an older chromogenic: move it aside
+        previous = tempfile.mkdtemp(
+            prefix='%s-' % os.path.basename(path),
+            dir=os.path.dirname(os.path.abspath(path)))
+        os.rmdir(previous)
+        os.rename(path, previous)
+    link_path = '%s.new' % path
+    if os.path.lexists(link_path):
+        os.remove(link_path)
+    os.symlink(build_dir, link_path)
+    os.rename(link_path, path)
+    return previous
+
+
+def _remove_old_appliances(path, keep):
+    parent = os.path.dirname(os.path.abspath(path))
+    prefix = '%s-' % os.path.basename(path)
+    keep = [os.path.realpath(kept) for kept in keep if kept]
+    for name in os.listdir(parent):
+        old_path = os.path.join(parent, name)
+        if name.startswith(prefix) and os.path.isdir(old_path) \
+                and not os.path.islink(old_path) \
+                and os.path.realpath(old_path) not in keep:
+            logger.info("Removing the old libguestfs appliance %s"
+                        % old_path)
+            shutil.rmtree(old_path, ignore_errors=True)
+
+
+def use_appliance(path):
+    """
+    Point libguestfs (tools and handles started by this process) at <path>
+    """
+    os.environ['LIBGUESTFS_PATH'] = path
+
+
+def measure_boot():
+    """
+    Boot the appliance once, and return the seconds it took
+    """
+    global _boot_latency
+    if has_guestfs:
+        start = time.time()
+        handle = guestfs.GuestFS(python_return_dict=True)
+        try:
+            handle.add_drive_scratch(1024 * 1024)
+            handle.launch()
+            handle.shutdown()
+        finally:
+            handle.close()
+        latency = time.time() - start
+    else:
+        result = run_command(['guestfish', '-a', '/dev/null', 'run'],
+                             check_return=True)
+        latency = result.duration
+    _boot_latency = latency
+    logger.info("libguestfs appliance booted in %.2fs (LIBGUESTFS_PATH=%s)"
+                % (latency, os.environ.get('LIBGUESTFS_PATH')))
+    return latency
+
+
+def boot_latency():
+    """
+    Seconds taken by the last appliance boot measured by this process, or
+    when the appliance was built on this host, or None
+    """
+    if _boot_latency is not None:
+        return _boot_latency
+    path = appliance_dir()
+    if not path:
+        return None
+    try:
+        with open(os.path.join(path, BOOT_LATENCY_FILE)) as latency_file:
+            return float(latency_file.read())
+    except (IOError, ValueError):
+        return None
+
+
+def warm_up():
+    """
+    Build (or find) the fixed appliance and use it. The appliance is booted
+    once per host, by the process that builds it.
+    Call this when a worker process starts. Never raises.
+    """
+    try:
+        path = build_appliance()
+        if path:
+            use_appliance(path)
+        return boot_latency()
+    except Exception as warm_up_error:
+        logger.exception("Could not warm up the libguestfs appliance: %s"
+                         % warm_up_error)
+        return None
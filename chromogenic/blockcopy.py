@@ -0,0 +1,93 @@
+"""
+imaging/blockcopy.py
+
+Copy a byte range from one raw image file to another, reading only the
+data the source has allocated (See chromogenic.common.copy_disk, which
+uses this to copy a root filesystem into a new partition):
+
+>> copy_range('/tmp/old.raw', 1048576, '/tmp/new.raw', 1048576,
+>>            filesystem_size('/tmp/old.raw', 1048576))
+1073741824
+
+Holes are found with SEEK_DATA/SEEK_HOLE and skipped, and blocks of
+zeros are not written, so the target stays sparse. The target range
+must already read as zeros (ex: punched with 'fallocate --punch-hole').
+Filesystems without SEEK_DATA support are read in full.
+"""
+import errno
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Linux lseek whence values (not in the os module of python 2)
+SEEK_DATA = 3
+SEEK_HOLE = 4
+CHUNK_SIZE = 4 * 1024 * 1024
+ZEROS = '\0' * CHUNK_SIZE
+
+
+def data_extents(fd, start, end):
+    """
+    Yield the (start, end) ranges of allocated data in [start, end)
+    """
+    position = start
+    while position < end:
+        try:
+            data_start = os.lseek(fd, position, SEEK_DATA)
+        except OSError as seek_error:
+            if seek_error.errno == errno.ENXIO:
+                return  # Only holes after <position>
+            if seek_error.errno == errno.EINVAL:
+                yield (position, end)  # SEEK_DATA is not supported
+                return
+            raise
+        if data_start >= end:
+            return
+        data_end = min(os.lseek(fd, data_start, SEEK_HOLE), end)
+        yield (data_start, data_end)
+        position = data_end
+
+
+def copy_range(source_path, source_offset, target_path, target_offset,
+               length):
+    """
+    Copy <length> bytes at <source_offset> of <source_path> to
+    <target_offset> of <target_path>. Returns the bytes written.
+    """
+    written = 0
+    source_fd = os.open(source_path, os.O_RDONLY)
+    try:
+        target_fd = os.open(target_path, os.O_WRONLY)
+        try:
+            shift = target_offset - source_offset
+            for start, end in data_extents(source_fd, source_offset,
+                                           source_offset + length):
+                written += _copy_extent(source_fd, target_fd, start, end,
+                                        shift)
+            os.fsync(target_fd)
+        finally:
+            os.close(target_fd)
+    finally:
+        os.close(source_fd)
+    logger.info("Copied %s bytes of %s (%s of data written) to %s"
+                % (length, source_path, written, target_path))
+    return written
+
+
+def _copy_extent(source_fd, target_fd, start, end, shift):
+    written = 0
+    position = start
+    os.lseek(source_fd, position, os.SEEK_SET)
+    while position < end:
+        data = os.read(source_fd, min(CHUNK_SIZE, end - position))
+        if not data:
+            break
+        if data != ZEROS[:len(data)]:
+            os.lseek(target_fd, position + shift, os.SEEK_SET)
+            done = 0
+            while done < len(data):
+                done += os.write(target_fd, buffer(data, done))
+            written += len(data)
+        position += len(data)
+    return written
@@ -0,0 +1,193 @@
+"""
+imaging/chroot.py
+
+Run a batch of commands inside a chroot through one shell process,
+instead of starting '/usr/sbin/chroot ... /bin/bash -c' for each one:
+
+>> with ChrootShell(mounted_path) as shell:
+>>     result = shell.run('yum install -qy kernel')
+>>     result.returncode, result.duration
+(0, 41.2)
+
+Each command runs in a subshell (so 'cd' and 'exit' do not leak into the
+next one) with stdin from /dev/null and stderr merged into its output.
+Only the last MAX_OUTPUT bytes of output are kept for each command.
+The chroot environment (/proc, /sys, ...) must already be prepared
+(See chromogenic.common.chroot_env)
+
+Like run_command, each command is limited by the COMMAND_TIMEOUTS setting
+of its tool (ex: 'yum'), or by <timeout>, and recorded in
+chromogenic.metrics. A command that runs out of time kills the shell's
+whole process group, and raises CommandTimeout. Closing the shell kills
+its process group too, so a daemon started in the chroot can not keep
+the job waiting.
+"""
+import errno
+import logging
+import os
+import pipes
+import signal
+import subprocess
+import time
+import uuid
+from collections import namedtuple
+
+from chromogenic.command import OutputBuffer, Deadline, CommandTimeout, \
+    CHUNK_SIZE
+from chromogenic.metrics import record_command, tool_name
+from chromogenic.settings import chromo_settings
+
+logger = logging.getLogger(__name__)
+
+CHROOT = '/usr/sbin/chroot'
+MAX_OUTPUT = 64 * 1024  # bytes kept per command
+
+ChrootResult = namedtuple('ChrootResult', [
+    'command', 'returncode', 'duration', 'output', 'truncated', 'timed_out'])
+
+
+class ChrootShell(object):
+
+    def __init__(self, mounted_path, shell='/bin/bash',
+                 max_output=MAX_OUTPUT):
+        self.mounted_path = mounted_path
+        self.shell = shell
+        self.max_output = max_output
+        self.proc = None
+        # Printed on a line of its own after every command, followed by
+        # its exit code
+        self.marker = '\n__chromo_%s__ ' % uuid.uuid4().hex
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def open(self):
+        shell_list = [CHROOT, self.mounted_path, self.shell,
+                      '--noprofile', '--norc']
+        logger.info("Starting chroot shell: %s" % ' '.join(shell_list))
+        self.proc = subprocess.Popen(
+            shell_list, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, bufsize=-1, close_fds=True,
+            # Its own process group, killed on timeout and on close
+            preexec_fn=os.setsid)
+        result = self.run('true')
+        if result.returncode != 0:
+            self.close()
+            raise Exception("Could not start a shell in chroot %s: %s"
+                            % (self.mounted_path, result.output))
+        return self
+
+    def close(self):
+        if not self.proc:
+            return
+        proc, self.proc = self.proc, None
+        try:
+            proc.stdin.close()
+        except IOError:
+            pass
+        # Every command has finished: kill what is left in the group (ex:
+        # daemons holding stdout) instead of waiting for it. The shell is
+        # not reaped yet, so its process group id can not be reused.
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError as kill_error:
+            if kill_error.errno != errno.ESRCH:
+                raise
+        proc.stdout.close()
+        proc.wait()
+
+    def run(self, command, check_return=False, timeout=None):
+        """
+        Run <command> (a string, or a list that will be quoted) and return
+        a ChrootResult. <timeout> defaults to the COMMAND_TIMEOUTS setting
+        of the tool.
+        """
+        if not self.proc:
+            raise Exception("The chroot shell for %s is not running"
+                            % self.mounted_path)
+        if not isinstance(command, basestring):
+            command = ' '.join(pipes.quote(arg) for arg in command)
+        if timeout is None:
+            timeout = chromo_settings.COMMAND_TIMEOUTS.get(tool_name(command))
+        start = time.time()
+        self.proc.stdin.write(
+            "( %s\n) </dev/null 2>&1; __rc=$?; printf '%s%%d\\n' $__rc\n"
+            % (command, self.marker.replace('\n', '\\n')))
+        self.proc.stdin.flush()
+        deadline = Deadline(self.proc, timeout) if timeout else None
+        try:
+            buf, returncode = self._read_output()
+        finally:
+            if deadline:
+                with deadline.lock:
+                    deadline.cancel()
+                deadline.join()
+        timed_out = bool(deadline and deadline.timed_out.is_set())
+        result = ChrootResult(command, returncode, time.time() - start,
+                              buf.getvalue(), buf.truncated, timed_out)
+        record_command(result)
+        if returncode is None:
+            self.close()
+            if timed_out:
+                raise CommandTimeout(result, timeout)
+            raise Exception("The chroot shell for %s exited while running: %s"
+                            % (self.mounted_path, command))
+        output = result.output
+        logger.info("Completed chroot command with exit code %s in %.2fs: %s"
+                    % (returncode, result.duration, command))
+        if returncode != 0:
+            logger.warn("Chroot command output: %s" % output)
+            if check_return:
+                raise Exception("Command returned a non-zero exit code (%s)"
+                                " : %s " % (returncode, command))
+        return result
+
+    def _read_output(self):
+        """
+        Read up to the marker: (OutputBuffer, exit code or None at EOF)
+        """
+        buf = OutputBuffer(self.max_output)
+        fd = self.proc.stdout.fileno()
+        # Held back in case it is the start of the marker
+        keep = len(self.marker) - 1
+        pending = ''
+        while True:
+            data = os.read(fd, CHUNK_SIZE)
+            if not data:
+                buf.append(pending)
+                return buf, None
+            pending += data
+            index = pending.find(self.marker)
+            if index >= 0:
+                line_end = pending.find('\n', index + len(self.marker))
+                if line_end >= 0:
+                    buf.append(pending[:index])
+                    return buf, int(
+                        pending[index + len(self.marker):line_end])
+                continue
+            if len(pending) > keep:
+                buf.append(pending[:-keep])
+                pending = pending[-keep:]
+
+    def run_batch(self, commands, check_return=False):
+        return [self.run(command, check_return=check_return)
+                for command in commands]
+
+
+def run_chroot_commands(mounted_path, commands, check_return=False,
+                        dry_run=False):
+    """
+    Run every command in one ChrootShell and return their ChrootResults
+    """
+    if not commands:
+        return []
+    if dry_run:
+        for command in commands:
+            logger.debug("Mock Chroot Command: %s" % (command,))
+        return []
+    with ChrootShell(mounted_path) as shell:
+        return shell.run_batch(commands, check_return=check_return)
@@ -4,14 +4,16 @@ imaging/clean.py
 These functions are used to strip data from a VM before imaging occurs.
 
 """
-import logging, os
-from chromogenic.common import prepare_chroot_env,\
-remove_chroot_env, run_command, check_distro
+import glob, hashlib, logging, os, tempfile, time
+from chromogenic.common import chroot_env, run_command, check_distro
 from chromogenic.common import (
     remove_files, overwrite_files,
     append_line_in_files, remove_line_in_files,
     replace_line_in_files, remove_multiline_in_files,
-    execute_chroot_commands, fsck_image, mount_image)
+    execute_chroot_commands, fsck_image, mount_image, ImageSession)
+from chromogenic.settings import chromo_settings
+from chromogenic.sysprep import has_guestfs, GuestfsSession, \
+    UnsupportedGuest, parse_commands
 import chromogenic.virt_sysprep as virt_sysprep_files
 
 logger = logging.getLogger(__name__)
@@ -21,66 +23,181 @@ logger = logging.getLogger(__name__)
 
 # still used in drivers/virtualbox.py
 def remove_ldap(mounted_path):
-    try:
-        prepare_chroot_env(mounted_path)
+    with chroot_env(mounted_path):
         run_command(["/usr/sbin/chroot", mounted_path, 'yum',
                      'remove', '-qy', 'openldap'])
-    finally:
-        remove_chroot_env(mounted_path)
 
 # still used in drivers/virtualbox.py
 def reset_root_password(mounted_path, new_password='atmosphere'):
-    try:
-        prepare_chroot_env(mounted_path)
+    with chroot_env(mounted_path):
         run_command(["/usr/sbin/chroot", mounted_path, "/bin/bash", "-c",
                      "echo %s | passwd root --stdin" % new_password])
-    finally:
-        remove_chroot_env(mounted_path)
 
 
-def mount_and_clean(image_path, created_by=None, status_hook=None, method_hook=None, **kwargs):
+def mount_and_clean(image_path, created_by=None, status_hook=None, method_hook=None, session=None, **kwargs):
     """
     Clean the local image at <image_path>
+    If an ImageSession is given, its block device is used for every step
+    and left attached for the next stage.
     """
     #Prepare the paths
     if not os.path.exists(image_path):
         logger.error("Could not find local image!")
         raise Exception("Image file not found")
 
+    if not session:
+        with ImageSession(image_path) as session:
+            return mount_and_clean(image_path, created_by, status_hook,
+                                   method_hook, session=session, **kwargs)
+    # virt-* tools must have the disk to themselves
+    session.unmount()
+    if _use_guestfs() and _clean_with_guestfs(image_path, session):
+        return
+    disk_args = ['--format', 'raw', '-a', session.block_device]
+
     #FSCK the image, FIRST!
-    fsck_image(image_path)
+    fsck_image(image_path, session=session)
 
     # Figure out distro using virt-inspect
-    import subprocess
-    output = subprocess.Popen(['virt-inspector', '-a', image_path], stdout=subprocess.PIPE).stdout.read()
-    distro = output[output.find('<distro>') + 8 : output.find('</distro>')]
-    fstrim = 'run-command fstrim --all' if '<name>util-linux</name>' in output else ''
-
-    # Check that cloud-init is installed because virt-sysprep is currently unable to install it
-    if '<name>cloud-init</name>' not in output:
-        raise Exception("cloud-init is not installed on this image so it will fail to deploy on Atmosphere")
-
-    # Get filename and content based off distro
-    vs_filename = "{}/virt-sysprep-{}.txt".format(os.path.dirname(image_path), distro)
-    vs_content = virt_sysprep_files.commands % (getattr(virt_sysprep_files, distro), fstrim)
-
-    # Create file if it does not exist
-    if not os.path.exists(vs_filename):
-        with open(vs_filename, 'w+') as vs_file:
-            vs_file.write(vs_content)
+    guest = session.guest
+    distro = guest.distro
+    _check_cloud_init(guest)
+    vs_filename = _write_sysprep_commands(image_path, guest)
 
     # Use virt-sysprep to clean image
     logger.info("Running virt-sysprep for distro {}".format(distro))
-    proc = subprocess.Popen([
+    result = run_command([
         'virt-sysprep',
-        '-a', image_path,
+    ] + disk_args + [
         '--operations', 'defaults,kerberos-data,user-account',
         '--hostname', distro,
         '--commands-from-file', vs_filename
-    ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out,err = proc.communicate()
-    rc = proc.returncode
+    ])
+    out,err = result
+    rc = result.returncode
+    session.invalidate_guest()
     logger.info("virt-sysprep out: {}".format(out))
     if rc != 0:
         logger.error("virt-sysprep exited with code {} and message: {}".format(rc, err))
         raise Exception("virt-sysprep failed on image file {} with error: {}".format(image_path, err))
+
+
+def _use_guestfs():
+    engine = chromo_settings.CLEAN_ENGINE
+    if engine == 'guestfs' and not has_guestfs:
+        logger.warn("CLEAN_ENGINE is 'guestfs' but the libguestfs python"
+                    " bindings are not installed. Using virt-sysprep")
+    return engine in ('auto', 'guestfs') and has_guestfs
+
+
+def _clean_with_guestfs(image_path, session):
+    """
+    fsck, inspect and sysprep the image in one libguestfs appliance.
+    Returns False, before changing the guest, if the commands file uses
+    a directive that is only supported by virt-sysprep.
+    """
+    with GuestfsSession(session.block_device) as handle:
+        try:
+            guest = handle.prepare()
+        except UnsupportedGuest as unsupported:
+            logger.warn("Cleaning with virt-sysprep instead: %s"
+                        % unsupported)
+            return False
+        session.invalidate_guest()
+        _check_cloud_init(guest)
+        vs_filename = _write_sysprep_commands(image_path, guest)
+        with open(vs_filename) as vs_file:
+            commands = vs_file.read()
+        try:
+            parse_commands(commands)
+        except Exception as unsupported:
+            logger.warn("Cleaning with virt-sysprep instead: %s"
+                        % unsupported)
+            return False
+        logger.info("Cleaning %s (%s) in one libguestfs session"
+                    % (image_path, guest.distro))
+        handle.sysprep(hostname=guest.distro, commands=commands)
+    return True
+
+
+def _check_cloud_init(guest):
+    # Check that cloud-init is installed because virt-sysprep is currently unable to install it
+    if not guest.has_package('cloud-init'):
+        raise Exception("cloud-init is not installed on this image so it will fail to deploy on Atmosphere")
+
+
+def _write_sysprep_commands(image_path, guest):
+    """
+    Return the path of the '--commands-from-file' file for <guest>
+    """
+    fstrim = guest.has_package('util-linux')
+    try:
+        return sysprep_recipe(guest.distro, fstrim)
+    except (IOError, OSError) as cache_error:
+        # Fall back to a file in the job directory
+        logger.warn("Could not use the sysprep recipe cache: %s"
+                    % cache_error)
+        return sysprep_recipe(guest.distro, fstrim,
+                              recipe_dir=os.path.dirname(image_path))
+
+
+def render_sysprep_commands(distro, fstrim=False):
+    """
+    The virt-sysprep commands for <distro>
+    """
+    fstrim_command = 'run-command fstrim --all' if fstrim else ''
+    return virt_sysprep_files.commands % (getattr(virt_sysprep_files, distro),
+                                          fstrim_command)
+
+
+def sysprep_recipe(distro, fstrim=False, recipe_dir=None):
+    """
+    Return the path of the rendered commands for <distro>, in
+    <recipe_dir> (Default: SYSPREP_RECIPE_DIR).
+    Files are named by a hash of their content, so every job on the host
+    shares them, and a change to chromogenic.virt_sysprep makes new ones.
+    Using a recipe updates its mtime. Other recipes for <distro> that were
+    not used for SYSPREP_RECIPE_MAX_AGE seconds are removed.
+    """
+    recipe_dir = recipe_dir or chromo_settings.SYSPREP_RECIPE_DIR
+    content = render_sysprep_commands(distro, fstrim)
+    prefix = "virt-sysprep-%s%s-" % (distro, '-fstrim' if fstrim else '')
+    recipe_path = os.path.join(recipe_dir, "%s%s.txt"
+                               % (prefix, hashlib.sha1(content).hexdigest()))
+    if os.path.exists(recipe_path):
+        try:
+            os.utime(recipe_path, None)
+        except OSError:
+            pass
+        return recipe_path
+    if not os.path.isdir(recipe_dir):
+        os.makedirs(recipe_dir)
+    (fd, tmp_path) = tempfile.mkstemp(prefix='.%s' % prefix, dir=recipe_dir)
+    try:
+        with os.fdopen(fd, 'w') as recipe_file:
+            recipe_file.write(content)
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, recipe_path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    logger.info("Rendered sysprep recipe %s" % recipe_path)
+    _remove_stale_recipes(recipe_dir, prefix, recipe_path)
+    return recipe_path
+
+
+def _remove_stale_recipes(recipe_dir, prefix, recipe_path):
+    """
+    Remove the recipes rendered from other templates (ex: by an older
+    release) once they were not used for SYSPREP_RECIPE_MAX_AGE seconds
+    """
+    oldest = time.time() - chromo_settings.SYSPREP_RECIPE_MAX_AGE
+    stale_glob = '%s%s.txt' % (prefix, '[0-9a-f]' * 40)
+    for stale_path in glob.glob(os.path.join(recipe_dir, stale_glob)):
+        if stale_path == recipe_path:
+            continue
+        try:
+            if os.path.getmtime(stale_path) < oldest:
+                os.remove(stale_path)
+        except OSError:
+            pass
@@ -0,0 +1,336 @@
+"""
+imaging/command.py
+
+Run a system command, streaming its output instead of buffering all of it
+(See chromogenic.common.run_command, which wraps this with logging):
+
+>> result = run(['virt-inspector', '-a', '/dev/nbd1'], timeout=1800)
+>> out, err = result
+>> result.returncode, result.duration, result.truncated
+(0, 12.4, False)
+>> result.rusage.ru_maxrss
+10240
+
+Output is read in chunks of at most CHUNK_SIZE bytes into an
+OutputBuffer, which keeps only the last <max_output> bytes of each stream
+(even when the command never prints a newline, like dd). A command that
+runs longer than <timeout> seconds is killed with its whole process group
+(SIGTERM, then SIGKILL after KILL_GRACE seconds) and CommandTimeout is
+raised. A command with a timeout is reaped under the lock of its
+Deadline, so a late signal never reaches a process group id that was
+reused.
+
+A command whose output is read as a stream (instead of buffered) is
+started with start, under the same time limit:
+
+>> process = start(['ssh', host, 'dd if=/dev/vda'], stdout=subprocess.PIPE)
+>> copy(process.stdout)
+>> result = process.wait()
+"""
+import errno
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+MAX_OUTPUT = 1024 * 1024  # bytes kept per stream
+CHUNK_SIZE = 64 * 1024  # bytes read from a stream at a time
+KILL_GRACE = 10  # seconds between SIGTERM and SIGKILL
+POLL_INTERVAL = 0.5  # longest sleep between checks for a timed command
+
+
+class CommandTimeout(Exception):
+
+    def __init__(self, result, timeout):
+        self.result = result
+        self.timeout = timeout
+        Exception.__init__(self, "Command timed out after %ss : %s"
+                           % (timeout, result.command))
+
+
+class CommandResult(tuple):
+    """
+    The (out, err) pair of a command, so existing 'out, err = ...' callers
+    keep working. Streams that were not captured are None.
+    rusage is the resource usage of the command and its children, as
+    returned by os.wait4 (or None).
+    """
+
+    def __new__(cls, out, err, command='', returncode=None, duration=0.0,
+                truncated=False, timed_out=False, rusage=None):
+        result = tuple.__new__(cls, (out, err))
+        result.command = command
+        result.returncode = returncode
+        result.duration = duration
+        result.truncated = truncated
+        result.timed_out = timed_out
+        result.rusage = rusage
+        return result
+
+    @property
+    def out(self):
+        return self[0]
+
+    @property
+    def err(self):
+        return self[1]
+
+    def __getnewargs__(self):
+        return tuple(self)
+
+
+class OutputBuffer(object):
+    """
+    Keep the last <max_bytes> of a stream, one chunk at a time.
+    max_bytes=None keeps everything.
+    """
+
+    def __init__(self, max_bytes=MAX_OUTPUT):
+        self.max_bytes = max_bytes
+        self.lines = deque()
+        self.size = 0
+        self.truncated = False
+
+    def append(self, data):
+        if self.max_bytes is not None and len(data) > self.max_bytes:
+            data = data[-self.max_bytes:]
+            self.truncated = True
+        self.lines.append(data)
+        self.size += len(data)
+        while self.max_bytes is not None and self.size > self.max_bytes:
+            excess = self.size - self.max_bytes
+            first = self.lines[0]
+            if len(first) > excess:
+                # Keep the tail of the oldest chunk
+                self.lines[0] = first[excess:]
+                self.size -= excess
+            else:
+                self.size -= len(self.lines.popleft())
+            self.truncated = True
+
+    def getvalue(self):
+        return ''.join(self.lines)
+
+
+def run(command_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        stdin=None, shell=False, timeout=None, max_output=MAX_OUTPUT):
+    """
+    Run <command_list> and return a CommandResult.
+    Raises CommandTimeout if <timeout> (seconds) is given and exceeded.
+    """
+    cmd_str = command_list if isinstance(command_list, basestring) \
+        else ' '.join(command_list)
+    start = time.time()
+    proc = subprocess.Popen(
+        command_list, stdout=stdout, stderr=stderr,
+        stdin=subprocess.PIPE if stdin else None, shell=shell,
+        # Its own process group, so a timeout kills every child too
+        preexec_fn=os.setsid if timeout else None)
+    buffers = {}
+    threads = []
+    for name, stream in (('out', proc.stdout), ('err', proc.stderr)):
+        if stream:
+            buffers[name] = OutputBuffer(max_output)
+            threads.append(_start_thread(_read_chunks, stream, buffers[name]))
+    if stdin:
+        threads.append(_start_thread(_write_input, proc.stdin, stdin))
+
+    deadline = Deadline(proc, timeout) if timeout else None
+    try:
+        rusage = _wait4(proc, deadline)
+    finally:
+        if deadline:
+            deadline.cancel()
+    timed_out = deadline.timed_out if deadline else threading.Event()
+    for thread in threads:
+        # A killed command may leave children holding its pipes open
+        thread.join(KILL_GRACE if timed_out.is_set() else None)
+
+    out = buffers['out'].getvalue() if 'out' in buffers else None
+    err = buffers['err'].getvalue() if 'err' in buffers else None
+    result = CommandResult(
+        out, err, cmd_str, proc.returncode, time.time() - start,
+        any(buf.truncated for buf in buffers.values()), timed_out.is_set(),
+        rusage)
+    if result.timed_out:
+        raise CommandTimeout(result, timeout)
+    return result
+
+
+class Process(object):
+    """
+    A command started by start(). Its streams are read by the caller.
+    """
+
+    def __init__(self, command_list, timeout=None, **popen_kwargs):
+        self.command = command_list if isinstance(command_list, basestring) \
+            else ' '.join(command_list)
+        self.timeout = timeout
+        self.started = time.time()
+        self.proc = subprocess.Popen(
+            command_list,
+            preexec_fn=os.setsid if timeout else None, **popen_kwargs)
+        self.deadline = Deadline(self.proc, timeout) if timeout else None
+
+    @property
+    def stdout(self):
+        return self.proc.stdout
+
+    def kill(self):
+        if self.proc.returncode is None:
+            try:
+                self.proc.kill()
+            except OSError as kill_error:
+                if kill_error.errno != errno.ESRCH:
+                    raise
+
+    def wait(self):
+        """
+        Wait for the command and return its CommandResult (with no
+        output). Raises CommandTimeout if it ran out of time.
+        """
+        try:
+            rusage = _wait4(self.proc, self.deadline)
+        finally:
+            if self.deadline:
+                self.deadline.cancel()
+        result = CommandResult(
+            None, None, self.command, self.proc.returncode,
+            time.time() - self.started, False,
+            bool(self.deadline and self.deadline.timed_out.is_set()),
+            rusage)
+        if result.timed_out:
+            raise CommandTimeout(result, self.timeout)
+        return result
+
+
+def start(command_list, timeout=None, **popen_kwargs):
+    """
+    Start <command_list> and return its Process. <popen_kwargs> go to
+    subprocess.Popen (ex: stdout=subprocess.PIPE).
+    """
+    return Process(command_list, timeout, **popen_kwargs)
+
+
+class Deadline(object):
+    """
+    Kill the process group of <proc> (SIGTERM, then SIGKILL after
+    KILL_GRACE seconds) once <timeout> seconds have passed.
+    The signals are sent under <lock>, and never after cancel().
+    """
+
+    def __init__(self, proc, timeout):
+        self.proc = proc
+        self.timeout = timeout
+        self.timed_out = threading.Event()
+        self.lock = threading.Lock()
+        self.cancelled = False
+        self.timers = [
+            threading.Timer(timeout, self._kill, (signal.SIGTERM,)),
+            threading.Timer(timeout + KILL_GRACE, self._kill,
+                            (signal.SIGKILL,))]
+        for timer in self.timers:
+            timer.daemon = True
+            timer.start()
+
+    def _kill(self, sig):
+        with self.lock:
+            if not self.cancelled:
+                _kill_group(self.proc, sig, self.timed_out)
+
+    def cancel(self):
+        """
+        Stop the timers (_wait4 calls this with the lock held, right
+        after reaping the command)
+        """
+        self.cancelled = True
+        for timer in self.timers:
+            timer.cancel()
+
+    def join(self):
+        for timer in self.timers:
+            if timer is not threading.current_thread():
+                timer.join()
+
+
+def _wait4(proc, deadline=None):
+    """
+    proc.wait(), but also return the rusage of the command.
+    With a Deadline, the command is reaped under its lock, and the
+    Deadline is cancelled before the lock is released.
+    """
+    delay = 0.01
+    while True:
+        try:
+            if not deadline:
+                _, status, rusage = os.wait4(proc.pid, 0)
+            else:
+                with deadline.lock:
+                    pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+                    if pid:
+                        deadline.cancel()
+                if not pid:
+                    time.sleep(delay)
+                    delay = min(delay * 2, POLL_INTERVAL)
+                    continue
+        except OSError as wait_error:
+            if wait_error.errno == errno.EINTR:
+                continue
+            if wait_error.errno == errno.ECHILD:
+                # Already reaped (ex: by a SIGCHLD handler)
+                if deadline:
+                    with deadline.lock:
+                        deadline.cancel()
+                proc.wait()
+                return None
+            raise
+        if deadline:
+            deadline.join()
+        proc._handle_exitstatus(status)
+        return rusage
+
+
+def _start_thread(target, *args):
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def _read_chunks(stream, buf):
+    try:
+        fd = stream.fileno()
+        while True:
+            data = os.read(fd, CHUNK_SIZE)
+            if not data:
+                break
+            buf.append(data)
+    finally:
+        stream.close()
+
+
+def _write_input(stream, data):
+    try:
+        stream.write(data)
+        stream.close()
+    except IOError as io_error:
+        # The command exited without reading all of its input
+        if io_error.errno not in (errno.EPIPE, errno.EINVAL):
+            raise
+
+
+def _kill_group(proc, sig, timed_out=None):
+    if timed_out:
+        timed_out.set()
+        logger.warn("Killing process group %s (signal %s): timed out"
+                    % (proc.pid, sig))
+    try:
+        os.killpg(proc.pid, sig)
+    except OSError as kill_error:
+        if kill_error.errno != errno.ESRCH:
+            raise
@@ -1,40 +1,69 @@
 import glob
 import os
-import re
 import subprocess
+import tempfile
 import logging
+import threading
+import time
+from contextlib import contextmanager
 from chromogenic.settings import chromo_settings
+from chromogenic.devices import reserve_device, release_device
+from chromogenic.partitions import read_partition_table, select_root,\
+    write_mbr
+from chromogenic.detect import image_format, filesystem_type,\
+    filesystem_state, filesystem_size
+from chromogenic.blockcopy import copy_range
+from chromogenic.chroot import run_chroot_commands
+from chromogenic.edits import FileEditBatch
+from chromogenic.command import run, start, CommandResult, CommandTimeout,\
+                                MAX_OUTPUT
+from chromogenic.metrics import record_command, record_fsck,\
+    record_created_image, tool_name
+from chromogenic import guest as guest_cache
 logger = logging.getLogger(__name__)
 
 ##
 # Tools
 ##
+LOG_OUTPUT = 4096  # bytes of each stream logged at debug level
 
 
 def run_command(commandList, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                stdin=None, dry_run=False, shell=False, check_return=False):
+                stdin=None, dry_run=False, shell=False, check_return=False,
+                timeout=None, max_output=MAX_OUTPUT):
     """
     NOTE: Use this to run ANY system command, because its wrapped around a loggger
     Using Popen, run any command at the system level and record the output and error streams
+
+    Output is streamed, and only the last <max_output> bytes of each stream
+    are kept (max_output=None keeps everything).
+    timeout - Seconds before the command and its children are killed
+              (Default: COMMAND_TIMEOUTS for the tool, or no limit)
+    Returns a CommandResult: the (out, err) pair, which also carries the
+    returncode, duration and whether the output was truncated
+    (See chromogenic.command)
+    The resource usage of every command is recorded in chromogenic.metrics
     """
-    out = None
-    err = None
     cmd_str = ' '.join(commandList)
     if dry_run:
         #Bail before making the call
         logger.debug("Mock Command: %s" % cmd_str)
-        return ('','')
+        return CommandResult('', '', cmd_str, 0)
+    if timeout is None:
+        timeout = command_timeout(commandList)
     #Execution
     try:
-        if stdin:
-            proc = subprocess.Popen(commandList, stdout=stdout, stderr=stderr,
-                    stdin=subprocess.PIPE, shell=shell)
-        else:
-            proc = subprocess.Popen(commandList, stdout=stdout, stderr=stderr,
-                    shell=shell)
-        out,err = proc.communicate(input=stdin)
-        return_code = proc.returncode
-        logger.info("Completed Command with exit code %s: %s" % (return_code, cmd_str))
+        try:
+            result = run(commandList, stdout=stdout, stderr=stderr,
+                         stdin=stdin, shell=shell, timeout=timeout,
+                         max_output=max_output)
+        except CommandTimeout as timed_out:
+            _record_metrics(timed_out.result, commandList)
+            raise
+        _record_metrics(result, commandList)
+        return_code = result.returncode
+        logger.info("Completed Command with exit code %s in %.2fs: %s"
+                    % (return_code, result.duration, cmd_str))
         if check_return and return_code != 0:
                 raise Exception("Command returned a non-zero exit code (%s) : %s " % (return_code, cmd_str))
     except Exception, e:
@@ -45,14 +74,71 @@ def run_command(commandList, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
     #logging - NEVER let logging the commands be the reason
     # run command fails.
     try:
-        if stdin:
-            logger.debug("%s STDIN: %s" % (cmd_str, stdin))
-        logger.debug("%s STDOUT: %s" % (cmd_str, out))
-        logger.debug("%s STDERR: %s" % (cmd_str, err))
+        if logger.isEnabledFor(logging.DEBUG):
+            if stdin:
+                logger.debug("%s STDIN: %s" % (cmd_str, stdin[-LOG_OUTPUT:]))
+            (out, err) = result
+            logger.debug("%s STDOUT: %s" % (cmd_str, _log_tail(out)))
+            logger.debug("%s STDERR: %s" % (cmd_str, _log_tail(err)))
+    except Exception, e:
+        logger.exception(e)
+
+    return result
+
+
+def start_command(commandList, timeout=None, **popen_kwargs):
+    """
+    Start a command whose output is read as a stream, and return its
+    chromogenic.command.Process. Finish it with wait_command, which
+    records it like run_command.
+    timeout - Seconds before the command is killed
+              (Default: COMMAND_TIMEOUTS for the tool, or no limit)
+    """
+    if timeout is None:
+        timeout = command_timeout(commandList)
+    process = start(commandList, timeout, **popen_kwargs)
+    process.command_list = commandList
+    return process
+
+
+def wait_command(process):
+    """
+    Wait for a command started by start_command. Returns its
+    CommandResult, or raises CommandTimeout.
+    """
+    try:
+        result = process.wait()
+    except CommandTimeout as timed_out:
+        _record_metrics(timed_out.result, process.command_list)
+        logger.error("Timed out after %ss: %s"
+                     % (process.timeout, process.command))
+        raise
+    _record_metrics(result, process.command_list)
+    logger.info("Completed Command with exit code %s in %.2fs: %s"
+                % (result.returncode, result.duration, process.command))
+    return result
+
+
+def _record_metrics(result, commandList):
+    #NEVER let metrics be the reason run command fails.
+    try:
+        record_command(result, commandList)
     except Exception, e:
         logger.exception(e)
 
-    return (out,err)
+
+def command_timeout(commandList):
+    """
+    The COMMAND_TIMEOUTS setting for the tool run by <commandList>, or None
+    """
+    return chromo_settings.COMMAND_TIMEOUTS.get(tool_name(commandList))
+
+
+def _log_tail(output):
+    if output and len(output) > LOG_OUTPUT:
+        return "...%s" % output[-LOG_OUTPUT:]
+    return output
+
 
 def overwrite_file(filepath, dry_run=False):
     if '*' in filepath:
@@ -107,54 +193,28 @@ def wildcard_remove(wildcard_path, dry_run=False):
 """
 SED tools - in-place editing of files on the system
 BE VERY CAREFUL USING THESE -- YOU HAVE BEEN WARNED!
+Each call reads and rewrites the file in-process (See chromogenic.edits).
+To make many changes, use the *_in_files helpers or a FileEditBatch.
 """
 def sed_delete_multi(from_here,to_here,filepath, dry_run=False):
-    if not os.path.exists(filepath):
-        logger.warn("File not found: %s Cannot delete lines" % filepath)
-        return
-    cmd_list = ["/bin/sed", "-i", "/%s/,/%s/d" % (from_here, to_here),
-                filepath]
-    run_command(cmd_list, dry_run=dry_run)
+    return FileEditBatch().remove_multilines(
+        [(from_here, to_here, filepath)]).commit(dry_run=dry_run)
 
 def sed_replace(find,replace,filepath, dry_run=False):
-    if not os.path.exists(filepath):
-        logger.warn("File not found: %s Cannot replace lines" % filepath)
-        return
-    cmd_list = ["/bin/sed", "-i", "s/%s/%s/" % (find,replace), filepath]
-    run_command(cmd_list, dry_run=dry_run)
+    return FileEditBatch().replace_lines(
+        [(find, replace, filepath)]).commit(dry_run=dry_run)
 
 def sed_delete_one(remove_string, filepath, dry_run=False):
-    if not os.path.exists(filepath):
-        logger.warn("File not found: %s Cannot delete lines" % filepath)
-        return
-    cmd_list = ["/bin/sed", "-i", "/%s/d" % remove_string, filepath]
-    run_command(cmd_list, dry_run=dry_run)
+    return FileEditBatch().remove_lines(
+        [(remove_string, filepath)]).commit(dry_run=dry_run)
 
 def sed_append(append_string, filepath, dry_run=False):
-    if not os.path.exists(filepath):
-        logger.warn("File not found: %s Cannot append lines" % filepath)
-        return
-    if _line_exists_in_file(append_string, filepath):
-        return
-    cmd_list = ["/bin/sed", "-i", "$ a\\%s" % append_string, filepath]
-    run_command(cmd_list, dry_run=dry_run)
+    return FileEditBatch().append_lines(
+        [(append_string, filepath)]).commit(dry_run=dry_run)
 
 def sed_prepend(prepend_string, filepath, dry_run=False):
-    if not os.path.exists(filepath):
-        logger.warn("File not found: %s Cannot prepend lines" % filepath)
-        return
-    if _line_exists_in_file(prepend_string, filepath):
-        return
-    cmd_list = ["/bin/sed", "-i", "1i %s" % prepend_string, filepath]
-    run_command(cmd_list, dry_run=dry_run)
-
-def _line_exists_in_file(needle, filepath):
-    with open(filepath,'r') as _file:
-        if [line for line in _file.readlines()
-            if needle.strip() == line.strip()]:
-            return True
-    return False
-
+    return FileEditBatch().prepend_lines(
+        [(prepend_string, filepath)]).commit(dry_run=dry_run)
 
 def _mkinitrd_command(latest_rmdisk, rmdisk_version, distro='centos', preload=[], include=[]):
     preload.extend(['ahci'])
@@ -222,52 +282,155 @@ def rebuild_ramdisk(mounted_path, preload=[], include=[],
     mkinitrd_str = _mkinitrd_command(latest_rmdisk, rmdisk_version,
                                      distro=distro, preload=preload,
                                      include=include)
-    try:
-        prepare_chroot_env(mounted_path)
+    with chroot_env(mounted_path):
         #Create a brand new ramdisk using the KVM variables set above
         run_command(["/usr/sbin/chroot", mounted_path,
                      "/bin/bash", "-c", mkinitrd_str])
-    finally:
-        remove_chroot_env(mounted_path)
+
+
+# The ramdisk files a kernel version may have, by distro
+# (centos: el5 'initrd-', el6 and later 'initramfs-')
+RAMDISK_NAMES = {'ubuntu': ('initrd.img-%s',),
+                 'centos': ('initramfs-%s.img', 'initrd-%s.img')}
+KERNEL_ARCHES = ('x86_64', 'i686', 'i586', 'i386')
+
+
+def _kernel_ramdisk(boot_dir, distro, kernels, ignore_suffix):
+    """
+    The (ramdisk, version) of the newest of <kernels> with a ramdisk in
+    <boot_dir>, or None
+    """
+    for kernel in reversed(kernels):
+        versions = [kernel]
+        base, _, arch = kernel.rpartition('.')
+        if arch in KERNEL_ARCHES:
+            versions.append(base)  # el5 leaves the arch out
+        if base.endswith(ignore_suffix) or kernel.endswith(ignore_suffix):
+            continue
+        for version in versions:
+            for name in RAMDISK_NAMES[distro]:
+                ramdisk = name % version
+                if os.path.exists(os.path.join(boot_dir, ramdisk)):
+                    return ramdisk, version
+    return None
 
 
 def get_latest_ramdisk(mounted_path, distro, ignore_suffix='el5xen'):
     boot_dir = os.path.join(mounted_path,'boot/')
-    output, _ = run_command(["/bin/bash", "-c", "ls -Fah %s" % boot_dir])
+    # An image mounted by an ImageSession knows its installed kernels
+    guest = guest_cache.for_mount(mounted_path)
+    if guest and distro in RAMDISK_NAMES:
+        found = _kernel_ramdisk(boot_dir, distro, guest.kernels,
+                                ignore_suffix)
+        if found:
+            return found
+        logger.info("No ramdisk in %s matches the installed kernels %s,"
+                    " listing the directory" % (boot_dir, guest.kernels))
     #Determine the latest (KVM) ramdisk to use
     latest_rmdisk = ''
     rmdisk_version = ''
-    for line in output.split('\n'):
-        if 'initrd' in line:
+    for line in sorted(os.listdir(boot_dir)):
+        if ('initrd' in line or line.startswith('initramfs-')) \
+                and 'kdump' not in line:
             if distro == 'ubuntu' and not line.endswith(ignore_suffix):
                 latest_rmdisk = line
                 rmdisk_version = line.replace('initrd.img-','')
             elif distro == 'centos' and not line.endswith("%s.img" % ignore_suffix):
                 latest_rmdisk = line
-                rmdisk_version = line.replace('initrd-','').replace('.img','')
+                rmdisk_version = line.replace('initrd-','').replace(
+                    'initramfs-','').replace('.img','')
     if not latest_rmdisk or not rmdisk_version:
         raise Exception("Could not determine the latest ramdisk. Is the "
                         "ramdisk located in %s?" % boot_dir)
     return latest_rmdisk, rmdisk_version
 
 
-def copy_disk(old_image, new_image, download_dir):
-    old_img_dir = os.path.join(download_dir, 'old_image')
-    new_img_dir  = os.path.join(download_dir, 'new_image')
-    run_command(['mkdir', '-p', old_img_dir])
-    run_command(['mkdir', '-p', new_img_dir])
+def copy_disk(old_image, new_image, download_dir=None):
+    """
+    Copy the root filesystem of <old_image> into the root partition of
+    the raw <new_image> (See create_empty_image) at block level, then
+    grow it to fill the partition. Nothing is mounted.
+    Images that are not raw are converted to a sparse raw file in
+    <download_dir> first, with 'qemu-img convert'.
+    An xfs root filesystem keeps its size (See grow_filesystem).
+    """
+    download_dir = download_dir or os.path.dirname(new_image)
+    source = old_image
+    if _get_type_by_metadata(old_image) != 'raw':
+        (fd, source) = tempfile.mkstemp(prefix='copy_disk_', suffix='.raw',
+                                        dir=download_dir)
+        os.close(fd)
+        try:
+            run_command(['qemu-img', 'convert', '-O', 'raw', '-m', '8', '-W',
+                         old_image, source], check_return=True)
+        except Exception:
+            os.remove(source)
+            raise
     try:
-        mount_image(old_image, old_img_dir)
-        mount_image(new_image, new_img_dir)
+        source_offset = _root_offset(source)
+        fs_size = filesystem_size(source, source_offset)
+        if not fs_size:
+            raise Exception("Could not find the size of the root filesystem"
+                            " of %s" % old_image)
+        disk, partitions = read_partition_table(new_image)
+        target = select_root(partitions)
+        if not target:
+            raise Exception("%s has no partition to copy into" % new_image)
+        target_offset = target.start * disk.logical_sector_size
+        if fs_size > target.size:
+            raise Exception("The root filesystem of %s (%s bytes) does not"
+                            " fit the partition of %s (%s bytes)"
+                            % (old_image, fs_size, new_image, target.size))
+        # The copy skips holes, so the partition must read as zeros
+        run_command(['fallocate', '--punch-hole',
+                     '--offset', str(target_offset),
+                     '--length', str(target.size), new_image],
+                    check_return=True)
+        copy_range(source, source_offset, new_image, target_offset, fs_size)
+    finally:
+        if source != old_image:
+            os.remove(source)
+    grow_filesystem(new_image, target_offset, target.size)
+
+
+def _root_offset(raw_image):
+    """
+    The byte offset of the root filesystem in <raw_image>
+    """
+    if filesystem_type(raw_image):
+        return 0
+    disk, partitions = read_partition_table(raw_image)
+    root = select_root(partitions)
+    if not root:
+        raise Exception("Could not find the root filesystem of %s"
+                        % raw_image)
+    return root.start * disk.logical_sector_size
 
-        run_command(['/bin/bash', '-c', 'rsync --inplace -a %s/* %s'
-                     % (old_img_dir, new_img_dir)])
+
+def grow_filesystem(image_path, offset, size):
+    """
+    Grow the ext* filesystem at <offset> of the raw <image_path> to
+    <size> bytes. Returns False for other filesystems, which are left as
+    they are: growing xfs needs a mount, so 'xfs_growfs' has to run in
+    the guest (ex: cloud-init's growpart and resizefs modules).
+    """
+    fs_type = filesystem_type(image_path, offset)
+    if fs_type not in ('ext2', 'ext3', 'ext4'):
+        logger.warn("Not growing the %s filesystem of %s"
+                    % (fs_type, image_path))
+        return False
+    loop_dev = reserve_device('loop')
+    try:
+        run_command(['losetup', '-o', str(offset), '--sizelimit', str(size),
+                     loop_dev, image_path], check_return=True)
+        try:
+            run_command(['e2fsck', '-f', '-y', loop_dev])
+            run_command(['resize2fs', loop_dev], check_return=True)
+        finally:
+            run_command(['losetup', '-d', loop_dev])
     finally:
-        run_command(['umount', old_img_dir])
-        run_command(['umount', new_img_dir])
-    ##TODO: Delete the directories
-    #old_img_dir)
-    #new_img_dir)
+        release_device(loop_dev)
+    return True
 
 def check_root():
     import getpass
@@ -283,47 +446,119 @@ def mount_image(image_path, mount_point):
     return _detect_and_mount_image(image_path, mount_point)
 
 
+# First sector of the partition of a new image (1 MiB aligned)
+PARTITION_START = 2048
+FS_BLOCK_SIZE = 4096
+MKFS_COMMANDS = {
+    # Inode tables and the journal are left to the kernel to initialize
+    'ext3': ['mkfs.ext3', '-q', '-F', '-b', str(FS_BLOCK_SIZE),
+             '-E', 'offset=%(offset)s,lazy_itable_init=1'],
+    'ext4': ['mkfs.ext4', '-q', '-F', '-b', str(FS_BLOCK_SIZE),
+             '-E', 'offset=%(offset)s,lazy_itable_init=1,'
+                   'lazy_journal_init=1'],
+}
+
+
 def create_empty_image(new_image_path, image_type='raw',
-                      image_size_gb=5, bootable=False, label='root'):
-    run_command(['qemu-img', 'create', '-f', image_type,
-                 new_image_path, "%sG" % image_size_gb])
-
-    #SFDisk script by stdin
-    #See http://linuxgazette.net/issue46/nielsen.html#create
-    if bootable:
-        line_one = ",,L,*\n"
-    else:
-        line_one = ",,L,\n"
-    sfdisk_input = "%s;\n;\n;\n" % line_one
-    run_command(['sfdisk', '-D', new_image_path], stdin=sfdisk_input)
-    #Disk has unformatted partition
-    out, err = run_command(['fdisk','-l',new_image_path])
-    fdisk_stats = _parse_fdisk_stats(out)
-    partition = _select_partition(fdisk_stats['devices'])
-    _format_partition(fdisk_stats['disk'], partition, new_image_path,
-            label=label)
+                      image_size_gb=5, bootable=False, label='root',
+                      fs_type='ext3'):
+    """
+    Create a sparse image of <image_size_gb> with one partition holding an
+    empty <fs_type> filesystem ('ext3', 'ext4' or 'xfs').
+    The partition table is written in-process, and no loop device is used.
+    Images that are not raw are built raw, then converted.
+    """
+    start = time.time()
+    raw_path = new_image_path
+    if image_type != 'raw':
+        # A unique scratch file, so concurrent builds never share one
+        (fd, raw_path) = tempfile.mkstemp(
+            prefix='%s.' % os.path.basename(new_image_path),
+            suffix='.build.raw', dir=os.path.dirname(new_image_path) or '.')
+        os.close(fd)
+    size = image_size_gb * 1024 ** 3
+    try:
+        with open(raw_path, 'wb') as image_file:
+            image_file.truncate(size)
+        sectors = size // 512 - PARTITION_START
+        write_mbr(raw_path, [(bootable, 0x83, PARTITION_START, sectors)])
+        _make_filesystem(raw_path, PARTITION_START * 512, sectors * 512,
+                         fs_type, label)
+        if raw_path != new_image_path:
+            run_command(['qemu-img', 'convert', '-O', image_type, raw_path,
+                         new_image_path], check_return=True)
+    finally:
+        if raw_path != new_image_path:
+            os.remove(raw_path)
+    allocated = os.stat(new_image_path).st_blocks * 512
+    record_created_image(new_image_path, fs_type, size, allocated,
+                         time.time() - start)
     return new_image_path
 
 
+def _make_filesystem(image_path, offset, size, fs_type, label=None):
+    """
+    Make a <size> byte <fs_type> filesystem at <offset> of <image_path>
+    """
+    if fs_type in MKFS_COMMANDS:
+        command = [arg % {'offset': offset}
+                   for arg in MKFS_COMMANDS[fs_type]]
+        if label:
+            command += ['-L', label]
+        run_command(command + [image_path, str(size // FS_BLOCK_SIZE)],
+                    check_return=True)
+        return
+    if fs_type != 'xfs':
+        raise Exception("Cannot make a %s filesystem" % fs_type)
+    # mkfs.xfs has no offset: make it in a sparse file, and copy its data
+    (fd, fs_path) = tempfile.mkstemp(
+        prefix='%s.' % os.path.basename(image_path), suffix='.xfs',
+        dir=os.path.dirname(image_path) or '.')
+    os.close(fd)
+    try:
+        with open(fs_path, 'wb') as fs_file:
+            fs_file.truncate(size)
+        command = ['mkfs.xfs', '-q', '-f', '-K']
+        if label:
+            command += ['-L', label[:12]]  # xfs labels hold 12 characters
+        run_command(command + [fs_path], check_return=True)
+        copy_range(fs_path, 0, image_path, offset, size)
+    finally:
+        os.remove(fs_path)
+
+
 ##
 # Private Methods
 ##
 
-def append_line_in_files(append_files, mount_point, dry_run=False):
+"""
+The *_in_files helpers apply every change in one pass per file.
+Pass a FileEditBatch(mount_point) as <batch> to collect the changes of
+several helpers, then apply them with batch.commit(dry_run)
+"""
+def _commit_edits(batch, mount_point, add_edits, dry_run):
+    if batch:
+        add_edits(batch)
+        return
+    batch = FileEditBatch(mount_point)
+    add_edits(batch)
+    return batch.commit(dry_run=dry_run)
+
+def append_line_in_files(append_files, mount_point, dry_run=False,
+                         batch=None):
     if not append_files:
         return
-    for (append_line, append_to) in append_files:
-        append_to = _check_mount_path(append_to)
-        mounted_filepath = os.path.join(mount_point, append_to)
-        sed_append(append_line, mounted_filepath, dry_run=dry_run)
+    return _commit_edits(batch, mount_point,
+                         lambda edits: edits.append_lines(append_files),
+                         dry_run)
 
-def prepend_line_in_files(prepend_files, mount_point, dry_run=False):
+def prepend_line_in_files(prepend_files, mount_point, dry_run=False,
+                          batch=None):
     if not prepend_files:
         return
-    for (prepend_line, prepend_to) in prepend_files:
-        prepend_to = _check_mount_path(prepend_to)
-        mounted_filepath = os.path.join(mount_point, prepend_to)
-        sed_prepend(prepend_line, mounted_filepath, dry_run=dry_run)
+    return _commit_edits(batch, mount_point,
+                         lambda edits: edits.prepend_lines(prepend_files),
+                         dry_run)
 
 
 
@@ -347,54 +582,62 @@ def overwrite_files(overwrite_files, mount_point, dry_run=False):
         overwrite_file(overwrite_file_path, dry_run=dry_run)
 
 
-def remove_line_in_files(remove_line_files, mount_point, dry_run=False):
+def remove_line_in_files(remove_line_files, mount_point, dry_run=False,
+                         batch=None):
     """
     #Single line removal..
     """
-    for (remove_line_w_str, remove_from) in remove_line_files:
-        remove_from = _check_mount_path(remove_from)
-        mounted_filepath = os.path.join(mount_point, remove_from)
-        sed_delete_one(remove_line_w_str, mounted_filepath, dry_run=dry_run)
+    return _commit_edits(batch, mount_point,
+                         lambda edits: edits.remove_lines(remove_line_files),
+                         dry_run)
 
 
-def replace_line_in_files(replace_line_files, mount_point, dry_run=False):
+def replace_line_in_files(replace_line_files, mount_point, dry_run=False,
+                          batch=None):
     """
     #Single line replacement..
     """
-    for (replace_str, replace_with, replace_where) in replace_line_files:
-        replace_where = _check_mount_path(replace_where)
-        mounted_filepath = os.path.join(mount_point, replace_where)
-        sed_replace(replace_str, replace_with, mounted_filepath,
-                    dry_run=dry_run)
+    return _commit_edits(batch, mount_point,
+                         lambda edits: edits.replace_lines(replace_line_files),
+                         dry_run)
 
 
 def execute_chroot_commands(subprocess_commands, mounted_path, dry_run=False):
     """
     Execute the following command(s) inside a chroot jail
+    Commands are run in order, in one shell (See chromogenic.chroot).
+    Returns the results of those commands.
     """
     # If empty -- do nothing.
     if not subprocess_commands:
         return
-    try:
-        prepare_chroot_env(mounted_path)
+    results = []
+    with chroot_env(mounted_path):
+        batch = []
         for cmd_list in subprocess_commands:
             if 'chroot' not in cmd_list[0]:
-                cmd_list = ["/usr/sbin/chroot", mounted_path] + cmd_list
+                batch.append(cmd_list)
+                continue
+            # Already a complete chroot command, run it by itself
+            results.extend(run_chroot_commands(mounted_path, batch,
+                                               dry_run=dry_run))
+            batch = []
             logger.info(cmd_list)
             run_command(cmd_list, dry_run=dry_run)
-    finally:
-        remove_chroot_env(mounted_path)
+        results.extend(run_chroot_commands(mounted_path, batch,
+                                           dry_run=dry_run))
+    return results
 
 
-def remove_multiline_in_files(multiline_delete_files, mount_point, dry_run=False):
+def remove_multiline_in_files(multiline_delete_files, mount_point, dry_run=False,
+                              batch=None):
     """
     #Remove EVERYTHING between these lines..
     """
-    for (delete_from, delete_to, replace_where) in multiline_delete_files:
-        replace_where = _check_mount_path(replace_where)
-        mounted_filepath = os.path.join(mount_point, replace_where)
-        sed_delete_multi(delete_from, delete_to, mounted_filepath,
-                         dry_run=dry_run)
+    return _commit_edits(
+        batch, mount_point,
+        lambda edits: edits.remove_multilines(multiline_delete_files),
+        dry_run)
 
 
 def _check_mount_path(filepath):
@@ -408,9 +651,13 @@ def _check_mount_path(filepath):
 def check_distro(root_dir=''):
     """
     Either your CentOS or your Ubuntu.
+    An image mounted by an ImageSession is answered from its inspection,
+    when there is one (See inspect_image).
     """
-    etc_release_path = os.path.join(root_dir,'etc/*release*')
-    (out,err) = run_command(['/bin/bash','-c','cat %s' % etc_release_path])
+    guest = guest_cache.for_mount(root_dir) if root_dir else None
+    if guest and guest.distro in ('centos', 'ubuntu'):
+        return guest.distro
+    out = guest_cache.read_release_files(root_dir)
     if 'centos' in out.lower():
         return 'centos'
     elif 'ubuntu' in out.lower():
@@ -427,53 +674,28 @@ def _get_stage_files(root_dir, distro):
 def apply_label(image_path, label='root'):
     run_command(['e2label', image_path, label])
 
-def _format_partition(disk, part, image_path, label=None):
-    #This is a 'known constant'.. It should never change..
-    #4096 = Default block size for ext2/ext3
-    BLOCK_SIZE = 4096
-
-    #First mount the loopback device
-    loop_offset = part['start'] * disk['logical_sector_size']
-    (loop_str, _) = run_command(['losetup', '-fv', '-o', '%s' % loop_offset,
-        image_path])
-
-    #The last word of the output is the device
-    loop_dev = _losetup_extract_device(loop_str)
-    #loop_dev == /dev/loop*
-
-    #Then mkfs
-    unit_length = part['end'] - part['start']
-    fs_size = unit_length * disk['unit_byte_size'] / BLOCK_SIZE
-    run_command(['mkfs.ext3', '-b', '%s' % BLOCK_SIZE, loop_dev])
-    if label:
-        apply_label(loop_dev, label)
-    #Then unmount it all
-    run_command(['losetup', '-d', loop_dev])
-
-
-def _losetup_extract_device(loop_str):
-    return loop_str.split(' ')[-1].strip()
-
 def _get_type_by_metadata(image_path):
-    #TODO: Add more logic here
-    stdout, stderr = run_command(['file',image_path])
-    if 'qcow' in stdout.lower():
-        return 'qcow'
-    else:
-        return 'img'
+    """
+    Return the image format found in the header: 'raw', 'qcow2', 'vmdk', ..
+    (See chromogenic.detect)
+    """
+    return image_format(image_path)
 
 def _mount_by_file_metadata(image_path, mount_point):
     image_type = _get_type_by_metadata(image_path)
-    if 'qcow' in image_type:
-        return mount_qcow(image_path, mount_point)
-    raise Exception("The type of image "
-            "could not be determined by output of 'file'")
+    if image_type == 'raw':
+        result = mount_raw(image_path, mount_point)
+        return (result, None)
+    # qemu-nbd can attach any of the other formats
+    return mount_qcow(image_path, mount_point)
 
 def _detect_and_mount_image(image_path, mount_point):
     try:
         return _mount_by_file_metadata(image_path, mount_point)
     except Exception, no_metadata:
-        pass
+        # An unreadable header, or a failed mount of the detected format
+        logger.warn("Could not mount %s by its header, guessing from its"
+                    " extension: %s" % (image_path, no_metadata))
     #Resort to guessing based on file extension
     file_name, file_ext= os.path.splitext(image_path)
     if file_ext == '.qcow' or file_ext == '.qcow2':
@@ -498,79 +720,218 @@ def unmount_qcow(nbd_device):
     if err:
         return out, err
     out, err = run_command(['qemu-nbd', '-d', nbd_device])
+    release_device(nbd_device)
     if err:
         return out, err
 
-def remove_chroot_env(mount_point):
-    proc_dir = os.path.join(mount_point,'proc/')
-    sys_dir = os.path.join(mount_point,'sys/')
-    dev_dir = os.path.join(mount_point,'dev/')
+# The chroot environment is shared by every caller using the same
+# mount point: realpath(mount_point) -> [number of active users,
+# the targets this process mounted]
+_chroot_users = {}
+_chroot_lock = threading.Lock()
+
+
+def _chroot_mounts(mount_point):
+    """
+    (target, mount command, unmount command) for each chroot mount
+    """
+    proc_dir = os.path.join(mount_point,'proc')
+    sys_dir = os.path.join(mount_point,'sys')
+    dev_dir = os.path.join(mount_point,'dev')
     etc_resolv_file = os.path.join(mount_point,'etc/resolv.conf')
-    run_command(['umount', '-lf', proc_dir], check_return=True)
-    run_command(['umount', '-lf', sys_dir], check_return=True)
-    run_command(['umount', '-lf', dev_dir], check_return=True)
-    run_command(['umount', etc_resolv_file])
+    return [
+        (proc_dir, ['mount', '-t', 'proc', '/proc', proc_dir],
+         ['umount', '-lf', proc_dir]),
+        (sys_dir, ['mount', '-t', 'sysfs', '/sys', sys_dir],
+         ['umount', '-lf', sys_dir]),
+        (dev_dir, ['mount', '-o', 'bind', '/dev',  dev_dir],
+         ['umount', '-lf', dev_dir]),
+        (etc_resolv_file, ['mount', '--bind', '/etc/resolv.conf',
+                           etc_resolv_file],
+         ['umount', etc_resolv_file]),
+    ]
+
+
+def mounted_paths():
+    """
+    The set of mount points in this process' namespace
+    (read from /proc/self/mountinfo)
+    """
+    paths = set()
+    with open('/proc/self/mountinfo') as mountinfo:
+        for line in mountinfo:
+            fields = line.split()
+            if len(fields) > 4:
+                # Spaces, tabs, etc. are escaped as octal (\040)
+                paths.add(fields[4].decode('string_escape'))
+    return paths
+
+
+def remove_chroot_env(mount_point):
+    """
+    Release the chroot environment at <mount_point>.
+    The mounts made by prepare_chroot_env are removed when the last user
+    releases it. Mounts that were already there are left alone.
+    """
+    key = os.path.realpath(mount_point)
+    with _chroot_lock:
+        if key not in _chroot_users:
+            logger.warn("The chroot environment at %s was not prepared"
+                        % mount_point)
+            return
+        _chroot_users[key][0] -= 1
+        if _chroot_users[key][0] > 0:
+            return
+        _, targets = _chroot_users.pop(key)
+        mounted = mounted_paths()
+        for target, _, unmount in reversed(_chroot_mounts(key)):
+            if target in targets and target in mounted:
+                # Never hide the error that ended the chroot commands
+                result = run_command(unmount)
+                if result.returncode != 0:
+                    logger.warn("Could not unmount %s: %s"
+                                % (target, result.err))
 
 
 def prepare_chroot_env(mount_point):
-    proc_dir = os.path.join(mount_point,'proc/')
-    sys_dir = os.path.join(mount_point,'sys/')
-    dev_dir = os.path.join(mount_point,'dev/')
-    etc_resolv_file = os.path.join(mount_point,'etc/resolv.conf')
-    run_command(['mount', '-t', 'proc', '/proc', proc_dir])
-    run_command(['mount', '-t', 'sysfs', '/sys', sys_dir])
-    run_command(['mount', '-o', 'bind', '/dev',  dev_dir])
-    run_command(['mount', '--bind', '/etc/resolv.conf', etc_resolv_file])
-
-def fsck_image(image_path):
-    _, source_ext = os.path.splitext(image_path)
-    if 'qcow' in source_ext:
+    """
+    Mount /proc, /sys, /dev and /etc/resolv.conf inside <mount_point>.
+    Nested callers share the mounts (See chroot_env)
+    """
+    key = os.path.realpath(mount_point)
+    with _chroot_lock:
+        if key not in _chroot_users:
+            targets = set()
+            mounted = mounted_paths()
+            for target, mount, _ in _chroot_mounts(key):
+                if target not in mounted \
+                        and run_command(mount).returncode == 0:
+                    targets.add(target)
+            _chroot_users[key] = [0, targets]
+        _chroot_users[key][0] += 1
+
+
+@contextmanager
+def chroot_env(mount_point):
+    """
+    >> with chroot_env(mounted_path):
+    >>     run_command(['/usr/sbin/chroot', mounted_path, ...])
+    """
+    prepare_chroot_env(mount_point)
+    try:
+        yield mount_point
+    finally:
+        remove_chroot_env(mount_point)
+
+def fsck_image(image_path, session=None):
+    if session:
+        return session.fsck()
+    if _get_type_by_metadata(image_path) != 'raw':
         return fsck_qcow(image_path)
     else:
         return fsck_img(image_path)
 
 def fsck_img(image_path):
-    loop_dev = _get_next_loop()
+    loop_dev = reserve_device('loop')
     try:
-        run_command(['losetup', loop_dev, image_path])
-        run_command(['fsck', '-y', loop_dev])
+        run_command(['losetup', '-P', loop_dev, image_path])
+        run_command(['partprobe', '-s', loop_dev])
+        fsck_device(_root_device(loop_dev), image_path)
     finally:
         run_command(['losetup', '-d', loop_dev])
+        release_device(loop_dev)
 
 def fsck_qcow(image_path):
     """
     Will attempt to auto-repair a QCOW2 image, in case there were errors during
     snapshot creation
     """
-    if 'qcow' not in image_path:
+    if _get_type_by_metadata(image_path) == 'raw':
         return False
-    nbd_dev = _get_next_nbd()
+    nbd_dev = reserve_device('nbd')
     try:
         run_command(['qemu-nbd', '-c', nbd_dev, image_path])
         run_command(['partprobe', '-s', nbd_dev])
-        run_command(['fsck', '-y', nbd_dev])
+        fsck_device(_root_device(nbd_dev), image_path)
     finally:
         run_command(['qemu-nbd', '-d', nbd_dev])
+        release_device(nbd_dev)
 
 
-def _get_parted_fs_type(partition_path):
-    out, err = run_command(['parted', '-sm', partition_path, 'print'])
-    if not out or err:
-        return None
-    elif 'unrecognised disk label' in out:
-        return None
-    elif 'Input/output error' in out:
-        return None
-    elif 'xfs' in out:
-        return 'xfs'
-    elif 'ext3' in out:
-        return 'ext3'
-    elif 'ext4' in out:
-        return 'ext4'
-    else:
-        full_out, _ = run_command(['parted', '-sm', partition_path, 'print'])
-        raise Exception("Received 'parted output' of %s -"
-                        "- Could not determine fs_type" % full_out)
+def _root_device(device):
+    """
+    The partition of the attached disk <device> that holds the root
+    filesystem (See ImageSession.root_device), or <device> itself when
+    the disk has no partition table
+    """
+    try:
+        partition = _fdisk_get_partition(device)
+    except Exception as e:
+        logger.warn("Could not read the partitions of %s: %s" % (device, e))
+        return device
+    partition_dev = partition.get('image_name') if partition else None
+    if not partition_dev:
+        return device
+    if not os.path.exists(partition_dev):
+        logger.warn("%s has no partition device %s" % (device, partition_dev))
+        return device
+    return partition_dev
+
+
+# Replay the journal, and check nothing else
+REPLAY_COMMANDS = {
+    'ext3': ['e2fsck', '-p', '-E', 'journal_only'],
+    'ext4': ['e2fsck', '-p', '-E', 'journal_only'],
+}
+
+
+def fsck_action(state):
+    """
+    What a FilesystemState (See chromogenic.detect) calls for:
+    'skip' when the filesystem was cleanly unmounted, 'replay' when only
+    its journal (or xfs log) must be replayed, or 'full'
+    """
+    if not state:
+        return 'full'
+    if state.clean:
+        return 'skip'
+    if state.needs_recovery and not state.errors \
+            and (state.filesystem in REPLAY_COMMANDS
+                 or state.filesystem == 'xfs'):
+        return 'replay'
+    return 'full'
+
+
+def fsck_device(device, image_path=None):
+    """
+    fsck <device>, unless its superblock says that is not needed.
+    The decision is recorded (See chromogenic.metrics.record_fsck).
+    """
+    start = time.time()
+    try:
+        state = filesystem_state(device)
+    except (IOError, OSError) as read_error:
+        logger.warn("Could not read the filesystem state of %s: %s"
+                    % (device, read_error))
+        state = None
+    action = fsck_action(state)
+    result = None
+    if action == 'full':
+        result = run_command(['fsck', '-y', device])
+    elif action == 'replay' and state.filesystem in REPLAY_COMMANDS:
+        result = run_command(REPLAY_COMMANDS[state.filesystem] + [device])
+    # xfs replays its log when mounted
+    record_fsck(image_path or device, state.filesystem if state else None,
+                action, state.reason if state else 'state not read',
+                time.time() - start)
+    return result
+
+
+def _get_fs_type(partition_path):
+    """
+    Read the filesystem type from its superblock (See chromogenic.detect)
+    """
+    return filesystem_type(partition_path)
 
 
 def _init_xfs(partition_path):
@@ -580,35 +941,251 @@ def _init_xfs(partition_path):
     run_command(['xfs_admin',partition_path])
 
 def mount_qcow(image_path, mount_point):
-    nbd_dev = _get_next_nbd()
-    #Mount disk to /dev/nbd*
-    run_command(['qemu-nbd', '-c', nbd_dev, image_path])
-    run_command(['partprobe', '-s', nbd_dev])
-    #Check if filesystem has multiple partitions
+    """
+    Attach the image to a reserved /dev/nbd* and mount it.
+    On success the device stays reserved until unmount_qcow(nbd_dev).
+    """
+    nbd_dev = reserve_device('nbd')
+    mount_success = False
     try:
-        partition = _fdisk_get_partition(nbd_dev)
-        mount_from = partition.get('image_name',nbd_dev)
-        offset = int(partition.get('start',0)) *512
-        fs_type = _get_parted_fs_type(mount_from)
-    except Exception as e:
-        logger.exception(e)
-        mount_from = nbd_dev
-        offset = 0
-        fs_type = None
-    if fs_type == 'xfs':
-        _init_xfs(mount_from)
-    mount_success = attempt_mount(mount_from, mount_point)
-    if not mount_success:
-        mount_success = attempt_mount(nbd_dev, mount_point, "offset=%s,nouuid" % offset)
+        #Mount disk to /dev/nbd*
+        run_command(['qemu-nbd', '-c', nbd_dev, image_path])
+        run_command(['partprobe', '-s', nbd_dev])
+        #Check if filesystem has multiple partitions
+        try:
+            partition = _fdisk_get_partition(nbd_dev)
+            mount_from = partition.get('image_name',nbd_dev)
+            offset = int(partition.get('start',0)) *512
+            fs_type = _get_fs_type(mount_from)
+        except Exception as e:
+            logger.exception(e)
+            mount_from = nbd_dev
+            offset = 0
+            fs_type = None
+        if fs_type == 'xfs':
+            _init_xfs(mount_from)
+        mount_success = attempt_mount(mount_from, mount_point)
+        if not mount_success:
+            mount_success = attempt_mount(nbd_dev, mount_point, "offset=%s,nouuid" % offset)
+    finally:
+        if not mount_success:
+            # Run only on complete mount failure.. We want to keep the image mounted!
+            run_command(['qemu-nbd', '-d', nbd_dev])
+            release_device(nbd_dev)
     if mount_success:
         return True, nbd_dev
     else:
         logger.error('Could not mount QCOW image:%s to device:%s'
                          % (image_path, nbd_dev))
-        # Run only on complete mount failure.. We want to keep the image mounted!
-        run_command(['qemu-nbd', '-d', nbd_dev])
         return False, None
 
+def inspect_image(image_path, disk_args=None):
+    """
+    Run 'virt-inspector' on <image_path> (or <disk_args>, ex: an attached
+    block device) and return a GuestInfo (See chromogenic.guest).
+    The result is re-used until the image changes.
+    """
+    guest = guest_cache.lookup(image_path)
+    if guest:
+        logger.debug("Re-using the guest inspection of %s" % image_path)
+        return guest
+    key = guest_cache.image_key(image_path)
+    if not disk_args:
+        disk_args = ['-a', image_path]
+    # The whole XML document is needed, so its output is not bounded
+    xml, _ = run_command(['virt-inspector'] + disk_args, max_output=None,
+                         check_return=True)
+    guest = guest_cache.parse_inspection(xml)
+    guest_cache.remember(image_path, key, guest)
+    return guest
+
+
+class ImageSession(object):
+    """
+    Attach an image to a block device once, and share it between the
+    stages of an imaging job (fsck, inspection, cleaning, migration).
+    Partition and filesystem probes are cached for the life of the session.
+
+    >> with ImageSession(image_path) as session:
+    >>     fsck_image(image_path, session=session)
+    >>     mount_and_clean(image_path, session=session)
+    >>     Xen2KVM.convert(image_path, upload_dir, session=session)
+
+    The image is detached once, when the session is closed.
+    With <discard>, qcow (and other non-raw) images are attached so that
+    discards and zero writes free their clusters (See chromogenic.compact).
+    """
+
+    def __init__(self, image_path, discard=False):
+        self.image_path = image_path
+        self.discard = discard
+        self.mount_point = None
+        self._block_device = None
+        self._probes = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def _probe(self, name, probe_method):
+        if name not in self._probes:
+            self._probes[name] = probe_method()
+        return self._probes[name]
+
+    @property
+    def image_type(self):
+        return self._probe('image_type',
+                           lambda: _get_type_by_metadata(self.image_path))
+
+    @property
+    def block_device(self):
+        """
+        The whole disk, ex: /dev/nbd1 for a qcow or /dev/loop0 for a raw image
+        """
+        if not self._block_device:
+            self._block_device = self._attach()
+        return self._block_device
+
+    def _attach(self):
+        if self.image_type != 'raw':
+            device = reserve_device('nbd')
+            attach = ['qemu-nbd', '-c', device, self.image_path]
+            if self.discard:
+                attach[1:1] = ['--discard=unmap', '--detect-zeroes=unmap']
+        else:
+            device = reserve_device('loop')
+            attach = ['losetup', '-P', device, self.image_path]
+        try:
+            run_command(attach, check_return=True)
+            run_command(['partprobe', '-s', device])
+        except Exception:
+            release_device(device)
+            raise
+        logger.info("Attached %s to %s" % (self.image_path, device))
+        return device
+
+    def _detach(self):
+        device = self._block_device
+        self._block_device = None
+        if device.startswith('/dev/nbd'):
+            run_command(['qemu-nbd', '-d', device])
+        else:
+            run_command(['losetup', '-d', device])
+        release_device(device)
+        logger.info("Detached %s from %s" % (self.image_path, device))
+
+    @property
+    def guest(self):
+        """
+        The GuestInfo of the image (See inspect_image). The image is
+        unmounted first.
+        """
+        cached = guest_cache.lookup(self.image_path)
+        if cached:
+            return cached
+        self.unmount()
+        return inspect_image(self.image_path,
+                             ['--format', 'raw', '-a', self.block_device])
+
+    def invalidate_guest(self):
+        """
+        Call after changing the guest (See chromogenic.guest)
+        """
+        guest_cache.invalidate(self.image_path)
+
+    @property
+    def partition(self):
+        """
+        The selected partition (See _select_partition) or None
+        """
+        def _partition():
+            try:
+                return _fdisk_get_partition(self.block_device)
+            except Exception as e:
+                logger.exception(e)
+                return None
+        return self._probe('partition', _partition)
+
+    @property
+    def root_device(self):
+        """
+        The device holding the root filesystem
+        """
+        partition = self.partition
+        if partition and partition.get('image_name'):
+            return partition['image_name']
+        return self.block_device
+
+    @property
+    def fs_type(self):
+        def _fs_type():
+            try:
+                return _get_fs_type(self.root_device)
+            except Exception as e:
+                logger.exception(e)
+                return None
+        return self._probe('fs_type', _fs_type)
+
+    def fsck(self):
+        if self.mount_point:
+            raise Exception("Cannot fsck %s while it is mounted at %s"
+                            % (self.image_path, self.mount_point))
+        return fsck_device(self.root_device, self.image_path)
+
+    def mount(self, mount_point):
+        """
+        Mount the root filesystem at <mount_point>, once.
+        Returns the mount point.
+        """
+        if self.mount_point:
+            if os.path.realpath(self.mount_point) != \
+                    os.path.realpath(mount_point):
+                raise Exception("%s is already mounted at %s"
+                                % (self.image_path, self.mount_point))
+            return self.mount_point
+        if not os.path.isdir(mount_point):
+            os.makedirs(mount_point)
+        if self.fs_type == 'xfs':
+            _init_xfs(self.root_device)
+        guest_cache.register_mount(mount_point, self.image_path)
+        mount_success = attempt_mount(self.root_device, mount_point)
+        if not mount_success and self.partition:
+            offset = int(self.partition.get('start', 0)) * 512
+            mount_success = attempt_mount(self.block_device, mount_point,
+                                          "offset=%s,nouuid" % offset)
+        if not mount_success:
+            guest_cache.unregister_mount(mount_point)
+            raise Exception("Could not mount %s (%s) at %s"
+                            % (self.image_path, self.block_device,
+                               mount_point))
+        self.mount_point = mount_point
+        return mount_point
+
+    def unmount(self):
+        if self.mount_point:
+            run_command(['umount', self.mount_point], check_return=True)
+            guest_cache.unregister_mount(self.mount_point)
+            self.mount_point = None
+
+    def close(self):
+        try:
+            self.unmount()
+        finally:
+            if self._block_device:
+                self._detach()
+
+    def reset(self):
+        """
+        Close the session, and forget its probes. Call after changing the
+        partition table or the size of the image.
+        """
+        self.close()
+        self._probes = {}
+
+
 def attempt_mount(mount_from, mount_point, mount_options=None):
     if mount_options:
         mount_cmd_list = ['mount', "-o %s" % mount_options, mount_from, mount_point]
@@ -625,9 +1202,25 @@ def attempt_mount(mount_from, mount_point, mount_options=None):
 
 
 def fdisk_image(image_path):
-    out, err = run_command(['fdisk','-l',image_path])
-    fdisk_stats = _parse_fdisk_stats(out)
-    return fdisk_stats
+    """
+    Read the partition table of <image_path> (See chromogenic.partitions)
+    Returns the same dictionary 'fdisk -l' parsing used to:
+    {'disk': {heads, sectors_per_track, cylinders, sectors_total,
+              unit_byte_size, logical_sector_size, physical_sector_size,
+              label},
+     'devices': [{image_name, bootable, start, end, blocks, id, system,
+                  number, sectors, size, type_id, kind}, ...]}
+    or {} if the disk could not be read.
+    """
+    try:
+        disk, partitions = read_partition_table(image_path)
+    except (IOError, OSError) as e:
+        logger.warn("Could not read the partition table of %s: %s"
+                    % (image_path, e))
+        return {}
+    if not disk.size:
+        return {}
+    return _partition_stats(disk, partitions)
 
 
 def _fdisk_get_partition(image_path):
@@ -636,33 +1229,6 @@ def _fdisk_get_partition(image_path):
     return partition
 
 
-def _get_next_loop():
-    loop_name = '/dev/loop'
-    loop_count = 0
-    MAX_COUNT = 7
-    while loop_count < MAX_COUNT:
-        loop_dev = '%s%s' % (loop_name, loop_count)  # /dev/loop[0,1,2,...]
-        out, err = run_command(['losetup',loop_dev])
-        if 'no such device' in err.lower():
-            #No such device means the loop is empty, ready for use.
-            return loop_dev
-        loop_count += 1
-    raise Exception("Error: All /dev/loop* devices are in use")
-
-
-def _get_next_nbd():
-    nbd_name = '/dev/nbd'
-    nbd_count = 1
-    MAX_PART = 16
-    while nbd_count < MAX_PART:
-        out, err = run_command(['fdisk','-l','%s%s' % (nbd_name, nbd_count)])
-        if not out:
-            #No output means the nbd is empty, ready for use.
-            return '%s%s' % (nbd_name, nbd_count)
-        nbd_count += 1
-    raise Exception("Error: All /dev/nbd* devices are in use")
-
-
 def mount_raw(image_path, mount_point, attempt_qcow=False):
     out, err = run_command(['mount','-o','loop',image_path,mount_point])
     logger.debug("Mount Output:%s\nMount Error:%s" % (out, err))
@@ -697,99 +1263,39 @@ def mount_raw_with_offsets(image_path, mount_point):
 
 def _select_partition(partitions):
     """
-    TODO: Is there a way to pick the 'real' device out of the list?
-    Ideas:
-      System == 'Linux'
-      Select if bootable
+    Pick the partition holding the root filesystem (See
+    chromogenic.partitions.select_root): the largest Linux partition,
+    skipping swap, extended, EFI and BIOS boot partitions.
     """
-    if not partitions:
-        return None
-    partition = partitions[0]
-    return partition
+    return select_root(partitions)
 
 
-def _parse_fdisk_stats(output):
+def _partition_stats(disk, partitions):
     """
-    Until I find a better way, the best thing to do is parse through fdisk
-    to get the important statistics aboutput the disk image
-
-    Sample Input:
-    (0, '')
-    (1, 'Disk /dev/loop0: 9663 MB, 9663676416 bytes')
-    (2, '255 heads, 63 sectors/track, 1174 cylinders, total 18874368 sectors')
-    (3, 'Units = sectors of 1 * 512 = 512 bytes')
-    (4, 'Sector size (logical/physical): 512 bytes / 512 bytes')
-    (5, 'I/O size (minimum/optimal): 512 bytes / 512 bytes')
-    (6, 'Disk identifier: 0x00000000')
-    (7, '')
-    (8, '      Device Boot      Start         End      Blocks   Id  System')
-    (9, '/dev/loop0p1   *          63    18860309     9430123+  83  Linux')
-    (10, '')
-    Returns:
-        A dictionary of string to int values for the disk:
-        *heads, sectors, cylinders, sector_count, units, Sector Size, Start, End
+    Convert the typed partition records to the dictionaries callers of
+    fdisk_image expect. Geometry uses the usual 255 heads/63 sectors.
     """
-
-
-    DEVICE_LINE = 9
-
-    if not output:
-        return {}
-
-    lines = output.split('\n')
-    #Going line-by-line here.. Line 2
-    disk_map = {}
-    regex = re.compile(
-        "(?P<heads>[0-9]+) heads, "
-        "(?P<sectors_per_track>[0-9]+) sectors/track, "
-        "(?P<cylinders>[0-9]+) cylinders, "
-        "total (?P<sectors_total>[0-9]+) sectors")
-    r = regex.search(lines[2])
-    disk_map.update(r.groupdict())
-    #Adding line 3
-    regex = re.compile("(?P<unit_byte_size>[0-9]+) bytes")
-    r = regex.search(lines[3])
-    disk_map.update(r.groupdict())
-    #Adding line 4
-    regex = re.compile("(?P<logical_sector_size>[0-9]+) bytes / (?P<physical_sector_size>[0-9]+) bytes")
-    r = regex.search(lines[4])
-    disk_map.update(r.groupdict())
-    ## Map each device partition
+    heads, sectors_per_track = 255, 63
+    disk_map = {
+        'heads': heads,
+        'sectors_per_track': sectors_per_track,
+        'cylinders': disk.sectors_total // (heads * sectors_per_track),
+        'sectors_total': disk.sectors_total,
+        'unit_byte_size': disk.logical_sector_size,
+        'logical_sector_size': disk.logical_sector_size,
+        'physical_sector_size': disk.physical_sector_size,
+        'label': disk.label,
+    }
     devices = []
-    while len(lines) > DEVICE_LINE:
-        #TODO: For each partition, capture this input.. Also add optional
-        # bootable flag
-        regex = re.compile("(?P<image_name>[\S]+)\s+(?P<bootable>[*]+)?\s+"
-                           "(?P<start>[0-9]+)\s+(?P<end>[0-9]+)\s+"
-                           "(?P<blocks>[0-9]+)[+]?\s+(?P<id>\w+)\s+"
-                           "(?P<system>.*)")
-        r = regex.search(lines[DEVICE_LINE])
-        #Ignore the empty lines
-        if r:
-            device_stats = r.groupdict()
-            if not device_stats.get('image_name'):
-                raise Exception("Regex failed to properly identify fdisk image. "
-                                "This problem must be fixed by hand!")
-            devices.append(device_stats)
-        DEVICE_LINE += 1
-    #Wrap-it-up
-    fdisk_stats = {}
-    _map_str_to_int(disk_map)
-    [_map_str_to_int(dev) for dev in devices]
-    fdisk_stats.update({'disk':disk_map})
-    fdisk_stats.update({'devices':devices})
-    return fdisk_stats
-
-
-def _map_str_to_int(dictionary):
-    """
-    Regex saves the variables as strings,
-    but they are more useful as ints
-    """
-    for (k,v) in dictionary.items():
-        if type(v) == str and v.isdigit():
-            dictionary[k] = int(v)
-    return dictionary
+    for part in partitions:
+        device = dict(part._asdict())
+        device.update({
+            'bootable': '*' if part.bootable else None,
+            'blocks': part.size // 1024,
+            'id': part.type_id,
+        })
+        devices.append(device)
+    return {'disk': disk_map, 'devices': devices}
 
 
 def build_imaging_dirs(download_dir, full_image=False):
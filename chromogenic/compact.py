@@ -0,0 +1,222 @@
+"""
+imaging/compact.py
+
+Shrink a cleaned image to fit its data, so the image service does not
+store (and serve) its free space:
+
+>> compact_image(image_path, headroom_mb=1024)
+CompactRecord(image='/tmp/image.qcow2', filesystem='ext4',
+              virtual_before=21474836480, virtual_after=3221225472, ...)
+
+The free space of the root filesystem is trimmed (or zeroed), then an
+ext* root filesystem is shrunk to its minimum size plus <headroom_mb>,
+its partition is shrunk to match, and the disk is truncated after it.
+Images that are not raw are attached by qemu-nbd with discard support
+for this, so trimmed blocks are passed through to the image. Finally the
+freed blocks are dropped from the image file: a raw image gets
+'fallocate --dig-holes', any other format is rewritten by
+'qemu-img convert', which leaves out zero clusters.
+The partition and the disk are only shrunk when the root partition is
+the last one of an MBR (dos) table, or when the disk has no table.
+Other filesystems (ex: xfs, which can not shrink) are only trimmed.
+
+Compaction is opt-in: set COMPACT_IMAGES, or pass compact_image=True to
+clone_image or start_migration.
+"""
+import logging
+import os
+import re
+import tempfile
+import time
+
+from chromogenic.common import run_command, ImageSession
+from chromogenic.detect import image_info
+from chromogenic.metrics import record_compaction
+from chromogenic.partitions import read_partition_table
+from chromogenic.settings import chromo_settings
+
+logger = logging.getLogger(__name__)
+
+EXT_FILESYSTEMS = ('ext2', 'ext3', 'ext4')
+ALIGNMENT = 1024 * 1024  # Filesystems and disks end on a MiB boundary
+
+
+def compact_requested(**kwargs):
+    """
+    True if this request (or the COMPACT_IMAGES setting) asks for
+    compaction
+    """
+    return kwargs.get('compact_image', chromo_settings.COMPACT_IMAGES)
+
+
+def compact_image(image_path, session=None, headroom_mb=None):
+    """
+    Compact the image at <image_path> and return its CompactRecord
+    (See chromogenic.metrics). If an ImageSession is given, it is reset:
+    the image is attached again by the next stage.
+    """
+    if not session:
+        with ImageSession(image_path, discard=True) as session:
+            return compact_image(image_path, session, headroom_mb)
+    if headroom_mb is None:
+        headroom_mb = chromo_settings.COMPACT_HEADROOM_MB
+    start = time.time()
+    before = image_sizes(image_path)
+    session.unmount()
+    discard = session.discard
+    if session.image_type != 'raw' and not discard:
+        # Attach again, so fstrim reaches the image
+        session.reset()
+        session.discard = True
+    fs_type = session.fs_type
+    trim_free_space(session)
+    disk_size = None
+    if fs_type in EXT_FILESYSTEMS:
+        fs_size = shrink_ext(session.root_device, headroom_mb * 1024 * 1024)
+        if fs_size:
+            disk_size = _shrink_partition(session, fs_size)
+    else:
+        logger.info("%s is %s: it is trimmed, but not shrunk"
+                    % (image_path, fs_type))
+    image_format = session.image_type
+    session.reset()
+    session.discard = discard
+    if disk_size and disk_size < before[0]:
+        run_command(['qemu-img', 'resize', '--shrink', '-f', image_format,
+                     image_path, str(disk_size)], check_return=True)
+    sparsify(image_path, image_format)
+    after = image_sizes(image_path)
+    record = record_compaction(image_path, fs_type, before, after,
+                               time.time() - start)
+    logger.info("Compacted %s: %s -> %s bytes (virtual), %s -> %s bytes"
+                " (allocated) in %.2fs"
+                % (image_path, before[0], after[0], before[1], after[1],
+                   record.wall_time))
+    return record
+
+
+def image_sizes(image_path):
+    """
+    (virtual size, allocated size) of <image_path>, in bytes
+    """
+    stat = os.stat(image_path)
+    virtual_size = image_info(image_path).virtual_size or stat.st_size
+    return (virtual_size, stat.st_blocks * 512)
+
+
+def sparsify(image_path, image_format):
+    """
+    Deallocate the zeroed (or trimmed) blocks of <image_path>
+    """
+    if image_format == 'raw':
+        run_command(['fallocate', '--dig-holes', image_path],
+                    check_return=True)
+        return
+    (fd, tmp_path) = tempfile.mkstemp(
+        prefix='.compact-', suffix='.%s' % image_format,
+        dir=os.path.dirname(os.path.abspath(image_path)))
+    os.close(fd)
+    try:
+        run_command(['qemu-img', 'convert', '-f', image_format,
+                     '-O', image_format, image_path, tmp_path],
+                    check_return=True)
+        os.chmod(tmp_path, os.stat(image_path).st_mode & 0o7777)
+        os.rename(tmp_path, image_path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def trim_free_space(session):
+    """
+    Discard the free blocks of the root filesystem with 'fstrim'. When
+    the device does not support discard (or a qemu-nbd device would
+    ignore it), zero them with 'zerofree' (ext* only) so they can be left
+    out of the image.
+    """
+    if session.image_type != 'raw' and not session.discard:
+        return _zero_free_space(session)
+    mount_point = tempfile.mkdtemp(prefix='compact-')
+    try:
+        session.mount(mount_point)
+        try:
+            result = run_command(['fstrim', '-v', mount_point])
+        finally:
+            session.unmount()
+        if result.returncode == 0:
+            return True
+        logger.info("fstrim failed (%s), zeroing free blocks instead"
+                    % result.err)
+    except Exception as trim_error:
+        logger.warn("Could not trim %s: %s"
+                    % (session.image_path, trim_error))
+    finally:
+        os.rmdir(mount_point)
+    return _zero_free_space(session)
+
+
+def _zero_free_space(session):
+    if session.fs_type not in EXT_FILESYSTEMS:
+        return False
+    return run_command(['zerofree', session.root_device]).returncode == 0
+
+
+def shrink_ext(device, headroom):
+    """
+    Shrink the ext* filesystem on <device> to its minimum size plus
+    <headroom> bytes. Returns its new size in bytes, or None if it was
+    not shrunk.
+    """
+    # resize2fs insists on a freshly checked filesystem
+    run_command(['e2fsck', '-f', '-y', device])
+    block_size, block_count = _ext_geometry(device)
+    out, _ = run_command(['resize2fs', '-P', device], check_return=True)
+    match = re.search(r'minimum size of the filesystem:\s*(\d+)', out)
+    if not match:
+        logger.warn("Could not read the minimum size of %s: %s"
+                    % (device, out))
+        return None
+    target = int(match.group(1)) * block_size + headroom
+    target = -(-target // ALIGNMENT) * ALIGNMENT
+    target_blocks = target // block_size
+    if target_blocks >= block_count:
+        logger.info("%s is already within %s bytes of its minimum size"
+                    % (device, headroom))
+        return None
+    run_command(['resize2fs', device, str(target_blocks)],
+                check_return=True)
+    return target_blocks * block_size
+
+
+def _ext_geometry(device):
+    out, _ = run_command(['dumpe2fs', '-h', device], check_return=True)
+    fields = dict(re.findall(r'^(Block size|Block count):\s*(\d+)', out,
+                             re.MULTILINE))
+    return int(fields['Block size']), int(fields['Block count'])
+
+
+def _shrink_partition(session, fs_size):
+    """
+    Shrink the root partition to <fs_size> bytes. Returns the size the
+    disk can be truncated to, or None if it must keep its size.
+    """
+    disk, partitions = read_partition_table(session.block_device)
+    if not disk.label:
+        return fs_size
+    root = session.partition
+    if disk.label != 'dos' or not root:
+        logger.info("Not shrinking the %s partition table of %s"
+                    % (disk.label, session.image_path))
+        return None
+    last = max(partitions, key=lambda part: part.end)
+    if last.number != root['number']:
+        logger.info("The root partition of %s is not the last one,"
+                    " the disk keeps its size" % session.image_path)
+        return None
+    sectors = fs_size // disk.logical_sector_size
+    # Keep the start, change the size (in sectors)
+    run_command(['sfdisk', '--no-reread', '-N', str(root['number']),
+                 session.block_device], stdin=',%s\n' % sectors,
+                check_return=True)
+    end = (root['start'] + sectors) * disk.logical_sector_size
+    return -(-end // ALIGNMENT) * ALIGNMENT
@@ -0,0 +1,425 @@
+"""
+imaging/detect.py
+
+Identify disk image formats and filesystems from their headers, without
+running 'file', 'qemu-img info' or 'parted':
+
+>> image_info('/tmp/instance.qcow2')
+ImageInfo(format='qcow2', version=3, virtual_size=10737418240,
+          cluster_size=65536, filesystem=None)
+>> image_info('/tmp/instance.img')
+ImageInfo(format='raw', version=None, virtual_size=10737418240,
+          cluster_size=None, filesystem='ext4')
+>> filesystem_type('/dev/nbd1p1')
+'xfs'
+>> filesystem_state('/dev/nbd1p1')
+FilesystemState(filesystem='xfs', clean=True, needs_recovery=False,
+                errors=False, reason='log ends with an unmount record')
+
+Filesystems can only be found on raw images (or attached block devices).
+For a raw image that has a partition table, the root partition is read
+(See chromogenic.partitions.select_root).
+"""
+import logging
+import os
+import struct
+from collections import namedtuple
+
+from chromogenic.partitions import read_partition_table, select_root
+
+logger = logging.getLogger(__name__)
+
+FilesystemState = namedtuple('FilesystemState', [
+    'filesystem',  # See filesystem_type
+    'clean',  # True if cleanly unmounted, None if it can not be told
+    'needs_recovery',  # The journal (or log) must be replayed
+    'errors',  # The filesystem has recorded errors
+    'reason',
+])
+
+ImageInfo = namedtuple('ImageInfo', [
+    'format',  # 'qcow', 'qcow2', 'vmdk', 'vdi', 'vhd', 'vhdx' or 'raw'
+    'version',
+    'virtual_size',  # bytes, or None if the header does not say
+    'cluster_size',  # bytes, or None
+    'filesystem',  # See filesystem_type
+])
+
+QCOW_MAGIC = 'QFI\xfb'
+VMDK_MAGIC = 'KDMV'
+VMDK_DESCRIPTOR = '# Disk DescriptorFile'
+VDI_MAGIC = 0xbeda107f
+VHD_COOKIE = 'conectix'
+VHDX_MAGIC = 'vhdxfile'
+
+EXT_MAGIC = 0xef53
+EXT_VALID_FS = 0x1  # s_state: cleanly unmounted
+EXT_ERROR_FS = 0x2  # s_state: errors detected
+EXT_COMPAT_HAS_JOURNAL = 0x4
+EXT_INCOMPAT_RECOVER = 0x4  # The journal needs recovery
+EXT_INCOMPAT_64BIT = 0x80
+EXT_INCOMPAT_EXT4 = 0x40 | 0x80 | 0x200  # extents, 64bit, flex_bg
+EXT_RO_COMPAT_EXT4 = 0x8 | 0x10 | 0x20 | 0x400  # huge_file, gdt_csum,
+                                                # dir_nlink, metadata_csum
+XFS_MAGIC = 'XFSB'
+XLOG_HEADER_MAGIC = 0xfeedbabe
+XLOG_UNMOUNT_TRANS = 0x20  # Op header flag of the unmount record
+XLOG_CLIENT_ID = 0xaa  # XFS_LOG
+XLOG_HEADER_CYCLE_SIZE = 32 * 1024
+BB_SIZE = 512  # XFS 'basic block'
+# Look this many basic blocks back from the log head for the last record
+XLOG_MAX_SCAN = 4096
+BTRFS_MAGIC = '_BHRfS_M'
+SWAP_MAGIC = 'SWAPSPACE2'
+
+HEADER_SIZE = 512
+
+
+def image_info(image_path):
+    """
+    Return an ImageInfo for <image_path>. Anything that is not a known
+    image container is 'raw'.
+    """
+    fd = os.open(image_path, os.O_RDONLY)
+    try:
+        size = os.lseek(fd, 0, os.SEEK_END)
+        header = _read(fd, 0, HEADER_SIZE)
+        for detect in (_qcow_info, _vmdk_info, _vdi_info, _vhdx_info):
+            info = detect(fd, header)
+            if info:
+                return info
+        info = _vhd_info(fd, header, size)
+        if info:
+            return info
+    finally:
+        os.close(fd)
+    return ImageInfo('raw', None, size, None, _raw_filesystem(image_path))
+
+
+def image_format(image_path):
+    return image_info(image_path).format
+
+
+def filesystem_type(path, offset=0):
+    """
+    Return 'ext2', 'ext3', 'ext4', 'xfs', 'btrfs', 'swap' or None
+    for the filesystem starting <offset> bytes into <path>
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return detect_filesystem(_reader(fd, offset))
+    finally:
+        os.close(fd)
+
+
+def filesystem_state(path, offset=0):
+    """
+    Return a FilesystemState for the filesystem starting <offset> bytes
+    into <path>, from its superblock (ext*) or log (xfs)
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return read_filesystem_state(_reader(fd, offset))
+    finally:
+        os.close(fd)
+
+
+def filesystem_size(path, offset=0):
+    """
+    The size in bytes of the filesystem starting <offset> bytes into
+    <path>, from its superblock (ext* and xfs), or None
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return read_filesystem_size(_reader(fd, offset))
+    finally:
+        os.close(fd)
+
+
+def read_filesystem_size(read):
+    """
+    As filesystem_size, where read(offset, length) returns the bytes of
+    the filesystem
+    """
+    fs_type = detect_filesystem(read)
+    if fs_type in ('ext2', 'ext3', 'ext4'):
+        superblock = read(1024, 1024)
+        blocks, = struct.unpack('<I', superblock[0x4:0x8])
+        log_block_size, = struct.unpack('<I', superblock[0x18:0x1c])
+        incompat, = struct.unpack('<I', superblock[0x60:0x64])
+        if incompat & EXT_INCOMPAT_64BIT:
+            blocks_hi, = struct.unpack('<I', superblock[0x150:0x154])
+            blocks |= blocks_hi << 32
+        return blocks * (1024 << log_block_size)
+    if fs_type == 'xfs':
+        superblock = read(0, 512)
+        block_size, = struct.unpack('>I', superblock[4:8])
+        blocks, = struct.unpack('>Q', superblock[8:16])
+        return blocks * block_size
+    return None
+
+
+def read_filesystem_state(read):
+    """
+    As filesystem_state, where read(offset, length) returns the bytes of
+    the filesystem (ex: from a libguestfs handle)
+    """
+    fs_type = detect_filesystem(read)
+    if fs_type in ('ext2', 'ext3', 'ext4'):
+        return _ext_state(fs_type, read)
+    if fs_type == 'xfs':
+        return _xfs_state(read)
+    return FilesystemState(fs_type, None, False, False,
+                           'state is not read for this filesystem')
+
+
+def xfs_external_log(read):
+    """
+    True if the xfs filesystem read by read(offset, length) keeps its log
+    on another device
+    """
+    logstart, = struct.unpack('>Q', read(0, 512)[48:56])
+    return not logstart
+
+
+def _reader(fd, base_offset):
+    return lambda offset, length: _read(fd, base_offset + offset, length)
+
+
+def _read(fd, offset, length):
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, length)
+
+
+def _qcow_info(fd, header):
+    if header[:4] != QCOW_MAGIC:
+        return None
+    version, = struct.unpack('>I', header[4:8])
+    virtual_size, = struct.unpack('>Q', header[24:32])
+    if version == 1:
+        cluster_bits, = struct.unpack('>B', header[32:33])
+        image_type = 'qcow'
+    else:
+        cluster_bits, = struct.unpack('>I', header[20:24])
+        image_type = 'qcow2'
+    return ImageInfo(image_type, version, virtual_size, 1 << cluster_bits,
+                     None)
+
+
+def _vmdk_info(fd, header):
+    if header[:4] == VMDK_MAGIC:
+        version, _, capacity, grain_size = struct.unpack(
+            '<IIQQ', header[4:28])
+        return ImageInfo('vmdk', version, capacity * 512, grain_size * 512,
+                         None)
+    if header.startswith(VMDK_DESCRIPTOR):
+        # A descriptor file: the extents list the size in sectors
+        descriptor = header + _read(fd, HEADER_SIZE, 10240)
+        sectors = 0
+        for line in descriptor.splitlines():
+            words = line.split()
+            if len(words) > 1 and words[0] in ('RW', 'RDONLY', 'NOACCESS') \
+                    and words[1].isdigit():
+                sectors += int(words[1])
+        return ImageInfo('vmdk', None, sectors * 512 or None, None, None)
+    return None
+
+
+def _vdi_info(fd, header):
+    if len(header) < 0x48:
+        return None
+    magic, version = struct.unpack('<II', header[0x40:0x48])
+    if magic != VDI_MAGIC:
+        return None
+    # Version 1.1 header
+    virtual_size, block_size = struct.unpack('<QI', header[0x170:0x17c])
+    return ImageInfo('vdi', version >> 16, virtual_size, block_size, None)
+
+
+def _vhdx_info(fd, header):
+    if header[:8] != VHDX_MAGIC:
+        return None
+    # Sizes live in the metadata region, which is not worth parsing here
+    return ImageInfo('vhdx', None, None, None, None)
+
+
+def _vhd_info(fd, header, size):
+    """
+    Dynamic disks start with a copy of the footer. Fixed disks only have
+    the footer, in the last 512 bytes.
+    """
+    if header[:8] == VHD_COOKIE:
+        footer = header
+    elif size >= HEADER_SIZE:
+        footer = _read(fd, size - HEADER_SIZE, HEADER_SIZE)
+        if footer[:8] != VHD_COOKIE:
+            return None
+    else:
+        return None
+    data_offset, = struct.unpack('>Q', footer[16:24])
+    version, = struct.unpack('>I', footer[12:16])
+    virtual_size, = struct.unpack('>Q', footer[48:56])
+    disk_type, = struct.unpack('>I', footer[60:64])
+    block_size = None
+    if disk_type in (3, 4) and data_offset != 0xffffffffffffffff:
+        dynamic_header = _read(fd, data_offset, 40)
+        if dynamic_header[:8] == 'cxsparse':
+            block_size, = struct.unpack('>I', dynamic_header[32:36])
+    return ImageInfo('vhd', version >> 16, virtual_size, block_size, None)
+
+
+def _raw_filesystem(image_path):
+    fs_type = filesystem_type(image_path)
+    if fs_type:
+        return fs_type
+    try:
+        disk, partitions = read_partition_table(image_path)
+    except (IOError, OSError):
+        return None
+    root = select_root(partitions)
+    if not root:
+        return None
+    return filesystem_type(image_path,
+                           root.start * disk.logical_sector_size)
+
+
+def detect_filesystem(read):
+    """
+    As filesystem_type, where read(offset, length) returns the bytes of
+    the filesystem
+    """
+    superblock = read(1024, 1024)
+    if len(superblock) >= 0x68:
+        magic, = struct.unpack('<H', superblock[0x38:0x3a])
+        if magic == EXT_MAGIC:
+            compat, incompat, ro_compat = struct.unpack(
+                '<III', superblock[0x5c:0x68])
+            if incompat & EXT_INCOMPAT_EXT4 or ro_compat & EXT_RO_COMPAT_EXT4:
+                return 'ext4'
+            if compat & EXT_COMPAT_HAS_JOURNAL:
+                return 'ext3'
+            return 'ext2'
+    if read(0, 4) == XFS_MAGIC:
+        return 'xfs'
+    if read(65536 + 64, 8) == BTRFS_MAGIC:
+        return 'btrfs'
+    if read(4096 - 10, 10) == SWAP_MAGIC:
+        return 'swap'
+    return None
+
+
+def _ext_state(fs_type, read):
+    superblock = read(1024, 1024)
+    state, = struct.unpack('<H', superblock[0x3a:0x3c])
+    incompat, = struct.unpack('<I', superblock[0x60:0x64])
+    errors = bool(state & EXT_ERROR_FS)
+    needs_recovery = bool(incompat & EXT_INCOMPAT_RECOVER)
+    clean = bool(state & EXT_VALID_FS) and not errors and not needs_recovery
+    if errors:
+        reason = 'errors were recorded'
+    elif needs_recovery:
+        reason = 'the journal needs recovery'
+    elif not clean:
+        reason = 'not cleanly unmounted'
+    else:
+        reason = 'cleanly unmounted'
+    return FilesystemState(fs_type, clean, needs_recovery, errors, reason)
+
+
+def _xfs_state(read):
+    """
+    XFS has no 'clean' flag: it is clean when the last record of its log
+    is an unmount record. Only internal logs are read.
+    """
+    superblock = read(0, 512)
+    blocksize, = struct.unpack('>I', superblock[4:8])
+    logstart, = struct.unpack('>Q', superblock[48:56])
+    agblocks, = struct.unpack('>I', superblock[84:88])
+    logblocks, = struct.unpack('>I', superblock[96:100])
+    agblklog, = struct.unpack('>B', superblock[124:125])
+    if not logstart:
+        return FilesystemState('xfs', None, False, False,
+                               'the log is external')
+    # logstart is a filesystem block number: (AG number, block in the AG)
+    agno = logstart >> agblklog
+    agbno = logstart & ((1 << agblklog) - 1)
+    log_offset = (agno * agblocks + agbno) * blocksize
+    log_bbs = logblocks * blocksize // BB_SIZE
+
+    def read_bb(bb):
+        return read(log_offset + (bb % log_bbs) * BB_SIZE, BB_SIZE)
+
+    head = _xlog_head(read_bb, log_bbs)
+    if head is None:
+        return FilesystemState('xfs', None, True, False,
+                               'the log head could not be found')
+    clean = _xlog_unmounted(read_bb, log_bbs, head)
+    if clean:
+        return FilesystemState('xfs', True, False, False,
+                               'log ends with an unmount record')
+    return FilesystemState('xfs', False, True, False,
+                           'the log needs to be replayed')
+
+
+def _xlog_cycle(block):
+    """
+    Every log block starts with its cycle number, except record headers,
+    which hold it after their magic number
+    """
+    word, = struct.unpack('>I', block[:4])
+    if word == XLOG_HEADER_MAGIC:
+        word, = struct.unpack('>I', block[4:8])
+    return word
+
+
+def _xlog_head(read_bb, log_bbs):
+    """
+    The first block of the log that has not been written in the current
+    cycle (blocks before the head have cycle N, blocks after it N - 1)
+    """
+    first_cycle = _xlog_cycle(read_bb(0))
+    last_cycle = _xlog_cycle(read_bb(log_bbs - 1))
+    if not first_cycle:
+        return None
+    if first_cycle == last_cycle:
+        # Written up to the end of the log: the head wrapped to the start
+        return 0
+    if last_cycle != first_cycle - 1:
+        return None
+    low, high = 0, log_bbs - 1
+    while high - low > 1:
+        middle = (low + high) // 2
+        if _xlog_cycle(read_bb(middle)) == first_cycle:
+            low = middle
+        else:
+            high = middle
+    return high
+
+
+def _xlog_unmounted(read_bb, log_bbs, head):
+    """
+    True if the record that ends at <head> is an unmount record
+    """
+    for back in range(1, min(XLOG_MAX_SCAN, log_bbs) + 1):
+        bb = (head - back) % log_bbs
+        header = read_bb(bb)
+        magic, = struct.unpack('>I', header[:4])
+        if magic != XLOG_HEADER_MAGIC:
+            continue
+        version, length = struct.unpack('>II', header[8:16])
+        num_logops, = struct.unpack('>i', header[40:44])
+        header_size, = struct.unpack('>i', header[320:324])
+        header_bbs = 1
+        if version & 2 and header_size > XLOG_HEADER_CYCLE_SIZE:
+            header_bbs = -(-header_size // XLOG_HEADER_CYCLE_SIZE)
+        data_bbs = -(-length // BB_SIZE)
+        if (bb + header_bbs + data_bbs) % log_bbs != head % log_bbs:
+            # A torn or partial record
+            return False
+        if num_logops != 1:
+            return False
+        op_header = read_bb(bb + header_bbs)
+        client_id, flags = struct.unpack('>BB', op_header[8:10])
+        return client_id == XLOG_CLIENT_ID and \
+            bool(flags & XLOG_UNMOUNT_TRANS)
+    return False
@@ -0,0 +1,223 @@
+"""
+imaging/devices.py
+
+Reserve loop and network block (nbd) devices for a single job.
+
+A device is reserved by holding an exclusive lock on
+<DEVICE_LOCK_DIR>/<device>.lock, so two jobs (threads or processes) can
+never be handed the same device. The kernel drops the lock if the
+process dies, and device state is read from sysfs instead of running
+'losetup' or 'fdisk' against every device:
+
+>> nbd_dev = reserve_device('nbd')    # '/dev/nbd3'
+>> try:
+>>     run_command(['qemu-nbd', '-c', nbd_dev, image_path])
+>>     ...
+>> finally:
+>>     run_command(['qemu-nbd', '-d', nbd_dev])
+>>     release_device(nbd_dev)
+
+A reservation lasts until release_device, or until the process exits
+(the lock dies with it, and release_all runs at exit). It is never taken
+back while the process runs, however long the device stays detached.
+
+Free loop devices are asked from the kernel first (LOOP_CTL_GET_FREE).
+When another job holds the lock of that device, the other loop devices
+are scanned, and a new one is added (LOOP_CTL_ADD) when they are all
+taken.
+"""
+import atexit
+import errno
+import fcntl
+import glob
+import logging
+import os
+import re
+import threading
+
+from chromogenic.settings import chromo_settings
+
+logger = logging.getLogger(__name__)
+
+SYS_BLOCK = '/sys/block'
+LOOP_CONTROL = '/dev/loop-control'
+LOOP_CTL_ADD = 0x4C80
+LOOP_CTL_GET_FREE = 0x4C82
+MAX_NEW_LOOPS = 8  # loop devices added by one reserve_device call
+
+_reserved = {}  # device path -> lock file
+_reserved_lock = threading.Lock()
+
+
+def _lock_dir():
+    lock_dir = chromo_settings.DEVICE_LOCK_DIR
+    if not os.path.isdir(lock_dir):
+        try:
+            os.makedirs(lock_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    return lock_dir
+
+
+def _device_names(kind):
+    """
+    All devices of this kind known to the kernel, in numeric order
+    """
+    names = [os.path.basename(path)
+             for path in glob.glob(os.path.join(SYS_BLOCK, '%s*' % kind))]
+    names = [name for name in names if re.match(r'^%s\d+$' % kind, name)]
+    return sorted(names, key=lambda name: int(name[len(kind):]))
+
+
+def is_attached(device):
+    """
+    True if the kernel reports this loop/nbd device as in use
+    """
+    name = os.path.basename(device)
+    sys_dir = os.path.join(SYS_BLOCK, name)
+    if name.startswith('loop'):
+        return os.path.exists(os.path.join(sys_dir, 'loop', 'backing_file'))
+    if os.path.exists(os.path.join(sys_dir, 'pid')):
+        return True
+    try:
+        with open(os.path.join(sys_dir, 'size')) as size_file:
+            return int(size_file.read().strip() or 0) > 0
+    except (IOError, ValueError):
+        return False
+
+
+def _try_lock(name):
+    lock_path = os.path.join(_lock_dir(), '%s.lock' % name)
+    lock_file = open(lock_path, 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as e:
+        lock_file.close()
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            return None
+        raise
+    return lock_file
+
+
+def _loop_control(request, argument=0):
+    """
+    The loop device number returned by a /dev/loop-control ioctl, or None
+    """
+    try:
+        control = os.open(LOOP_CONTROL, os.O_RDWR)
+    except OSError:
+        return None
+    try:
+        return fcntl.ioctl(control, request, argument)
+    except IOError:
+        return None
+    finally:
+        os.close(control)
+
+
+def _reserve_new_loop():
+    """
+    Add loop devices after the last one until one can be locked
+    """
+    names = _device_names('loop')
+    number = int(names[-1][len('loop'):]) + 1 if names else 0
+    for number in range(number, number + MAX_NEW_LOOPS):
+        added = _loop_control(LOOP_CTL_ADD, number)
+        if added is None:
+            # Added by someone else meanwhile: try the next number
+            continue
+        name = 'loop%s' % added
+        lock_file = _try_lock(name)
+        if lock_file:
+            return _add_reservation(name, lock_file)
+    return None
+
+
+def reserve_device(kind):
+    """
+    Reserve the first free <kind> ('loop' or 'nbd') device
+    and return its path, ex: '/dev/nbd1'
+    """
+    if kind == 'loop':
+        free = _loop_control(LOOP_CTL_GET_FREE)
+        name = 'loop%s' % free if free is not None else None
+        lock_file = _try_lock(name) if name else None
+        if lock_file:
+            if not is_attached(name):
+                return _add_reservation(name, lock_file)
+            lock_file.close()
+        # Locked by another job: scan the other loop devices
+    names = _device_names(kind)
+    if kind == 'nbd':
+        #NOTE: nbd0 is left alone, as it always has been.
+        names = [name for name in names if name != 'nbd0']
+    for name in names:
+        if is_attached(name):
+            continue
+        lock_file = _try_lock(name)
+        if not lock_file:
+            continue
+        # Attached between the sysfs check and the lock, by a tool that
+        # does not use these reservations
+        if is_attached(name):
+            lock_file.close()
+            continue
+        return _add_reservation(name, lock_file)
+    if kind == 'loop':
+        device = _reserve_new_loop()
+        if device:
+            return device
+    raise Exception("Error: All /dev/%s* devices are in use" % kind)
+
+
+def _add_reservation(name, lock_file):
+    device = os.path.join('/dev', name)
+    with _reserved_lock:
+        _reserved[device] = lock_file
+    logger.debug("Reserved device %s" % device)
+    return device
+
+
+def release_device(device):
+    """
+    Release a device returned by reserve_device. The caller is
+    responsible for detaching it first. Unknown devices are ignored.
+    """
+    with _reserved_lock:
+        lock_file = _reserved.pop(device, None)
+    if not lock_file:
+        return False
+    lock_file.close()
+    logger.debug("Released device %s" % device)
+    return True
+
+
+def release_all():
+    with _reserved_lock:
+        devices = list(_reserved.keys())
+    for device in devices:
+        release_device(device)
+
+atexit.register(release_all)
+
+
+def pool_usage():
+    """
+    Return a summary of each device pool:
+    {'nbd': {'total': 16, 'attached': [...], 'reserved': [...]}, 'loop': ...}
+    'reserved' lists the devices reserved by this process.
+    """
+    usage = {}
+    with _reserved_lock:
+        reserved = list(_reserved.keys())
+    for kind in ('loop', 'nbd'):
+        names = _device_names(kind)
+        devices = [os.path.join('/dev', name) for name in names]
+        usage[kind] = {
+            'total': len(devices),
+            'attached': [device for device in devices if is_attached(device)],
+            'reserved': sorted(device for device in reserved
+                               if os.path.basename(device).startswith(kind)),
+        }
+    return usage
@@ -50,10 +50,8 @@ class BaseDriver():
                            image_size+pad_size,  # Add some empty space..
                            bootable=True)
         download_dir = os.path.dirname(local_img_path)
-        mount_point = os.path.join(download_dir,"mount_point/")
-        #copy the data
+        #copy the root filesystem, and grow it to fill the partition
         copy_disk(old_image=local_img_path,
                   new_image=local_raw_path,
                   download_dir=download_dir)
-        #TODO: Grow filesystem via OS??
         return local_raw_path
@@ -18,9 +18,16 @@ import time
 import sys
 import os
 import math
+import socket
 import subprocess
+import threading
+import httplib
 import logging
-from datetime import datetime
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import partial
+from multiprocessing.pool import ThreadPool
 from urlparse import urlparse
 from xml.dom import minidom
 
@@ -40,6 +47,8 @@ except ImportError:
 
 from chromogenic.clean  import mount_and_clean
 from chromogenic.common import run_command, wildcard_remove
+from chromogenic.remote import ssh_session, transfer_remote_file
+from chromogenic.metrics import bind_context
 from chromogenic.common import mount_image, get_latest_ramdisk,\
                                _copy_kernel, _copy_ramdisk
 from django.conf import settings
@@ -48,15 +57,65 @@ from chromogenic.drivers.base import BaseDriver
 
 logger = logging.getLogger(__name__)
 
+# Failures that mean the connection itself (not the request) went bad
+CONNECTION_ERRORS = (socket.error, httplib.HTTPException)
+
+
+class ConnectionPool(object):
+    """
+    Keep one (keep-alive) connection of each kind per credential set.
+
+    Every ImageManager built with the same credentials, and every thread
+    they start, share these connections. boto keeps its own thread-safe pool
+    of HTTP connections per endpoint, so a shared connection object can be
+    used by parallel transfers. A connection is only rebuilt after a
+    request fails to reach the endpoint.
+    """
+    _lock = threading.Lock()
+    _connections = {}
+
+    @classmethod
+    def get(cls, kind, credentials, factory):
+        pool_key = (kind,) + tuple(credentials)
+        with cls._lock:
+            conn = cls._connections.get(pool_key)
+            if conn is None:
+                logger.debug("Opening new %s connection to %s"
+                             % (kind, credentials[-1]))
+                conn = factory()
+                cls._connections[pool_key] = conn
+            return conn
+
+    @classmethod
+    def discard(cls, kind, credentials, conn):
+        pool_key = (kind,) + tuple(credentials)
+        with cls._lock:
+            if cls._connections.get(pool_key) is conn:
+                del cls._connections[pool_key]
+
+    @classmethod
+    @contextmanager
+    def connection(cls, kind, credentials, factory):
+        conn = cls.get(kind, credentials, factory)
+        try:
+            yield conn
+        except CONNECTION_ERRORS, conn_failed:
+            logger.warn("%s connection to %s failed (%s). It will be rebuilt"
+                        " on next use." % (kind, credentials[-1], conn_failed))
+            cls.discard(kind, credentials, conn)
+            raise
+
 
 class ImageManager(BaseDriver):
     """
     Convienence class that uses a combination of boto and euca2ools calls
     to remotely download an image form the cloud
     """
-    s3_conn = None
     euca = None
     s3_url = None
+    CACHE_TIMEOUT = 5 # minutes
+    NODE_CACHE_TIMEOUT = 1 # minutes
+    DELETE_WORKERS = 8 # concurrent S3 requests when removing a bucket
 
     @classmethod
     def _build_image_creds(self, credentials):
@@ -90,13 +149,56 @@ class ImageManager(BaseDriver):
         (key, secret, ec2_url, s3_url) = self._get_credentials(**kwargs)
         self._imaging_credentials(**kwargs)
         (key, secret, ec2_url, s3_url) = self._env_credentials(key, secret, ec2_url, s3_url)
+        self.key = key
+        self.secret = secret
+        self.ec2_url = ec2_url
         self.s3_url = s3_url
 
-        #Initialize connections
+        #Connections are opened on first use, see ConnectionPool
         if has_euca:
             self.euca = self._init_euca2ool(key, secret, ec2_url)
-        self.s3_conn = self._boto_s3_conn(key, secret, s3_url)
-        self.image_conn = self._boto_ec2_conn(key, secret, ec2_url)
+        self.clear_cache()
+
+    @property
+    def s3_conn(self):
+        return ConnectionPool.get('s3', self._s3_creds(),
+                                  self._s3_factory(*self._s3_creds()))
+
+    @property
+    def image_conn(self):
+        return ConnectionPool.get('config', self._ec2_creds(),
+                                  self._config_factory)
+
+    def _ec2_creds(self):
+        return (self.key, self.secret, self.ec2_url)
+
+    def _s3_creds(self, key=None, secret=None, s3_url=None):
+        return (key or self.key, secret or self.secret, s3_url or self.s3_url)
+
+    def _s3_factory(self, key, secret, s3_url):
+        return lambda: self._boto_s3_conn(key, secret, s3_url)
+
+    def _config_factory(self):
+        return self._boto_ec2_conn(self.key, self.secret, self.ec2_url)
+
+    def _ec2(self):
+        """
+        with self._ec2() as euca_conn:
+            #The shared EC2 connection for these credentials
+        """
+        if not has_euca:
+            raise Exception("Euca2ools missing.. Required to run this function")
+        return ConnectionPool.connection('ec2', self._ec2_creds(),
+                                         self.euca.make_connection)
+
+    def _s3(self, key=None, secret=None, s3_url=None):
+        """
+        with self._s3() as s3_conn:
+            #The shared S3 connection for these (or the default) credentials
+        """
+        creds = self._s3_creds(key, secret, s3_url)
+        return ConnectionPool.connection('s3', creds,
+                                         self._s3_factory(*creds))
 
 
     def create_image(self, instance_id, image_name, *args, **kwargs):
@@ -213,10 +315,13 @@ class ImageManager(BaseDriver):
         #  node_scp_info - Dictionary for accessing the node controller, should
         #  contain: hostname, port, username(if not root), and a private
         #  ssh_key that allows access to the box.
+        #  (Optional: compression, sparse, resume, verify -- See
+        #  transfer_remote_file)
         node_scp_info= kwargs.get('node_scp_info',{})
 
         #Returns download_location
-        return self.scp_remote_file(remote_img_path, download_location, **node_scp_info)
+        return self.transfer_remote_file(remote_img_path, download_location,
+                                         **node_scp_info)
 
     def download_image_args(self, image_id, **kwargs):
         #  download_dir - Override the default download dir
@@ -329,18 +434,18 @@ class ImageManager(BaseDriver):
         if not public:
             try:
                 #Someday this will matter. Euca doesn't respect it though..
-                euca_conn = self.euca.make_connection()
-                euca_conn.modify_image_attribute(
-                    image_id=new_image_id,
-                    attribute='launchPermission',
-                    operation='remove',
-                    groups=['all'],
-                    product_codes=None)
-                euca_conn.modify_image_attribute(
-                    image_id=new_image_id,
-                    attribute='launchPermission',
-                    operation='add',
-                    user_ids=private_user_list)
+                with self._ec2() as euca_conn:
+                    euca_conn.modify_image_attribute(
+                        image_id=new_image_id,
+                        attribute='launchPermission',
+                        operation='remove',
+                        groups=['all'],
+                        product_codes=None)
+                    euca_conn.modify_image_attribute(
+                        image_id=new_image_id,
+                        attribute='launchPermission',
+                        operation='add',
+                        user_ids=private_user_list)
             except EC2ResponseError, call_failed:
                 #Since Euca ignores this anyway, lets just continue.
                 logger.error("Private List - %s" % private_user_list)
@@ -377,7 +482,7 @@ class ImageManager(BaseDriver):
             os.rename(new_image_path,image_path)
 
         return (kernel_id, ramdisk_id, new_image_id)
-    def delete_image(self, image_id, bucket_name=None):
+    def delete_image(self, image_id, bucket_name=None, max_workers=None):
         """
         Deletes an image
         WARN: THIS IS PERMANANT! YOU HAVE BEEN WARNED!
@@ -385,16 +490,20 @@ class ImageManager(BaseDriver):
             image_id - Deregisters the image from eucalyptus
         Optional Args:
             bucket_name - If Passed, the entire image is removed from S3.
+            max_workers - Concurrent deletes (Default: DELETE_WORKERS)
+        Returns a list of (key_name, error) for every bundle part that
+        could not be removed from S3.
         """
         if image_id:
-            euca_conn = self.euca.make_connection()
-            euca_conn.deregister_image(image_id=image_id)
+            with self._ec2() as euca_conn:
+                euca_conn.deregister_image(image_id=image_id)
+            self._uncache_image(image_id)
             logger.debug("Deleted image %s" % image_id)
             if not bucket_name:
                 logger.info("NOTE: Bucket for image %s still exists."
                             % image_id)
         if bucket_name:
-            self._delete_bucket(bucket_name)
+            return self._delete_bucket(bucket_name, max_workers=max_workers)
         return []
 
     def _prepare_kvm_export(self, image_path, download_dir):
@@ -559,27 +668,40 @@ class ImageManager(BaseDriver):
         return os.path.join(prefix, owner, instance_id, disk)
 
     def get_instance_node(self, instance_id):
-        (nodes, instances) = self._build_instance_nc_map()
+        (nodes, instances) = self._get_instance_nc_map()
+        if instance_id not in nodes:
+            #The instance may be newer than our cached map
+            (nodes, instances) = self._get_instance_nc_map(force_lookup=True)
         node_controller_ip = nodes.get(instance_id)
         logger.info("Instance:%s exists on Node:%s"
                     % (instance_id,node_controller_ip))
         return node_controller_ip
 
     #Delete privates
-    def _delete_bucket(self, bucket_name):
-        try:
-            bucket = self.s3_conn.get_bucket(bucket_name)
-        except S3ResponseError:
-            logger.info("The bucket %s does not exist" % bucket_name)
-            return
-        #Multi-object delete is best, but of course Walrus S3 fails
-        #result = bucket.delete_keys([key.name for key in bucket])
-        #return result.deleted
-        for key in bucket:
-            key.delete()
-        bucket.delete()
-        logger.debug("Deleted bucket %s" % bucket_name)
-        return True
+    def _delete_bucket(self, bucket_name, max_workers=None):
+        """
+        Remove every key in the bucket, then the bucket itself.
+        Returns a list of (key_name, error) for keys that were not deleted
+        (The bucket is kept when any key remains)
+        """
+        with self._s3() as s3_conn:
+            try:
+                bucket = s3_conn.get_bucket(bucket_name)
+            except S3ResponseError:
+                logger.info("The bucket %s does not exist" % bucket_name)
+                return []
+            key_names = [key.name for key in bucket]
+            failures = _delete_keys(bucket, key_names,
+                                    max_workers or self.DELETE_WORKERS)
+            if failures:
+                logger.error("%s/%s keys could not be deleted from bucket"
+                             " %s: %s" % (len(failures), len(key_names),
+                                          bucket_name, failures))
+                return failures
+            bucket.delete()
+        logger.debug("Deleted bucket %s (%s keys)"
+                     % (bucket_name, len(key_names)))
+        return []
 
 
 
@@ -606,44 +728,45 @@ class ImageManager(BaseDriver):
                     % new_image_id)
         return new_image_id
 
+    def transfer_remote_file(self, remote_path=None, local_path=None,
+                             user='root', hostname='localhost', port=22,
+                             check_key=False, private_key=None,
+                             compression='gzip', sparse=True, resume=True,
+                             verify=True):
+        """
+        Stream the remote file over SSH (See chromogenic.remote)
+        Unlike scp_remote_file, a partial local file is resumed and a
+        complete one is verified against the remote checksum.
+        """
+        with ssh_session(user, hostname, port, check_key,
+                         private_key) as session:
+            return transfer_remote_file(
+                session.command_list(), remote_path, local_path,
+                compression=compression, sparse=sparse, resume=resume,
+                verify=verify)
+
     def scp_remote_file(self, remote_path=None, local_path=None,
                         user='root', hostname='localhost', port=22,
                         check_key=False, private_key=None):
         """
         Build up the SCP command based on arguments
         """
-        # This SSH key file may be used and will self-destruct after scp is complete
-        ssh_file_loc = '/tmp/_chromo_tmp_ssh.key'
-        try:
-            if local_path:
-                if os.path.exists(local_path):
-                    logger.info("SCP Remote file canceled. Local file <%s> exists!"
-                                % local_path)
-                    return local_path
-            scp_command_list = ['scp']
-            if not check_key:
-                scp_command_list.extend(['-o', 'stricthostkeychecking=no'])
-            if private_key:
-                #SCP the file if an SSH Key has been added!
-                with open(ssh_file_loc, 'w') as ssh_key_file:
-                    run_command(['echo', private_key], stdout=ssh_key_file)
-                #run_command(['whoami']) # - Useful when debugging ssh problems
-                # SSH keys require specific permissions
-                run_command(['chmod', '600', ssh_file_loc])
-                scp_command_list.extend(['-i', ssh_file_loc])
-            if port != 22:
-                scp_command_list.extend(['-P%s' % port])
-            scp_command_list.extend(['%s@%s:%s' % (user, hostname, remote_path)])
-            #Where should the file go
-            scp_command_list.extend([local_path])
+        if local_path:
+            if os.path.exists(local_path):
+                logger.info("SCP Remote file canceled. Local file <%s> exists!"
+                            % local_path)
+                return local_path
+        # The private key is kept in a directory owned by this job, and
+        # removed when the (shared) SSH session closes
+        with ssh_session(user, hostname, port, check_key,
+                         private_key) as session:
+            scp_command_list = session.scp_command_list(remote_path,
+                                                        local_path)
             #Print and execute
             logger.info("Downloading image: <%s>"
                         % (' '.join(map(str,scp_command_list)),))
             run_command(scp_command_list)
-            return local_path
-        finally:
-            if private_key:
-                run_command(['rm', '-rf', ssh_file_loc])
+        return local_path
 
     """
     Indirect Create Image Functions -
@@ -741,6 +864,8 @@ class ImageManager(BaseDriver):
             bundled_size, sha_image_digest, user, kernel, ramdisk, mapping,
             product_codes, ancestor_ami_ids)
         logger.debug('Manifest Generated')
+        # tarzip_image hashes the image as it reads it
+        logger.info("SHA1 of %s: %s" % (image_path, sha_image_digest))
         #Destroyed encrypted file
         os.remove(encrypted_file)
         manifest_loc =  os.path.join(destination_path, '%s.manifest.xml' %
@@ -762,28 +887,21 @@ class ImageManager(BaseDriver):
     def _upload_file_to_s3(self, bucket_name, keyname,
                            filename, s3_key, s3_secret,
                            s3_url, canned_acl='aws-exec-read'):
-        if not has_euca:
-            raise Exception("Euca2ools missing.. Required to run this function")
-        s3euca = Euca2ool(is_s3=True)
-        s3euca.ec2_user_access_key = s3_key
-        s3euca.ec2_user_secret_key = s3_secret
-        s3euca.url = s3_url
-
-        conn = s3euca.make_connection()
-        bucket_instance = _ensure_bucket(conn, bucket_name, canned_acl)
-        k = Key(bucket_instance)
-        k.key = keyname
-        with open(filename, "rb") as the_file:
-            try:
-                logger.debug("Uploading File:%s to bucket:%s // key:%s"
-                             % (filename, bucket_name, keyname))
-                k.set_contents_from_file(the_file, policy=canned_acl)
-                logger.debug("File Upload complete")
-            except S3ResponseError, s3error:
-                s3error_string = '%s' % (s3error)
-                if s3error_string.find("403") >= 0:
-                    logger.exception("Permission denied while writing : %s\n%s"
-                                % (k.key, s3error))
+        with self._s3(s3_key, s3_secret, s3_url) as conn:
+            bucket_instance = _ensure_bucket(conn, bucket_name, canned_acl)
+            k = Key(bucket_instance)
+            k.key = keyname
+            with open(filename, "rb") as the_file:
+                try:
+                    logger.debug("Uploading File:%s to bucket:%s // key:%s"
+                                 % (filename, bucket_name, keyname))
+                    k.set_contents_from_file(the_file, policy=canned_acl)
+                    logger.debug("File Upload complete")
+                except S3ResponseError, s3error:
+                    s3error_string = '%s' % (s3error)
+                    if s3error_string.find("403") >= 0:
+                        logger.exception("Permission denied while writing : %s\n%s"
+                                    % (k.key, s3error))
         return k
 
     def _upload_bundle(self, bucket_name, manifest_path, ec2cert_path=None,
@@ -807,7 +925,7 @@ class ImageManager(BaseDriver):
         """
         if not has_euca:
             raise Exception("Euca2ools missing.. Required to run this function")
-        from euca2ools import Euca2ool, FileValidationError
+        from euca2ools import FileValidationError
         logger.debug("Validating the manifest")
         try:
             self.euca.validate_file(manifest_path)
@@ -815,24 +933,19 @@ class ImageManager(BaseDriver):
             logger.error("Invalid manifest file provided. Check path")
             raise
 
-        s3euca = Euca2ool(is_s3=True)
-        s3euca.ec2_user_access_key = self.euca.ec2_user_access_key
-        s3euca.ec2_user_secret_key = self.euca.ec2_user_secret_key
-        s3euca.url = self.s3_url
-
-        conn = s3euca.make_connection()
-        bucket_instance = _ensure_bucket(conn, bucket_name, canned_acl)
-        logger.debug("S3 Bucket %s Created. Retrieving Parts from manifest"
-                     % bucket_name)
-        parts = self._get_parts(manifest_path)
-        if not directory:
-            manifest_path_parts = manifest_path.split('/')
-            directory = manifest_path.replace(
-                manifest_path_parts[len(manifest_path_parts) - 1], '')
-        if not skipmanifest and not part:
-            _upload_manifest(bucket_instance, manifest_path, canned_acl)
-        logger.debug("Uploading image in parts to S3 Bucket %s." % bucket_name)
-        _upload_parts(bucket_instance, directory, parts, part, canned_acl)
+        with self._s3() as conn:
+            bucket_instance = _ensure_bucket(conn, bucket_name, canned_acl)
+            logger.debug("S3 Bucket %s Created. Retrieving Parts from manifest"
+                         % bucket_name)
+            parts = self._get_parts(manifest_path)
+            if not directory:
+                manifest_path_parts = manifest_path.split('/')
+                directory = manifest_path.replace(
+                    manifest_path_parts[len(manifest_path_parts) - 1], '')
+            if not skipmanifest and not part:
+                _upload_manifest(bucket_instance, manifest_path, canned_acl)
+            logger.debug("Uploading image in parts to S3 Bucket %s." % bucket_name)
+            _upload_parts(bucket_instance, directory, parts, part, canned_acl)
         return "%s/%s" % \
             (bucket_name, self.euca.get_relative_filename(manifest_path))
 
@@ -840,14 +953,29 @@ class ImageManager(BaseDriver):
         try:
             logger.debug("Registering S3 manifest file:%s with image in euca"
                          % s3_manifest_path)
-            euca_conn = self.euca.make_connection()
-            image_id = euca_conn.register_image(
-                image_location=s3_manifest_path)
+            with self._ec2() as euca_conn:
+                image_id = euca_conn.register_image(
+                    image_location=s3_manifest_path)
+            #The next image-list will include the new image
+            self.image_list_time = None
             return image_id
         except Exception, ex:
             logger.error(ex)
             self.euca.display_error_and_exit('%s' % ex)
 
+    def _get_instance_nc_map(self, force_lookup=False):
+        """
+        Return the (nodes, instances) maps of _build_instance_nc_map,
+        re-using the last 'DescribeNodes' response for NODE_CACHE_TIMEOUT
+        minutes.
+        """
+        if force_lookup or self._cache_expired(self.node_map_time,
+                                               self.NODE_CACHE_TIMEOUT):
+            self.node_map = self._build_instance_nc_map()
+            self.node_map_time = datetime.now()
+            logger.info("Caching a copy of the instance/node map")
+        return self.node_map
+
     def _build_instance_nc_map(self):
         """
         Using the 'DescribeNodes' API response,
@@ -855,8 +983,10 @@ class ImageManager(BaseDriver):
             i-12341234 => 128.196.1.1
             i-12345678 => 128.196.1.2
         """
-        boto_instances = self.image_conn.get_list(
-            "DescribeNodes", {}, [('euca:item', BotoInstance)], '/')
+        with ConnectionPool.connection('config', self._ec2_creds(),
+                                       self._config_factory) as config_conn:
+            boto_instances = config_conn.get_list(
+                "DescribeNodes", {}, [('euca:item', BotoInstance)], '/')
         last_node = ''
         nodes = {}
         instances = {}
@@ -969,46 +1099,123 @@ class ImageManager(BaseDriver):
     debugging and gathering necessary info at the REPL
     """
     def list_buckets(self):
-        return self.s3_conn.get_all_buckets()
+        with self._s3() as s3_conn:
+            return s3_conn.get_all_buckets()
 
     def find_bucket(self, name):
         return [b for b in self.list_buckets()
                 if name.lower() in b.name.lower()]
 
     def get_bucket(self, bucket_name):
-        return self.s3_conn.get_bucket(bucket_name)
+        with self._s3() as s3_conn:
+            return s3_conn.get_bucket(bucket_name)
 
     def list_instances(self):
-        euca_conn = self.euca.make_connection()
-        return euca_conn.get_all_instances()
+        with self._ec2() as euca_conn:
+            return euca_conn.get_all_instances()
 
     def find_instance(self, name):
         return [m for m in self.list_instances()
                 if name.lower() in m.instances[0].id.lower()]
 
-    def get_reservation(self, instance_id):
-        for res in self.list_instances():
-            for instance in res.instances:
-                if instance_id.lower() in instance.id.lower():
-                    return (res, instance)
-        return (None, None)
-
-    def list_images(self):
-        euca_conn = self.euca.make_connection()
-        all_images = euca_conn.get_all_images()
-        return [self._to_img(img) for img in all_images]
+    def get_reservation(self, instance_id, force_lookup=False):
+        """
+        Return the (reservation, instance) pair for <instance_id>
+        Results are cached for CACHE_TIMEOUT minutes, so repeated lookups
+        during a single imaging job do not contact the cloud again.
+        """
+        cached = self.reservations.get(instance_id)
+        if cached and not force_lookup \
+                and not self._cache_expired(cached[0], self.CACHE_TIMEOUT):
+            return cached[1]
+        (res, instance) = self._lookup_reservation(instance_id)
+        if res and instance:
+            self.reservations[instance_id] = (datetime.now(), (res, instance))
+        return (res, instance)
+
+    def _lookup_reservation(self, instance_id):
+        """
+        Ask for <instance_id> directly, then fall back to a full listing
+        (Partial or mixed-case instance IDs will only match the listing)
+        """
+        try:
+            with self._ec2() as euca_conn:
+                reservations = euca_conn.get_all_instances(
+                    instance_ids=[instance_id])
+        except EC2ResponseError, bad_request:
+            logger.debug("Filtered lookup of %s failed: %s"
+                         % (instance_id, bad_request))
+            reservations = []
+        (res, instance) = _match_reservation(reservations, instance_id)
+        if res:
+            return (res, instance)
+        logger.info("Instance %s not found by ID. Searching all instances"
+                    % instance_id)
+        return _match_reservation(self.list_instances(), instance_id)
+
+    def clear_cache(self):
+        logger.info("Clearing the cached reservations, images"
+                    " and instance/node map")
+        self.reservations = {}
+        self.node_map = None
+        self.node_map_time = None
+        self.images = OrderedDict()
+        self.image_locations = {}
+        self.image_list_time = None
+
+    def _cache_expired(self, cache_time, timeout):
+        if not cache_time:
+            return True
+        return datetime.now() - cache_time > timedelta(minutes=timeout)
+
+    def list_images(self, force_lookup=False):
+        """
+        Images are post-processed (_to_img) and indexed by id and location
+        once, then served from cache for CACHE_TIMEOUT minutes.
+        """
+        if force_lookup or self._cache_expired(self.image_list_time,
+                                               self.CACHE_TIMEOUT):
+            with self._ec2() as euca_conn:
+                all_images = euca_conn.get_all_images()
+            self.images = OrderedDict()
+            self.image_locations = {}
+            now_time = datetime.now()
+            for img in all_images:
+                self._cache_image(self._to_img(img), now_time)
+            self.image_list_time = now_time
+            logger.info("Caching a copy of image-list")
+        return [img for (_, img) in self.images.values()]
 
     def find_image(self, name):
-        return [m for m in self.list_images()
+        self.list_images()
+        #Exact manifest locations are answered by the location index
+        image_id = self.image_locations.get(name)
+        if image_id:
+            return [self.images[image_id][1]]
+        return [m for (_, m) in self.images.values()
                 if name.lower() in m.location.lower()]
 
-    def get_image(self, image_id):
-        euca_conn = self.euca.make_connection()
-        image = euca_conn.get_image(image_id)
+    def get_image(self, image_id, force_lookup=False):
+        cached = self.images.get(image_id)
+        if cached and not force_lookup \
+                and not self._cache_expired(cached[0], self.CACHE_TIMEOUT):
+            return cached[1]
+        with self._ec2() as euca_conn:
+            image = euca_conn.get_image(image_id)
         #Believe it or not, this image may NOT be the one we requested.
-        if image.id != image_id:
+        if not image or image.id != image_id:
             return None
-        return self._to_img(image)
+        return self._cache_image(self._to_img(image))
+
+    def _cache_image(self, image, cache_time=None):
+        self.images[image.id] = (cache_time or datetime.now(), image)
+        self.image_locations[image.location] = image.id
+        return image
+
+    def _uncache_image(self, image_id):
+        cached = self.images.pop(image_id, None)
+        if cached:
+            self.image_locations.pop(cached[1].location, None)
 
     def _to_img(self, image):
         if not image.name:
@@ -1017,7 +1224,7 @@ class ImageManager(BaseDriver):
                 if len(manifest.split('_')) >= 5:
                     image.name = '_'.join(manifest.split('_')[2:-2])
                 else:
-                    image.name = manifest.replace('.img.manifest.xml')
+                    image.name = manifest.replace('.img.manifest.xml', '')
             except:
                 image.name = image.location
                 #Attempt to do custom parsing, but its OK if it doesnt work
@@ -1037,6 +1244,62 @@ class ImageManager(BaseDriver):
         return parts
 
 
+MULTI_DELETE_LIMIT = 1000 # keys per S3 multi-object delete request
+
+
+def _delete_keys(bucket, key_names, max_workers):
+    """
+    Delete <key_names> from <bucket> using a bounded pool of threads.
+    Multi-object delete is used when the endpoint supports it, otherwise
+    (Walrus) every key is deleted with its own request.
+    Returns a list of (key_name, error) for each key that failed.
+    """
+    if not key_names:
+        return []
+    chunks = [key_names[idx:idx + MULTI_DELETE_LIMIT]
+              for idx in range(0, len(key_names), MULTI_DELETE_LIMIT)]
+    pool = ThreadPool(max(1, min(max_workers, len(key_names))))
+    try:
+        try:
+            #The first request tells us if multi-object delete is supported
+            results = [bucket.delete_keys(chunks[0])]
+            results.extend(pool.map(bind_context(bucket.delete_keys),
+                                    chunks[1:]))
+            failures = []
+            for result in results:
+                failures.extend([(error.key, '%s: %s'
+                                  % (error.code, error.message))
+                                 for error in result.errors])
+            return failures
+        except S3ResponseError, no_multi_delete:
+            logger.info("Multi-object delete unavailable (%s). Deleting %s"
+                        " keys individually" % (no_multi_delete.status,
+                                                len(key_names)))
+        results = pool.map(bind_context(partial(_delete_key, bucket)),
+                           key_names)
+        return [failure for failure in results if failure]
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _delete_key(bucket, key_name):
+    try:
+        bucket.delete_key(key_name)
+    except S3ResponseError, s3error:
+        logger.warn("Could not delete key %s: %s" % (key_name, s3error))
+        return (key_name, '%s' % s3error)
+    return None
+
+
+def _match_reservation(reservations, instance_id):
+    for res in reservations:
+        for instance in res.instances:
+            if instance_id.lower() in instance.id.lower():
+                return (res, instance)
+    return (None, None)
+
+
 """
 These functions belong to euca-upload-bundle in euca2ools 1.3.1
 """
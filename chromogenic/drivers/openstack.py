@@ -33,8 +33,11 @@ from rtwo.drivers.common import (
 )
 
 from chromogenic.drivers.base import BaseDriver
-from chromogenic.common import run_command, wildcard_remove
+from chromogenic.common import wildcard_remove
 from chromogenic.clean import mount_and_clean
+from chromogenic.compact import compact_image, compact_requested
+from chromogenic.detect import image_info
+from chromogenic.hashing import MultiHash, hash_file_async
 from chromogenic.settings import chromo_settings
 from keystoneclient.exceptions import NotFound
 from glanceclient import exc as glance_exception
@@ -274,6 +277,8 @@ class ImageManager(BaseDriver):
                     status_hook=getattr(self, 'hook', None),
                     method_hook=getattr(self, 'clean_hook',None),
                     **kwargs)
+        if compact_requested(**kwargs):
+            compact_image(download_location)
 
         #Step 3: Upload the local copy as a 'real' image
         # with seperate kernel & ramdisk
@@ -511,10 +516,14 @@ class ImageManager(BaseDriver):
             if body == None:  # NOTE: Explicitly checking for None because the iterator returned here is 'Falsy'
                 raise Exception("Image Download Failed! Did not receive data (%s) from glance for image %s" % (body,image_id))
             body = ProgressHook(body, len(body), getattr(self, 'hook', None), 'download')
+            # Hashed as it is written, so the file is not read again
+            multi_hash = MultiHash()
             for chunk in body:
                 f.write(chunk)
+                multi_hash.update(chunk)
         if body._totalsize != body._curr_size:
             raise Exception("Image Download Failed! Current Size %s/%s" % (body._curr_size, body._totalsize))
+        self._verify_checksum(image, multi_hash.hexdigests(), download_location)
         logger.info("Download Image %s Completed: %s" % (image_id, download_location))
         return download_location
 
@@ -544,11 +553,18 @@ class ImageManager(BaseDriver):
             self.hook.on_update_status("Uploading file to image %s" % new_image.id)
         if not os.path.exists(image_path):
             raise Exception("Image Upload failed! Image path (%s) does not exist." % (image_path))
-        data_file = open(image_path, 'rb')
-        filesize = utils.get_file_size(data_file)
-        body = ProgressHook(data_file, filesize, getattr(self, 'hook', None), 'upload')
-
-        self.glance.images.upload(new_image.id, data_file)
+        # Hashed on a background thread while the upload runs
+        hasher = hash_file_async(image_path)
+        try:
+            data_file = open(image_path, 'rb')
+            filesize = utils.get_file_size(data_file)
+            body = ProgressHook(data_file, filesize, getattr(self, 'hook', None), 'upload')
+
+            self.glance.images.upload(new_image.id, data_file)
+            self._verify_checksum(self.glance.images.get(new_image.id),
+                                  hasher.result(), image_path)
+        finally:
+            hasher.wait()
         # ASSERT: New image ID now that 'the_file' has completed the upload
         logger.info("New image created: %s - %s" % (image_name, new_image.id))
         for tenant_name in private_user_list:
@@ -557,6 +573,21 @@ class ImageManager(BaseDriver):
                          % (tenant_name, new_image))
         return new_image.id
 
+    def _verify_checksum(self, image, digests, image_path):
+        """
+        Compare the md5 glance keeps for <image> to the local <digests>
+        (See chromogenic.hashing)
+        """
+        checksum = getattr(image, 'checksum', None)
+        logger.info("Digests of %s (image %s): %s"
+                    % (image_path, image.id, digests))
+        if not checksum:
+            return
+        if checksum != digests['md5']:
+            raise Exception("Checksum mismatch for image %s: glance %s,"
+                            " local %s (%s)" % (image.id, checksum,
+                                                digests['md5'], image_path))
+
     def upload_full_image(self, image_name, image_path,
                           kernel_path, ramdisk_path, is_public=True,
                           private_user_list=[]):
@@ -675,18 +706,15 @@ class ImageManager(BaseDriver):
 
     # Private methods and helpers
     def _read_file_type(self, local_image):
-        out, _ = run_command(['file', local_image])
-        logger.info("FileOutput: %s" % out)
-        if 'qemu qcow' in out.lower():
-            if 'v2' in out.lower():
-                return 'qcow2'
-            else:
-                return 'qcow'
-        elif 'Linux rev 1.0' in out.lower() and 'ext' in out.lower():
+        info = image_info(local_image)
+        logger.info("Image info: %s" % (info,))
+        if info.format != 'raw':
+            return info.format
+        elif info.filesystem:
             return 'img'
         else:
-            raise Exception("Could not guess the type of file. Output=%s"
-                            % out)
+            raise Exception("Could not guess the type of file. Info=%s"
+                            % (info,))
 
 
     def _admin_identity_creds(self, **kwargs):
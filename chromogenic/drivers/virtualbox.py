@@ -11,7 +11,6 @@ import subprocess
 import sys
 import time
 
-from hashlib import md5
 from datetime import datetime
 from urlparse import urlparse
 from xml.dom import minidom
@@ -41,6 +40,7 @@ from chromogenic.common import run_command, copy_disk, create_empty_image
 from chromogenic.common import mount_image, check_distro
 from chromogenic.clean import remove_ldap, reset_root_password
 from chromogenic.export import add_virtualbox_support
+from chromogenic.hashing import hash_file_async
 
 logger = logging.getLogger(__name__)
 
@@ -119,11 +119,16 @@ class ImageManager(BaseDriver):
             return (None, completed_path)
 
         ##Archive/Compress/Send the export to S3
-        md5sum = self._large_file_hash(completed_path)
+        # Hashed on a background thread while the archive is written
+        hasher = hash_file_async(completed_path)
+        try:
+            tarfile_name = completed_path+'.tar.gz'
+            self._tarzip_image(tarfile_name, [appliance_path])
+            md5sum = hasher.result()['md5']
+        finally:
+            hasher.wait()
         logger.info("Hash of file complete:%s == %s"
                      % (completed_path, md5sum))
-        tarfile_name = completed_path+'.tar.gz'
-        self._tarzip_image(tarfile_name, [appliance_path])
         s3_keyname = 'vbox_export_%s_%s' % (instance_id,datetime.now().strftime('%Y%m%d_%H%M%S'))
         url = self._export_to_s3(s3_keyname, tarfile_name)
         return (md5sum, url)
@@ -204,15 +209,6 @@ class ImageManager(BaseDriver):
     #    url = key.generate_url(60*60*24*7) # 7 days from now.
     #    return url
 
-    def _large_file_hash(self, file_path):
-        #TODO: Move to export.py
-        logger.debug("Calculating MD5 Hash for %s" % file_path)
-        md5_hash = md5()
-        with open(file_path,'rb') as f:
-            for chunk in iter(lambda: f.read(md5_hash.block_size * 128), b''): #b'' == Empty Byte String
-                md5_hash.update(chunk)
-        return md5_hash.hexdigest()
-
     def _tarzip_image(self, tarfile_path, file_list):
         #TODO: Move to export.py
         import tarfile
@@ -0,0 +1,457 @@
+"""
+imaging/edits.py
+
+Edit text files inside a mounted image without running 'sed' once per
+change. Edits are grouped by file, applied in memory in the order they
+were added, and each file is written once (atomically):
+
+>> batch = FileEditBatch(mounted_path)
+>> batch.remove_lines([("atmo_boot", "etc/rc.local")])
+>> batch.replace_lines([("^xvc0", "\#xvc0", "etc/inittab")])
+>> batch.append_lines([("S0:2345:respawn:/sbin/agetty ttyS0 115200",
+>>                      "etc/inittab")])
+>> batch.commit()
+['/mnt/image/etc/rc.local', '/mnt/image/etc/inittab']
+>> batch.commit(dry_run=True)  # Nothing is written
+{'/mnt/image/etc/inittab': '--- a/etc/inittab\n+++ b/etc/inittab\n...'}
+
+Patterns use the same (basic) regular expression syntax as the 'sed_*'
+helpers always have, and are translated to python regexes once
+(See sed_regex, sed_replacement).
+"""
+import difflib
+import logging
+import os
+import re
+import tempfile
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# POSIX bracket classes and their python equivalents
+POSIX_CLASSES = {
+    'alnum': 'a-zA-Z0-9', 'alpha': 'a-zA-Z', 'blank': ' \\t',
+    'digit': '0-9', 'lower': 'a-z', 'upper': 'A-Z', 'punct': '!-/:-@[-`{-~',
+    'space': ' \\t\\n\\r\\f\\v', 'xdigit': '0-9A-Fa-f',
+}
+# Escapes that mean the same thing in GNU sed and python
+SHARED_ESCAPES = 'nt.*[]^$/wWsSbB'
+
+
+def sed_regex(pattern):
+    """
+    Translate a sed (GNU basic) regular expression to a python one.
+    In a BRE '(', ')', '{', '}', '|', '+' and '?' are literal characters
+    unless they are escaped.
+    """
+    regex = []
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        if char == '\\' and index + 1 < len(pattern):
+            index += 1
+            char = pattern[index]
+            if char in '(){}|+?':
+                regex.append(char)
+            elif char.isdigit():
+                regex.append('\\' + char)
+            elif char in '<>':
+                regex.append('\\b')
+            elif char == '`':
+                regex.append('\\A')
+            elif char == "'":
+                regex.append('\\Z')
+            elif char in SHARED_ESCAPES and char != '/':
+                regex.append('\\' + char)
+            else:
+                regex.append(re.escape(char))
+        elif char == '[':
+            bracket, index = _sed_bracket(pattern, index)
+            regex.append(bracket)
+            continue
+        elif char == '*' and (not regex or regex[-1] in ('^', '(')):
+            # A leading '*' is literal
+            regex.append('\\*')
+        elif char in '(){}|+?\\':
+            regex.append(re.escape(char))
+        else:
+            regex.append(char)
+        index += 1
+    return ''.join(regex)
+
+
+def _sed_bracket(pattern, index):
+    """
+    Copy the bracket expression starting at pattern[index] ('[').
+    Returns (python bracket expression, index after the closing ']')
+    """
+    start = index
+    result = ['[']
+    index += 1
+    if index < len(pattern) and pattern[index] == '^':
+        result.append('^')
+        index += 1
+    first = True
+    while index < len(pattern):
+        char = pattern[index]
+        if char == ']' and not first:
+            result.append(']')
+            return ''.join(result), index + 1
+        if pattern.startswith('[:', index):
+            end = pattern.find(':]', index + 2)
+            name = pattern[index + 2:end] if end > 0 else None
+            if name in POSIX_CLASSES:
+                result.append(POSIX_CLASSES[name])
+                index = end + 2
+                first = False
+                continue
+        # Backslashes and ']' (when first) are literal in a bracket
+        result.append('\\' + char if char in '\\]^[' else char)
+        first = False
+        index += 1
+    # Unterminated: treat the '[' as a literal character
+    return '\\[', start + 1
+
+
+def sed_replacement(replacement):
+    """
+    Translate the replacement of a sed 's/find/replace/' to a template
+    for re.sub: '&' is the whole match, '\\1'-'\\9' are groups and any
+    other escaped character is itself.
+    """
+    template = []
+    index = 0
+    while index < len(replacement):
+        char = replacement[index]
+        if char == '&':
+            template.append('\\g<0>')
+        elif char == '\\' and index + 1 < len(replacement):
+            index += 1
+            char = replacement[index]
+            if char.isdigit():
+                template.append('\\g<%s>' % char)
+            elif char == 'n':
+                template.append('\n')
+            elif char == 't':
+                template.append('\t')
+            elif char == '\\':
+                template.append('\\\\')
+            else:
+                template.append(char)
+        elif char == '\\':
+            template.append('\\\\')
+        else:
+            template.append(char)
+        index += 1
+    return ''.join(template)
+
+
+class _LineEdit(object):
+    """
+    Edits that look at one line at a time. Consecutive line edits are
+    applied together, in a single pass over the file.
+    Edits hold no state of their own, so one (compiled) edit can be
+    shared by any number of files and threads.
+    """
+    streaming = True
+
+    def editor(self):
+        """
+        Return a function for one pass over a file, that takes a line
+        (without its line ending) and returns the new line, or None to
+        delete it
+        """
+        return self.edit
+
+    def edit(self, line):
+        raise NotImplementedError()
+
+
+class DeleteLines(_LineEdit):
+    # sed -i '/<pattern>/d'
+    def __init__(self, pattern):
+        self.regex = re.compile(sed_regex(pattern))
+
+    def edit(self, line):
+        if self.regex.search(line):
+            return None
+        return line
+
+
+class ReplaceInLine(_LineEdit):
+    # sed -i 's/<pattern>/<replacement>/'
+    def __init__(self, pattern, replacement):
+        self.regex = re.compile(sed_regex(pattern))
+        self.template = sed_replacement(replacement)
+
+    def edit(self, line):
+        return self.regex.sub(self.template, line, count=1)
+
+
+class DeleteRange(_LineEdit):
+    # sed -i '/<start>/,/<end>/d'
+    def __init__(self, start_pattern, end_pattern):
+        self.start_regex = re.compile(sed_regex(start_pattern))
+        self.end_regex = re.compile(sed_regex(end_pattern))
+
+    def editor(self):
+        in_range = [False]
+
+        def edit(line):
+            if in_range[0]:
+                if self.end_regex.search(line):
+                    in_range[0] = False
+                return None
+            if self.start_regex.search(line):
+                in_range[0] = True
+                return None
+            return line
+        return edit
+
+
+class _FileEdit(object):
+    # Edits that need the whole file
+    streaming = False
+
+    def apply(self, lines):
+        raise NotImplementedError()
+
+
+class AppendLine(_FileEdit):
+    # Add <text> as the last line, unless the file already has that line
+    def __init__(self, text):
+        self.text = text
+
+    def apply(self, lines):
+        if _has_line(lines, self.text):
+            return lines
+        return lines + [self.text]
+
+
+class PrependLine(_FileEdit):
+    # Add <text> as the first line, unless the file already has that line
+    def __init__(self, text):
+        self.text = text
+
+    def apply(self, lines):
+        if _has_line(lines, self.text):
+            return lines
+        return [self.text] + lines
+
+
+def _has_line(lines, text):
+    needle = text.strip()
+    return any(line.strip() == needle for line in lines)
+
+
+def apply_edits(content, edits):
+    """
+    Apply <edits> (in order) to the text <content> and return the new text
+    """
+    ends_with_newline = content.endswith('\n')
+    lines = content.split('\n')
+    if ends_with_newline:
+        lines.pop()
+    index = 0
+    while index < len(edits):
+        if not edits[index].streaming:
+            lines = edits[index].apply(lines)
+            index += 1
+            continue
+        stream = []
+        while index < len(edits) and edits[index].streaming:
+            stream.append(edits[index])
+            index += 1
+        lines = _stream_lines(lines, stream)
+    if not lines:
+        return ''
+    # Appended lines always end with a newline, like 'sed $ a'
+    if not ends_with_newline:
+        ends_with_newline = any(isinstance(edit, AppendLine)
+                                for edit in edits)
+    return '\n'.join(lines) + ('\n' if ends_with_newline else '')
+
+
+def _stream_lines(lines, edits):
+    editors = [edit.editor() for edit in edits]
+    result = []
+    for line in lines:
+        for edit in editors:
+            line = edit(line)
+            if line is None:
+                break
+        if line is not None:
+            result.append(line)
+    return result
+
+
+class FileEditBatch(object):
+    """
+    Collect edits for files below <mount_point> and apply them with commit()
+    """
+
+    def __init__(self, mount_point=''):
+        self.mount_point = mount_point
+        self.edits = OrderedDict()  # path -> [edit, ...]
+
+    def _path(self, filepath):
+        if filepath.startswith('/') and self.mount_point:
+            filepath = filepath[1:]
+        return os.path.join(self.mount_point, filepath)
+
+    def add(self, filepath, edit):
+        self.edits.setdefault(self._path(filepath), []).append(edit)
+        return self
+
+    # These accept the same lists as the *_in_files helpers in common.py
+    def append_lines(self, append_files):
+        for (append_line, append_to) in append_files or []:
+            self.add(append_to, AppendLine(append_line))
+        return self
+
+    def prepend_lines(self, prepend_files):
+        for (prepend_line, prepend_to) in prepend_files or []:
+            self.add(prepend_to, PrependLine(prepend_line))
+        return self
+
+    def remove_lines(self, remove_line_files):
+        for (remove_line_w_str, remove_from) in remove_line_files or []:
+            self.add(remove_from, DeleteLines(remove_line_w_str))
+        return self
+
+    def replace_lines(self, replace_line_files):
+        for (replace_str, replace_with, replace_where) in \
+                replace_line_files or []:
+            self.add(replace_where, ReplaceInLine(replace_str, replace_with))
+        return self
+
+    def remove_multilines(self, multiline_delete_files):
+        for (delete_from, delete_to, delete_where) in \
+                multiline_delete_files or []:
+            self.add(delete_where, DeleteRange(delete_from, delete_to))
+        return self
+
+    def commit(self, dry_run=False):
+        """
+        Apply every pending edit. Files that do not exist are skipped.
+        Returns the list of files that changed or, if <dry_run>,
+        a dict of file -> unified diff (nothing is written).
+        """
+        changed = []
+        diffs = OrderedDict()
+        for filepath, edits in self.edits.items():
+            if not os.path.isfile(filepath):
+                logger.warn("File not found: %s Cannot edit lines" % filepath)
+                continue
+            with open(filepath) as the_file:
+                content = the_file.read()
+            new_content = apply_edits(content, edits)
+            if new_content == content:
+                continue
+            if dry_run:
+                name = os.path.relpath(filepath, self.mount_point or '/')
+                diffs[filepath] = ''.join(difflib.unified_diff(
+                    content.splitlines(True), new_content.splitlines(True),
+                    'a/%s' % name, 'b/%s' % name))
+                continue
+            atomic_write(filepath, new_content)
+            changed.append(filepath)
+            logger.info("Applied %s edit(s) to %s" % (len(edits), filepath))
+        if dry_run:
+            return diffs
+        self.edits.clear()
+        return changed
+
+
+def atomic_write(filepath, content):
+    """
+    Replace <filepath> with <content> by renaming a temporary file over it.
+    Mode and ownership are kept. (Like 'sed -i', a symlink is replaced
+    rather than followed, so absolute links can't escape the image)
+    """
+    stat = os.lstat(filepath)
+    fd, tmp_path = tempfile.mkstemp(
+        prefix='.%s.' % os.path.basename(filepath),
+        dir=os.path.dirname(filepath))
+    try:
+        with os.fdopen(fd, 'w') as tmp_file:
+            tmp_file.write(content)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        if not os.path.islink(filepath):
+            os.chmod(tmp_path, stat.st_mode & 0o7777)
+            os.chown(tmp_path, stat.st_uid, stat.st_gid)
+        os.rename(tmp_path, filepath)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class EditSpec(object):
+    """
+    A declared set of guest file edits, validated and compiled when it is
+    defined, so every image it is applied to shares the compiled form:
+
+    >> class Xen2KVM(MigrationPlan):
+    >>     rhel_edits = EditSpec(
+    >>         append=[("S0:2345:respawn:/sbin/agetty ttyS0 115200",
+    >>                  "etc/inittab")],
+    >>         remove_lines=[("atmo_boot", "etc/rc.local")])
+
+    The lists take the same tuples as the *_in_files helpers.
+    apply() edits every file once, in this order: append, prepend,
+    remove_lines, replace_lines, remove_multiline. remove_files and
+    create_files are declared here too, but are the caller's to apply
+    (See chromogenic.drivers.migration.MigrationPlan.apply_edits)
+    """
+    FIELDS = (
+        # (name, tuple length, builder)
+        ('append', 2, lambda text, path: (path, AppendLine(text))),
+        ('prepend', 2, lambda text, path: (path, PrependLine(text))),
+        ('remove_lines', 2,
+         lambda pattern, path: (path, DeleteLines(pattern))),
+        ('replace_lines', 3,
+         lambda pattern, replace, path: (path,
+                                         ReplaceInLine(pattern, replace))),
+        ('remove_multiline', 3,
+         lambda start, end, path: (path, DeleteRange(start, end))),
+    )
+
+    def __init__(self, append=(), prepend=(), remove_lines=(),
+                 replace_lines=(), remove_multiline=(), remove_files=(),
+                 create_files=()):
+        self.remove_files = tuple(remove_files)
+        self.create_files = tuple(create_files)
+        for create in self.create_files:
+            if len(create) != 2:
+                raise ValueError("create_files expects (path, text): %s"
+                                 % (create,))
+        declared = {
+            'append': append, 'prepend': prepend,
+            'remove_lines': remove_lines, 'replace_lines': replace_lines,
+            'remove_multiline': remove_multiline,
+        }
+        self.edits = OrderedDict()  # path -> (edit, ...)
+        for name, length, build in self.FIELDS:
+            for entry in declared[name]:
+                if len(entry) != length:
+                    raise ValueError("%s expects %s-tuples: %s"
+                                     % (name, length, entry))
+                try:
+                    path, edit = build(*entry)
+                except re.error as bad_pattern:
+                    raise ValueError("Invalid pattern in %s %s: %s"
+                                     % (name, entry, bad_pattern))
+                self.edits[path] = self.edits.get(path, ()) + (edit,)
+
+    def apply(self, mount_point, dry_run=False):
+        """
+        Apply the edits to the image mounted at <mount_point>
+        (See FileEditBatch.commit for the return value)
+        """
+        batch = FileEditBatch(mount_point)
+        for path, edits in self.edits.items():
+            for edit in edits:
+                batch.add(path, edit)
+        return batch.commit(dry_run=dry_run)
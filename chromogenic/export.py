@@ -1,7 +1,7 @@
 import os
 
 #from chromogenic.clean import remove_ldap, remove_vnc, remove_sensu
-from chromogenic.common import prepare_chroot_env, remove_chroot_env,\
+from chromogenic.common import chroot_env,\
                                    run_command,\
                                    rebuild_ramdisk,\
                                    append_line_in_files,\
@@ -55,16 +55,18 @@ def add_virtualbox_support(mounted_path, image_path):
     #remove_vnc(mounted_path)
     #remove_sensu(mounted_path)
 
-    add_gnome_support(mounted_path)
+    # One chroot environment is shared by every step below
+    with chroot_env(mounted_path):
+        add_gnome_support(mounted_path)
 
-    #Touch to create a new module file
-    new_mod_file = os.path.join(mounted_path, 'etc/modprobe.d/virtualbox')
-    open(new_mod_file,'a').close()
+        #Touch to create a new module file
+        new_mod_file = os.path.join(mounted_path, 'etc/modprobe.d/virtualbox')
+        open(new_mod_file,'a').close()
 
-    add_eth0_module(mounted_path)
-    add_intel_soundcard(mounted_path)
+        add_eth0_module(mounted_path)
+        add_intel_soundcard(mounted_path)
 
-    rebuild_ramdisk(mounted_path)
+        rebuild_ramdisk(mounted_path)
 
 
 def add_gnome_support(mounted_path):
@@ -72,14 +74,13 @@ def add_gnome_support(mounted_path):
     RHEL only at this point.
     TODO: Add ubuntu, then add deterine_distro code
     """
-    prepare_chroot_env(mounted_path)
-    run_command([
-        "/usr/sbin/chroot", mounted_path, "/bin/bash", "-c", "yum groupinstall"
-        " -y \"X Window System\" \"GNOME Desktop Environment\""])
-    #Selinux was enabled in the process. lets fix that:
-    selinux_conf = os.path.join(mounted_path, 'etc/sysconfig/selinux')
-    sed_replace("SELINUX=enforcing", "SELINUX=disabled", selinux_conf)
-    remove_chroot_env(mounted_path)
+    with chroot_env(mounted_path):
+        run_command([
+            "/usr/sbin/chroot", mounted_path, "/bin/bash", "-c", "yum groupinstall"
+            " -y \"X Window System\" \"GNOME Desktop Environment\""])
+        #Selinux was enabled in the process. lets fix that:
+        selinux_conf = os.path.join(mounted_path, 'etc/sysconfig/selinux')
+        sed_replace("SELINUX=enforcing", "SELINUX=disabled", selinux_conf)
 
     #Make it the default on boot
     replace_line_file_list = [
@@ -112,21 +113,15 @@ def add_intel_soundcard(mounted_path):
     append_line_in_files(append_line_list, mounted_path)
 
 def remove_sensu(mounted_path):
-    try:
-        prepare_chroot_env(mounted_path)
+    with chroot_env(mounted_path):
         run_command(["/usr/sbin/chroot", mounted_path, 'yum',
                      'remove', '-qy', 'sensu'])
-    finally:
-        remove_chroot_env(mounted_path)
 
 def remove_vnc(mounted_path):
-    try:
-        prepare_chroot_env(mounted_path)
+    with chroot_env(mounted_path):
         run_command(["/usr/sbin/chroot", mounted_path, 'yum',
             'remove', '-qy', 'realvnc-vnc-server'])
         #remove rpmsave.. to get rid of vnc for good.
         #["/usr/sbin/chroot", mounted_path, 'find', '/',
         #'-type', 'f', '-name', '*.rpmsave', '-exec', 'rm', '-f',
         #'{}', ';']
-    finally:
-        remove_chroot_env(mounted_path)
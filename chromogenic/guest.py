@@ -0,0 +1,206 @@
+"""
+imaging/guest.py
+
+Parse 'virt-inspector' output, and remember it for as long as the image
+is unchanged (See chromogenic.common.inspect_image, which runs it):
+
+>> guest = parse_inspection(xml)
+>> guest.distro, guest.major_version
+('centos', 6)
+>> guest.has_package('cloud-init')
+True
+>> guest.kernels
+('2.6.32-279.el6.x86_64',)
+
+Results are cached by image path, and are only used while the image has
+the same size, mtime and inode. Stages that change the guest must call
+invalidate(image_path).
+
+While an image is mounted (See register_mount), the result is also
+found by its mount point. Mounting writes to the image, so the entry is
+checked against the image once, when it is mounted, and then kept until
+the image is unmounted or invalidated.
+"""
+import glob
+import logging
+import os
+import threading
+from collections import namedtuple
+from xml.etree import ElementTree
+
+logger = logging.getLogger(__name__)
+
+Package = namedtuple('Package', ['name', 'epoch', 'version', 'release',
+                                 'arch'])
+
+# Package names that install a kernel (rpm: version-release[flavor].arch,
+# deb: the version is part of the name)
+RPM_KERNELS = {'kernel': '', 'kernel-xen': 'xen', 'kernel-PAE': 'PAE',
+               'kernel-uek': ''}
+DEB_KERNEL_PREFIX = 'linux-image-'
+
+_GUEST_FIELDS = [
+    'root',  # The root device, as named by libguestfs
+    'name',  # 'linux' or 'windows'
+    'distro',  # ex: 'centos', 'ubuntu', 'rhel'
+    'product_name',
+    'major_version',
+    'minor_version',
+    'arch',
+    'hostname',
+    'package_format',  # 'rpm' or 'deb'
+    'mountpoints',  # ((mount path, device), ...)
+    'packages',  # (Package, ...)
+]
+
+
+class GuestInfo(namedtuple('GuestInfo', _GUEST_FIELDS)):
+    __slots__ = ()
+
+    @property
+    def package_names(self):
+        return frozenset(package.name for package in self.packages)
+
+    def has_package(self, name):
+        return any(package.name == name for package in self.packages)
+
+    @property
+    def kernels(self):
+        """
+        Installed kernel versions, oldest first. rpm kernels carry their
+        arch, ex: ('2.6.18-308.el5xen.i686', '2.6.32-279.el6.x86_64'):
+        el6 and later name /boot files with it, el5 without it.
+        """
+        kernels = []
+        for package in self.packages:
+            if package.name in RPM_KERNELS:
+                version = '%s-%s%s' % (package.version, package.release,
+                                       RPM_KERNELS[package.name])
+                if package.arch and package.arch not in ('noarch', '(none)'):
+                    version = '%s.%s' % (version, package.arch)
+                kernels.append(version)
+            elif package.name.startswith(DEB_KERNEL_PREFIX) \
+                    and package.name[len(DEB_KERNEL_PREFIX):][:1].isdigit():
+                kernels.append(package.name[len(DEB_KERNEL_PREFIX):])
+        return tuple(sorted(kernels, key=_version_key))
+
+
+_cache = {}  # realpath -> (image_key, GuestInfo)
+_mounts = {}  # realpath of the mount point -> realpath of the image
+_lock = threading.Lock()
+
+
+def parse_inspection(xml):
+    """
+    Return a GuestInfo for the first operating system in the XML written
+    by 'virt-inspector'
+    """
+    document = ElementTree.fromstring(xml)
+    system = document.find('operatingsystem')
+    if system is None:
+        raise Exception("virt-inspector did not find an operating system")
+    packages = tuple(
+        Package(app.findtext('name'), app.findtext('epoch'),
+                app.findtext('version'), app.findtext('release'),
+                app.findtext('arch'))
+        for app in system.findall('applications/application'))
+    mountpoints = tuple(
+        (mountpoint.text, mountpoint.get('dev'))
+        for mountpoint in system.findall('mountpoints/mountpoint'))
+    return GuestInfo(
+        system.findtext('root'), system.findtext('name'),
+        system.findtext('distro'), system.findtext('product_name'),
+        _int(system.findtext('major_version')),
+        _int(system.findtext('minor_version')),
+        system.findtext('arch'), system.findtext('hostname'),
+        system.findtext('package_format'), mountpoints, packages)
+
+
+def image_key(image_path):
+    stat = os.stat(image_path)
+    return (stat.st_size, stat.st_mtime, stat.st_ino)
+
+
+def lookup(image_path):
+    """
+    The cached GuestInfo for <image_path>, if the image has not changed
+    """
+    path = os.path.realpath(image_path)
+    with _lock:
+        entry = _cache.get(path)
+    if not entry:
+        return None
+    try:
+        if entry[0] == image_key(path):
+            return entry[1]
+    except OSError:
+        pass
+    invalidate(path)
+    return None
+
+
+def remember(image_path, key, guest):
+    """
+    Cache <guest> for <image_path>. <key> is the image_key taken before
+    the image was inspected.
+    """
+    with _lock:
+        _cache[os.path.realpath(image_path)] = (key, guest)
+
+
+def invalidate(image_path):
+    path = os.path.realpath(image_path)
+    with _lock:
+        if _cache.pop(path, None):
+            logger.debug("Guest inspection of %s invalidated" % path)
+
+
+def register_mount(mount_point, image_path):
+    """
+    <image_path> is now mounted at <mount_point>. Call before mounting.
+    """
+    lookup(image_path)  # Drop the entry if the image has changed
+    with _lock:
+        _mounts[os.path.realpath(mount_point)] = os.path.realpath(image_path)
+
+
+def unregister_mount(mount_point):
+    with _lock:
+        _mounts.pop(os.path.realpath(mount_point), None)
+
+
+def for_mount(mount_point):
+    """
+    The cached GuestInfo for the image mounted at <mount_point>, or None
+    """
+    with _lock:
+        image_path = _mounts.get(os.path.realpath(mount_point))
+        entry = _cache.get(image_path) if image_path else None
+    return entry[1] if entry else None
+
+
+def read_release_files(root_dir=''):
+    """
+    The contents of every <root_dir>/etc/*release* file
+    """
+    contents = []
+    for release_path in sorted(glob.glob(os.path.join(root_dir,
+                                                      'etc/*release*'))):
+        try:
+            with open(release_path) as release_file:
+                contents.append(release_file.read())
+        except IOError:
+            continue
+    return ''.join(contents)
+
+
+def _int(text):
+    try:
+        return int(text)
+    except (TypeError, ValueError):
+        return None
+
+
+def _version_key(version):
+    return [(0, int(part)) if part.isdigit() else (1, part)
+            for part in version.replace('-', '.').split('.')]
@@ -0,0 +1,171 @@
+"""
+imaging/hashing.py
+
+Compute several digests of a file in one pass:
+
+>> hash_file('/tmp/image.raw')
+{'md5': '9e10...', 'sha1': '5c1b...', 'sha256': '0a4f...'}
+
+Holes (found with SEEK_DATA/SEEK_HOLE, See chromogenic.blockcopy) are
+not read: zeros are fed to the digests from memory instead. A digest of
+a whole file has to see every byte, but the digest of a single block
+that is a hole is taken from ZERO_DIGESTS:
+
+>> block_digest('/tmp/image.raw', 1024 * 1024, 1024 * 1024, 'md5')
+'b6d81b360a5672d80c27430f39153e2c'
+
+Hashing can run on a background thread, while other I/O goes on:
+
+>> hasher = hash_file_async('/tmp/image.raw', ('md5',))
+>> try:
+>>     upload('/tmp/image.raw')
+>>     hasher.result()['md5']
+>> finally:
+>>     hasher.wait()  # Never leave the thread reading a removed file
+
+Data read from elsewhere (ex: a download) is hashed as it is written
+with MultiHash.
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from chromogenic.blockcopy import data_extents
+from chromogenic.metrics import bind_context
+
+logger = logging.getLogger(__name__)
+
+ALGORITHMS = ('md5', 'sha1', 'sha256')
+CHUNK_SIZE = 1024 * 1024
+ZERO_CHUNK = '\0' * CHUNK_SIZE
+# Digests of one CHUNK_SIZE block of zeros
+ZERO_DIGESTS = dict((name, hashlib.new(name, ZERO_CHUNK).hexdigest())
+                    for name in ALGORITHMS)
+
+
+class MultiHash(object):
+    """
+    Update several hashlib digests at once
+    """
+
+    def __init__(self, algorithms=ALGORITHMS):
+        self.hashes = [(name, hashlib.new(name)) for name in algorithms]
+        self.size = 0
+
+    def update(self, data):
+        for _, digest in self.hashes:
+            digest.update(data)
+        self.size += len(data)
+
+    def update_zeros(self, length):
+        """
+        Hash <length> zero bytes, without reading them
+        """
+        while length > 0:
+            count = min(length, CHUNK_SIZE)
+            self.update(buffer(ZERO_CHUNK, 0, count))
+            length -= count
+
+    def hexdigests(self):
+        return dict((name, digest.hexdigest())
+                    for name, digest in self.hashes)
+
+
+def hash_file(path, algorithms=ALGORITHMS):
+    """
+    Return {algorithm: hex digest} for the file at <path>
+    """
+    start = time.time()
+    multi_hash = MultiHash(algorithms)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        position = 0
+        for data_start, data_end in data_extents(fd, 0, size):
+            multi_hash.update_zeros(data_start - position)
+            os.lseek(fd, data_start, os.SEEK_SET)
+            remaining = data_end - data_start
+            while remaining > 0:
+                data = os.read(fd, min(CHUNK_SIZE, remaining))
+                if not data:
+                    break
+                multi_hash.update(data)
+                remaining -= len(data)
+            position = data_end
+        multi_hash.update_zeros(size - position)
+    finally:
+        os.close(fd)
+    digests = multi_hash.hexdigests()
+    logger.info("Hashed %s (%s bytes) in %.2fs: %s"
+                % (path, size, time.time() - start,
+                   ', '.join('%s %s' % item for item in sorted(
+                       digests.items()))))
+    return digests
+
+
+def block_digest(path, offset, length=CHUNK_SIZE, algorithm='md5'):
+    """
+    The <algorithm> hex digest of <length> bytes at <offset> of <path>
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if length == CHUNK_SIZE and algorithm in ZERO_DIGESTS \
+                and not list(data_extents(fd, offset, offset + length)):
+            return ZERO_DIGESTS[algorithm]
+        os.lseek(fd, offset, os.SEEK_SET)
+        return hashlib.new(algorithm, os.read(fd, length)).hexdigest()
+    finally:
+        os.close(fd)
+
+
+class FileHasher(object):
+    """
+    hash_file on a background thread (See hash_file_async)
+    """
+
+    def __init__(self, path, algorithms=ALGORITHMS):
+        self.path = path
+        self.algorithms = algorithms
+        self._digests = None
+        self._error = None
+        # Tagged with the job that started the hashing
+        self._thread = threading.Thread(target=bind_context(self._run))
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        try:
+            self._digests = hash_file(self.path, self.algorithms)
+        except Exception as hash_error:
+            logger.exception("Could not hash %s" % self.path)
+            self._error = hash_error
+
+    def wait(self):
+        """
+        Wait for the hashing thread to finish. Never raises.
+        """
+        self._thread.join()
+
+    def result(self, timeout=None):
+        """
+        Wait for the digests. Raises the error of the hashing thread.
+        """
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            raise Exception("Hashing %s did not finish within %ss"
+                            % (self.path, timeout))
+        if self._error:
+            raise self._error
+        return self._digests
+
+
+def hash_file_async(path, algorithms=ALGORITHMS):
+    """
+    Start hashing <path> on a background thread, and return its FileHasher
+    """
+    return FileHasher(path, algorithms).start()
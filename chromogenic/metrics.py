@@ -0,0 +1,310 @@
+"""
+imaging/metrics.py
+
+Resource usage of every external command run by chromogenic
+(See chromogenic.common.run_command), tagged with the job and stage that
+ran it:
+
+>> with job_context('migrate_instance_task-1c2f'):
+>>     with stage('clean'):
+>>         run_command(['fsck', '-y', '/dev/nbd1p1'])
+>> summary('migrate_instance_task-1c2f')
+{'clean': {'fsck': {'count': 1, 'wall_time': 12.4, 'user_time': 3.1, ...}}}
+>> dump_json('/tmp/imaging_metrics.json')
+
+The fsck decision taken for each image (See chromogenic.common.fsck_device)
+is recorded too, with an estimate of the time it saved:
+
+>> record_fsck('/tmp/image.raw', 'ext4', 'skip', 'cleanly unmounted', 0.01)
+>> fsck_records()[-1].saved_time
+41.2
+
+CPU time, peak RSS and block I/O come from the rusage returned by wait4,
+and cover the command and every child it waited for. read_bytes and
+write_bytes are the storage I/O counters of /proc/<pid>/io (rusage reports
+them in 512 byte blocks). Only the last MAX_RECORDS records are kept.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import namedtuple, deque, OrderedDict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+MAX_RECORDS = 10000
+BLOCK_SIZE = 512  # rusage ru_inblock/ru_oublock units
+
+CommandRecord = namedtuple('CommandRecord', [
+    'job',
+    'stage',
+    'tool',  # The program run, ex: 'qemu-img'
+    'command',
+    'started',  # time.time() when the command was started
+    'returncode',
+    'timed_out',
+    'wall_time',  # seconds
+    'user_time',  # seconds of CPU, including children
+    'sys_time',
+    'max_rss',  # bytes
+    'read_bytes',
+    'write_bytes',
+])
+
+FsckRecord = namedtuple('FsckRecord', [
+    'job',
+    'stage',
+    'image',
+    'filesystem',
+    'action',  # 'skip', 'replay' or 'full'
+    'reason',
+    'started',
+    'wall_time',  # seconds, including the superblock read
+    # Mean wall_time of the full checks recorded for this filesystem type,
+    # less wall_time. None until a full check has been recorded.
+    'saved_time',
+])
+
+CompactRecord = namedtuple('CompactRecord', [
+    'job',
+    'stage',
+    'image',
+    'filesystem',
+    'virtual_before',  # bytes, as seen by the guest
+    'virtual_after',
+    'allocated_before',  # bytes, as stored on the host
+    'allocated_after',
+    'wall_time',
+])
+
+CreatedImageRecord = namedtuple('CreatedImageRecord', [
+    'job',
+    'stage',
+    'image',
+    'filesystem',
+    'size',  # bytes, as seen by the guest
+    'allocated',  # bytes, as stored on the host
+    'wall_time',
+])
+
+TOTALS = ('wall_time', 'user_time', 'sys_time', 'read_bytes', 'write_bytes')
+
+_records = deque(maxlen=MAX_RECORDS)
+_fsck_records = deque(maxlen=MAX_RECORDS)
+_compact_records = deque(maxlen=MAX_RECORDS)
+_created_records = deque(maxlen=MAX_RECORDS)
+_records_lock = threading.Lock()
+_context = threading.local()
+
+
+@contextmanager
+def job_context(job, stage_name=None):
+    """
+    Tag every command run by this thread with <job> (and <stage_name>)
+    """
+    previous = current_tags()
+    _context.job, _context.stage = job, stage_name
+    try:
+        yield
+    finally:
+        _context.job, _context.stage = previous
+
+
+@contextmanager
+def stage(stage_name):
+    """
+    Tag every command run by this thread with <stage_name>, in the current job
+    """
+    with job_context(current_tags()[0], stage_name):
+        yield
+
+
+def current_tags():
+    return (getattr(_context, 'job', None), getattr(_context, 'stage', None))
+
+
+def bind_context(function):
+    """
+    Wrap <function> so it runs with the job and stage of the calling
+    thread. Threads do not inherit them: wrap the targets of worker
+    threads and pools.
+    """
+    job, stage_name = current_tags()
+
+    def bound(*args, **kwargs):
+        with job_context(job, stage_name):
+            return function(*args, **kwargs)
+    return bound
+
+
+def tool_name(command_list):
+    if isinstance(command_list, basestring):
+        command_list = command_list.split()
+    if not command_list:
+        return None
+    return os.path.basename(command_list[0])
+
+
+def record_command(result, command_list=None):
+    """
+    Record a chromogenic.command.CommandResult
+    """
+    rusage = getattr(result, 'rusage', None)
+    job, stage_name = current_tags()
+    record = CommandRecord(
+        job, stage_name, tool_name(command_list or result.command),
+        result.command, time.time() - result.duration, result.returncode,
+        result.timed_out, result.duration,
+        rusage.ru_utime if rusage else None,
+        rusage.ru_stime if rusage else None,
+        # Linux reports ru_maxrss in kilobytes
+        rusage.ru_maxrss * 1024 if rusage else None,
+        rusage.ru_inblock * BLOCK_SIZE if rusage else None,
+        rusage.ru_oublock * BLOCK_SIZE if rusage else None)
+    with _records_lock:
+        _records.append(record)
+    return record
+
+
+def record_fsck(image, filesystem, action, reason, wall_time):
+    """
+    Record the fsck decision taken for <image>
+    """
+    job, stage_name = current_tags()
+    with _records_lock:
+        full_times = [record.wall_time for record in _fsck_records
+                      if record.action == 'full'
+                      and record.filesystem == filesystem]
+        saved_time = None
+        if action != 'full' and full_times:
+            saved_time = max(
+                0.0, sum(full_times) / len(full_times) - wall_time)
+        record = FsckRecord(job, stage_name, image, filesystem, action,
+                            reason, time.time() - wall_time, wall_time,
+                            saved_time)
+        _fsck_records.append(record)
+    logger.info("fsck %s (%s) on %s: %s%s"
+                % (action, filesystem, image, reason,
+                   ", saved ~%.2fs" % saved_time if saved_time else ''))
+    return record
+
+
+def record_compaction(image, filesystem, before, after, wall_time):
+    """
+    Record the (virtual, allocated) sizes of <image> <before> and <after>
+    it was compacted (See chromogenic.compact)
+    """
+    job, stage_name = current_tags()
+    record = CompactRecord(job, stage_name, image, filesystem,
+                           before[0], after[0], before[1], after[1],
+                           wall_time)
+    with _records_lock:
+        _compact_records.append(record)
+    return record
+
+
+def compact_records(job=None):
+    with _records_lock:
+        return [record for record in _compact_records
+                if job is None or record.job == job]
+
+
+def record_created_image(image, filesystem, size, allocated, wall_time):
+    """
+    Record an empty image made by chromogenic.common.create_empty_image
+    """
+    job, stage_name = current_tags()
+    record = CreatedImageRecord(job, stage_name, image, filesystem, size,
+                                allocated, wall_time)
+    with _records_lock:
+        _created_records.append(record)
+    logger.info("Created %s (%s, %s bytes): %s bytes allocated in %.2fs"
+                % (image, filesystem, size, allocated, wall_time))
+    return record
+
+
+def created_image_records(job=None):
+    with _records_lock:
+        return [record for record in _created_records
+                if job is None or record.job == job]
+
+
+def fsck_records(job=None):
+    with _records_lock:
+        return [record for record in _fsck_records
+                if job is None or record.job == job]
+
+
+def records(job=None):
+    with _records_lock:
+        return [record for record in _records
+                if job is None or record.job == job]
+
+
+def clear(job=None):
+    """
+    Forget the records of <job>, or every record
+    """
+    with _records_lock:
+        for registry in (_records, _fsck_records, _compact_records,
+                         _created_records):
+            kept = [record for record in registry
+                    if job is not None and record.job != job]
+            registry.clear()
+            registry.extend(kept)
+
+
+def summary(job=None):
+    """
+    Totals per stage, then per tool: {stage: {tool: {'count': ..., ...}}}
+    max_rss is the largest of the commands, the rest are sums.
+    """
+    stages = OrderedDict()
+    for record in records(job):
+        totals = stages.setdefault(record.stage, OrderedDict()).setdefault(
+            record.tool, OrderedDict([('count', 0), ('max_rss', 0)]
+                                     + [(name, 0) for name in TOTALS]))
+        totals['count'] += 1
+        totals['max_rss'] = max(totals['max_rss'], record.max_rss or 0)
+        for name in TOTALS:
+            totals[name] += getattr(record, name) or 0
+    return stages
+
+
+def log_summary(job):
+    for stage_name, tools in summary(job).items():
+        for tool, totals in sorted(tools.items(),
+                                   key=lambda item: -item[1]['wall_time']):
+            logger.info(
+                "%s [%s] %s: %s runs, %.2fs wall, %.2fs user, %.2fs sys,"
+                " %s max RSS, %s read, %s written"
+                % (job, stage_name, tool, totals['count'],
+                   totals['wall_time'], totals['user_time'],
+                   totals['sys_time'], totals['max_rss'],
+                   totals['read_bytes'], totals['write_bytes']))
+    saved = [record.saved_time for record in fsck_records(job)
+             if record.saved_time]
+    if saved:
+        logger.info("%s: fsck fast path saved ~%.2fs over %s images"
+                    % (job, sum(saved), len(saved)))
+
+
+def dump_json(path=None, job=None):
+    """
+    Return the records (and summary) as JSON, and write them to <path>
+    if given
+    """
+    data = json.dumps({
+        'records': [record._asdict() for record in records(job)],
+        'summary': summary(job),
+        'fsck': [record._asdict() for record in fsck_records(job)],
+        'compact': [record._asdict() for record in compact_records(job)],
+        'created': [record._asdict()
+                    for record in created_image_records(job)],
+    }, indent=2)
+    if path:
+        with open(path, 'w') as json_file:
+            json_file.write(data)
+    return data
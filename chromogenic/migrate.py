@@ -2,9 +2,11 @@ import os
 
 import logging
 
-from chromogenic.common import wildcard_remove
+from chromogenic.common import wildcard_remove, ImageSession
 from chromogenic.clean import mount_and_clean
+from chromogenic.compact import compact_image, compact_requested
 from chromogenic.drivers.migration import KVM2Xen, Xen2KVM
+from chromogenic.metrics import stage
 
 logger = logging.getLogger(__name__)
 
@@ -18,16 +20,18 @@ def migrate_instance(src_managerCls, src_manager_creds, migrationCls, migration_
 
     #1. Download from src_manager
     download_kwargs = src_manager.download_instance_args(**imaging_args)
-    snapshot_id, download_location = src_manager.download_instance(**download_kwargs)
+    with stage('download'):
+        snapshot_id, download_location = src_manager.download_instance(**download_kwargs)
     imaging_args['download_location'] = download_location
     #Clean it
     download_dir = os.path.dirname(download_location)
     if imaging_args.get('clean_image',True):
-        mount_and_clean(
-                download_location,
-                status_hook=getattr(src_manager, 'hook', None),
-                method_hook=getattr(src_manager, 'clean_hook', None),
-                **imaging_args)
+        with stage('clean'):
+            mount_and_clean(
+                    download_location,
+                    status_hook=getattr(src_manager, 'hook', None),
+                    method_hook=getattr(src_manager, 'clean_hook', None),
+                    **imaging_args)
     #2. Start the migration
     return start_migration(migrationCls, migration_creds, **imaging_args)
 
@@ -41,16 +45,18 @@ def migrate_image(src_managerCls, src_manager_creds, migrationCls, migration_cre
 
     #1. Download & clean from src_manager
     download_kwargs = src_manager.download_image_args(**imaging_args)
-    download_location = src_manager.download_image(**download_kwargs)
+    with stage('download'):
+        download_location = src_manager.download_image(**download_kwargs)
     #Clean it
     download_dir = os.path.dirname(download_location)
     imaging_args['download_location'] = download_location
     if imaging_args.get('clean_image',True):
-        mount_and_clean(
-                download_location,
-                status_hook=getattr(src_manager, 'hook', None),
-                method_hook=getattr(src_manager, 'clean_hook', None),
-                **imaging_args)
+        with stage('clean'):
+            mount_and_clean(
+                    download_location,
+                    status_hook=getattr(src_manager, 'hook', None),
+                    method_hook=getattr(src_manager, 'clean_hook', None),
+                    **imaging_args)
 
     #2. Start the migration
     return start_migration(migrationCls, migration_creds, **imaging_args)
@@ -65,34 +71,46 @@ def start_migration(migrationCls, migration_creds, download_location, **imaging_
     dest_manager = migrationCls(**migration_creds)
     dest_manager.hook = imaging_args.get('machine_request', None)
     download_dir = os.path.dirname(download_location)
-    #2. clean using dest manager
-    if imaging_args.get('clean_image',True):
-        mount_and_clean(
-                download_location,
-                status_hook=getattr(dest_manager, 'hook', None),
-                method_hook=getattr(dest_manager, 'clean_hook', None),
-                **imaging_args)
+    # Clean and convert share one attached image.
+    # It must be detached before upload.
+    with ImageSession(download_location) as session:
+        #2. clean using dest manager
+        if imaging_args.get('clean_image',True):
+            with stage('clean'):
+                mount_and_clean(
+                        download_location,
+                        status_hook=getattr(dest_manager, 'hook', None),
+                        method_hook=getattr(dest_manager, 'clean_hook', None),
+                        session=session,
+                        **imaging_args)
+        if compact_requested(**imaging_args):
+            with stage('compact'):
+                compact_image(download_location, session=session)
 
-    #3. Convert from KVM-->Xen or Xen-->KVM (If necessary)
-    if imaging_args.get('kvm_to_xen', False):
-        (image_path, kernel_path, ramdisk_path) =\
-            KVM2Xen.convert(download_location, download_dir)
-        imaging_args['image_path'] = image_path
-        imaging_args['kernel_path'] = kernel_path
-        imaging_args['ramdisk_path'] = ramdisk_path
-    elif imaging_args.get('xen_to_kvm', False):
-        (image_path, kernel_path, ramdisk_path) =\
-            Xen2KVM.convert(download_location, download_dir)
-        imaging_args['image_path'] = image_path
-        imaging_args['kernel_path'] = kernel_path
-        imaging_args['ramdisk_path'] = ramdisk_path
-    else:
-        logger.info("Upload requires no conversion between Xen and KVM.")
-        imaging_args['image_path'] = download_location
+        #3. Convert from KVM-->Xen or Xen-->KVM (If necessary)
+        with stage('convert'):
+            if imaging_args.get('kvm_to_xen', False):
+                (image_path, kernel_path, ramdisk_path) =\
+                    KVM2Xen.convert(download_location, download_dir,
+                                    session=session)
+                imaging_args['image_path'] = image_path
+                imaging_args['kernel_path'] = kernel_path
+                imaging_args['ramdisk_path'] = ramdisk_path
+            elif imaging_args.get('xen_to_kvm', False):
+                (image_path, kernel_path, ramdisk_path) =\
+                    Xen2KVM.convert(download_location, download_dir,
+                                    session=session)
+                imaging_args['image_path'] = image_path
+                imaging_args['kernel_path'] = kernel_path
+                imaging_args['ramdisk_path'] = ramdisk_path
+            else:
+                logger.info("Upload requires no conversion between Xen and KVM.")
+                imaging_args['image_path'] = download_location
     #4. Upload on new
     imaging_args['download_location'] = download_location
     upload_kwargs = dest_manager.parse_upload_args(**imaging_args)
-    new_image_id = dest_manager.upload_image(**upload_kwargs)
+    with stage('upload'):
+        new_image_id = dest_manager.upload_image(**upload_kwargs)
 
     #5. Cleanup, return
     if not imaging_args.get('keep_image',False):
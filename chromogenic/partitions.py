@@ -0,0 +1,320 @@
+"""
+imaging/partitions.py
+
+Read MBR (dos) and GPT partition tables straight from an image file or
+block device, without running 'fdisk':
+
+>> disk, partitions = read_partition_table('/dev/nbd1')
+>> disk.label
+'dos'
+>> partitions[0]
+Partition(number=1, image_name='/dev/nbd1p1', start=2048, end=20971519, ...)
+>> select_root(partitions).image_name
+'/dev/nbd1p1'
+
+An MBR table can be written the same way:
+
+>> write_mbr('/tmp/new.raw', [(True, 0x83, 2048, 10483712)])
+
+Only raw disks can be read this way. To read a qcow image, attach it to a
+block device first (See chromogenic.common.ImageSession).
+"""
+import logging
+import os
+import struct
+import uuid
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+SECTOR_SIZE = 512
+MBR_SIGNATURE = '\x55\xaa'
+GPT_SIGNATURE = 'EFI PART'
+# Follow at most this many extended boot records, in case of a loop
+MAX_LOGICAL = 128
+# CHS geometry written to new MBR entries (LBA is what is actually used)
+HEADS = 255
+SECTORS_PER_TRACK = 63
+MAX_CHS = (1023, 254, 63)
+
+Disk = namedtuple('Disk', [
+    'path',
+    'label',  # 'dos', 'gpt' or None (no partition table)
+    'size',  # bytes
+    'logical_sector_size',
+    'physical_sector_size',
+    'sectors_total',
+])
+
+Partition = namedtuple('Partition', [
+    'number',
+    'image_name',  # The device name used by the kernel, ex: /dev/loop0p1
+    'start',  # First sector
+    'end',  # Last sector (inclusive)
+    'sectors',
+    'size',  # bytes
+    'bootable',
+    'type_id',  # MBR type as hex ('83') or GPT type GUID
+    'kind',  # 'linux', 'swap', 'lvm', 'raid', 'efi', 'bios_boot',
+             # 'extended' or 'other'
+    'system',  # A human readable name for the type
+])
+
+MBR_TYPES = {
+    0x05: ('extended', 'Extended'),
+    0x0f: ('extended', 'W95 Ext\'d (LBA)'),
+    0x85: ('extended', 'Linux extended'),
+    0x82: ('swap', 'Linux swap / Solaris'),
+    0x83: ('linux', 'Linux'),
+    0x8e: ('lvm', 'Linux LVM'),
+    0xfd: ('raid', 'Linux raid autodetect'),
+    0xef: ('efi', 'EFI (FAT-12/16/32)'),
+    0xee: ('other', 'GPT'),
+}
+
+GPT_TYPES = {
+    '0fc63daf-8483-4772-8e79-3d69d8477de4': ('linux', 'Linux filesystem'),
+    '4f68bce3-e8cd-4db1-96e7-fbcaf984b709': ('linux', 'Linux root (x86-64)'),
+    '44479540-f297-41b2-9af7-d131d5f0458a': ('linux', 'Linux root (x86)'),
+    'bc13c2ff-59e6-4262-a352-b275fd6f7172': ('linux', 'Linux extended boot'),
+    '933ac7e1-2eb4-4f13-b844-0e14e2aef915': ('linux', 'Linux home'),
+    '3b8f8425-20e0-4f3b-907f-1a25a76f98e8': ('linux', 'Linux server data'),
+    '4d21b016-b534-45c2-a9fb-5c16e091fd2d': ('linux', 'Linux variable data'),
+    '7ec6f557-3bc5-4aca-b293-16ef5df639d1': ('linux', 'Linux temporary data'),
+    '0657fd6d-a4ab-43c4-84e5-0933c84b4f4f': ('swap', 'Linux swap'),
+    'e6d6d379-f507-44c2-a23c-238f2a3df928': ('lvm', 'Linux LVM'),
+    'a19d880f-05fc-4d3b-a006-743f0f84911e': ('raid', 'Linux RAID'),
+    'c12a7328-f81f-11d2-ba4b-00a0c93ec93b': ('efi', 'EFI System'),
+    '21686148-6449-6e6f-744e-656564454649': ('bios_boot', 'BIOS boot'),
+}
+
+# Preferred partition kinds for the root filesystem, best first
+ROOT_KINDS = ('linux', 'other', 'lvm', 'raid')
+# GPT types that mark the root filesystem explicitly
+ROOT_TYPE_IDS = ('4f68bce3-e8cd-4db1-96e7-fbcaf984b709',
+                 '44479540-f297-41b2-9af7-d131d5f0458a')
+# GPT types that mark a filesystem other than root (/boot, /home, /srv,
+# /var, /var/tmp), however large
+NOT_ROOT_TYPE_IDS = ('bc13c2ff-59e6-4262-a352-b275fd6f7172',
+                     '933ac7e1-2eb4-4f13-b844-0e14e2aef915',
+                     '3b8f8425-20e0-4f3b-907f-1a25a76f98e8',
+                     '4d21b016-b534-45c2-a9fb-5c16e091fd2d',
+                     '7ec6f557-3bc5-4aca-b293-16ef5df639d1')
+
+
+def read_partition_table(path):
+    """
+    Return (Disk, [Partition, ...]) for the disk at <path>.
+    Partitions are ordered by number. A disk without a partition table
+    has label None and no partitions.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.lseek(fd, 0, os.SEEK_END)
+        logical, physical = _sector_sizes(path)
+        mbr = _read(fd, 0, SECTOR_SIZE)
+        label, partitions = None, []
+        if len(mbr) == SECTOR_SIZE and mbr[510:512] == MBR_SIGNATURE:
+            entries = _mbr_entries(mbr)
+            if any(entry[1] == 0xee for entry in entries):
+                label, partitions = _read_gpt(fd, path, logical)
+            if not label:
+                label = 'dos'
+                partitions = _read_mbr(fd, path, entries, logical)
+        disk = Disk(path, label, size, logical, physical, size // logical)
+        return disk, partitions
+    finally:
+        os.close(fd)
+
+
+def write_mbr(path, entries):
+    """
+    Write an MBR (dos) partition table to <path>, with up to four primary
+    partitions: entries are (bootable, type, start, sectors), as read by
+    _mbr_entries. The rest of the first sector is zeroed.
+    """
+    if len(entries) > 4:
+        raise ValueError("An MBR holds at most four primary partitions")
+    sector = bytearray(SECTOR_SIZE)
+    sector[440:444] = os.urandom(4)  # Disk identifier
+    for index, (bootable, part_type, start, sectors) in enumerate(entries):
+        offset = 446 + index * 16
+        sector[offset:offset + 16] = (
+            struct.pack('<B', 0x80 if bootable else 0)
+            + _chs(start)
+            + struct.pack('<B', part_type)
+            + _chs(start + sectors - 1)
+            + struct.pack('<II', start, sectors))
+    sector[510:512] = MBR_SIGNATURE
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.write(fd, str(sector))
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def select_root(partitions):
+    """
+    Pick the partition most likely to hold the root filesystem:
+    a GPT root partition, or the largest partition of the best kind in
+    ROOT_KINDS, skipping GPT partitions typed as another mount point
+    (NOT_ROOT_TYPE_IDS). Falls back to the first partition.
+    """
+    if not partitions:
+        return None
+    for part in partitions:
+        if _get(part, 'type_id') in ROOT_TYPE_IDS:
+            return part
+    for kind in ROOT_KINDS:
+        candidates = [part for part in partitions
+                      if _get(part, 'kind') == kind
+                      and _get(part, 'type_id') not in NOT_ROOT_TYPE_IDS]
+        if candidates:
+            return max(candidates, key=lambda part: _get(part, 'sectors'))
+    return partitions[0]
+
+
+def partition_device(path, number):
+    """
+    /dev/loop0 -> /dev/loop0p1, /dev/sda -> /dev/sda1
+    """
+    separator = 'p' if path[-1:].isdigit() else ''
+    return '%s%s%s' % (path, separator, number)
+
+
+def _get(part, key):
+    # Accept Partition records and their dict form (See fdisk_image)
+    if isinstance(part, dict):
+        return part.get(key)
+    return getattr(part, key)
+
+
+def _read(fd, offset, length):
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, length)
+
+
+def _sector_sizes(path):
+    """
+    Block devices report their own sector sizes. Image files use 512.
+    """
+    queue_dir = os.path.join('/sys/class/block',
+                             os.path.basename(os.path.realpath(path)),
+                             'queue')
+    sizes = []
+    for name in ('logical_block_size', 'physical_block_size'):
+        try:
+            with open(os.path.join(queue_dir, name)) as size_file:
+                sizes.append(int(size_file.read().strip()))
+        except (IOError, ValueError):
+            sizes.append(SECTOR_SIZE)
+    return tuple(sizes)
+
+
+def _mbr_entries(sector):
+    """
+    The four primary entries as (bootable, type, start, sectors)
+    """
+    entries = []
+    for index in range(4):
+        offset = 446 + index * 16
+        status, part_type, start, sectors = struct.unpack(
+            '<B3xB3xII', sector[offset:offset + 16])
+        entries.append((status == 0x80, part_type, start, sectors))
+    return entries
+
+
+def _chs(lba):
+    cylinder = lba // (HEADS * SECTORS_PER_TRACK)
+    head = (lba // SECTORS_PER_TRACK) % HEADS
+    sector = lba % SECTORS_PER_TRACK + 1
+    if cylinder > MAX_CHS[0]:
+        cylinder, head, sector = MAX_CHS
+    return struct.pack('<BBB', head, ((cylinder >> 2) & 0xc0) | sector,
+                       cylinder & 0xff)
+
+
+def _mbr_partition(path, number, bootable, part_type, start, sectors,
+                   sector_size):
+    kind, system = MBR_TYPES.get(part_type, ('other', 'Unknown'))
+    return Partition(number, partition_device(path, number), start,
+                     start + sectors - 1, sectors, sectors * sector_size,
+                     bootable, '%x' % part_type, kind, system)
+
+
+def _read_mbr(fd, path, entries, sector_size):
+    partitions = []
+    extended_start = None
+    for number, (bootable, part_type, start, sectors) in \
+            enumerate(entries, 1):
+        if not part_type or not sectors:
+            continue
+        partition = _mbr_partition(path, number, bootable, part_type, start,
+                                   sectors, sector_size)
+        partitions.append(partition)
+        if partition.kind == 'extended' and extended_start is None:
+            extended_start = start
+    if extended_start is not None:
+        partitions.extend(
+            _read_logical(fd, path, extended_start, sector_size))
+    return partitions
+
+
+def _read_logical(fd, path, extended_start, sector_size):
+    """
+    Walk the chain of extended boot records. Logical partitions are
+    numbered from 5.
+    """
+    partitions = []
+    ebr_start = extended_start
+    seen = set()
+    while len(partitions) < MAX_LOGICAL and ebr_start not in seen:
+        seen.add(ebr_start)
+        sector = _read(fd, ebr_start * sector_size, SECTOR_SIZE)
+        if len(sector) < SECTOR_SIZE or sector[510:512] != MBR_SIGNATURE:
+            break
+        entries = _mbr_entries(sector)
+        bootable, part_type, start, sectors = entries[0]
+        if part_type and sectors:
+            partitions.append(_mbr_partition(
+                path, 5 + len(partitions), bootable, part_type,
+                ebr_start + start, sectors, sector_size))
+        _, next_type, next_start, _ = entries[1]
+        if not next_type or not next_start:
+            break
+        ebr_start = extended_start + next_start
+    return partitions
+
+
+def _read_gpt(fd, path, sector_size):
+    """
+    Return ('gpt', partitions), or (None, []) if the GPT header is not valid
+    """
+    header = _read(fd, sector_size, 92)
+    if len(header) < 92 or header[:8] != GPT_SIGNATURE:
+        logger.warn("%s has a protective MBR but no GPT header" % path)
+        return None, []
+    entries_lba, entry_count, entry_size = struct.unpack(
+        '<QII', header[72:88])
+    table = _read(fd, entries_lba * sector_size, entry_count * entry_size)
+    partitions = []
+    for index in range(len(table) // entry_size):
+        entry = table[index * entry_size:(index + 1) * entry_size]
+        type_guid = str(uuid.UUID(bytes_le=entry[:16]))
+        if type_guid == '00000000-0000-0000-0000-000000000000':
+            continue
+        start, end, attributes = struct.unpack('<QQQ', entry[32:56])
+        kind, system = GPT_TYPES.get(type_guid, ('other', 'Unknown'))
+        name = entry[56:128].decode('utf-16-le', 'replace').rstrip(u'\x00')
+        if name:
+            system = '%s (%s)' % (system, name.encode('utf-8'))
+        number = index + 1
+        sectors = end - start + 1
+        partitions.append(Partition(
+            number, partition_device(path, number), start, end, sectors,
+            sectors * sector_size,
+            # 'Legacy BIOS bootable' attribute
+            bool(attributes & 0x4), type_guid, kind, system))
+    return 'gpt', partitions
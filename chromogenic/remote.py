@@ -0,0 +1,507 @@
+"""
+imaging/remote.py
+
+These functions are used to copy files (instance root disks) from a remote
+host, such as a Eucalyptus node controller, over SSH.
+
+The remote file is streamed through 'dd' (and optionally a fast compressor)
+so that:
+  * A dropped connection resumes from the last verified block
+  * Blocks of zeros are written as holes (The local copy stays sparse)
+  * The result is verified against a checksum computed on the remote host
+
+Every job gets its own private key file and shares one multiplexed
+(ControlMaster) SSH connection per remote host, so concurrent jobs never
+touch each other's keys and every command after the first skips the SSH
+handshake. The master connection exits on its own once it has been idle
+for SSH_CONTROL_PERSIST seconds, so a worker that dies without closing
+its sessions leaves no ssh process behind. Sessions still open when the
+process exits are closed, and key directories left by processes that
+died are removed when the next session is created:
+
+>> with ssh_session(hostname='10.0.0.5', private_key=key) as session:
+>>     transfer_remote_file(session.command_list(), '/remote/root', '/tmp/root')
+"""
+import atexit
+import errno
+import glob
+import hashlib
+import logging
+import os
+import pipes
+import shutil
+import subprocess
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from chromogenic.command import CommandTimeout
+from chromogenic.common import run_command, start_command, wait_command
+from chromogenic.settings import chromo_settings
+from chromogenic.hashing import block_digest, hash_file, hash_file_async
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 1024 * 1024  # 1MB, unit of resume and of hole detection
+SSH_CONNECT_TIMEOUT = 30  # seconds
+# A link that answers no keepalive for ALIVE_INTERVAL * ALIVE_COUNT seconds
+# is dropped, so a stalled transfer fails and is retried
+SSH_ALIVE_INTERVAL = 15
+SSH_ALIVE_COUNT = 4
+# Seconds an idle master connection stays up with no client
+SSH_CONTROL_PERSIST = 10 * 60
+# Private directories of the sessions, named by the pid that owns them
+SESSION_DIR_PREFIX = 'chromo_ssh_'
+ZERO_BLOCK = '\0' * BLOCK_SIZE
+
+# compression: (remote compress command, local decompress command)
+COMPRESSION = {
+    'gzip': ('gzip -1 -c', ['gzip', '-d', '-c']),
+    'lz4': ('lz4 -1 -c', ['lz4', '-d', '-c']),
+    'zstd': ('zstd -1 -c', ['zstd', '-d', '-c']),
+}
+
+
+def ssh_command_list(user='root', hostname='localhost', port=22,
+                     check_key=False, key_path=None, control_path=None):
+    """
+    Build the 'ssh' command list (without a remote command) for a host
+    """
+    ssh_list = ['ssh', '-o', 'BatchMode=yes']
+    ssh_list.extend(ssh_options(check_key, key_path, control_path))
+    if port != 22:
+        ssh_list.extend(['-p', '%s' % port])
+    ssh_list.append('%s@%s' % (user, hostname))
+    return ssh_list
+
+
+def ssh_options(check_key=False, key_path=None, control_path=None):
+    """
+    Options shared by 'ssh' and 'scp'
+    """
+    options = ['-o', 'ConnectTimeout=%s' % SSH_CONNECT_TIMEOUT,
+               '-o', 'ServerAliveInterval=%s' % SSH_ALIVE_INTERVAL,
+               '-o', 'ServerAliveCountMax=%s' % SSH_ALIVE_COUNT]
+    if not check_key:
+        options.extend(['-o', 'stricthostkeychecking=no'])
+    if key_path:
+        options.extend(['-i', key_path])
+    if control_path:
+        options.extend(['-o', 'ControlPath=%s' % control_path])
+    return options
+
+
+class SSHSession(object):
+    """
+    A multiplexed SSH connection to one host, owned by this process.
+    The private key and control socket live in a directory private to the
+    session, which is removed when the session is closed.
+    Use ssh_session() to share a session between jobs.
+    """
+
+    def __init__(self, user='root', hostname='localhost', port=22,
+                 check_key=False, private_key=None):
+        self.user = user
+        self.hostname = hostname
+        self.port = port
+        self.check_key = check_key
+        self.users = 0
+        self.job_dir = tempfile.mkdtemp(
+            prefix='%s%s_' % (SESSION_DIR_PREFIX, os.getpid()))
+        self.key_path = None
+        if private_key:
+            self.key_path = write_private_key(
+                private_key, os.path.join(self.job_dir, 'id_key'))
+        self.control_path = os.path.join(self.job_dir, 'control')
+
+    def command_list(self):
+        """
+        'ssh' command list that runs over the shared connection
+        """
+        return ssh_command_list(self.user, self.hostname, self.port,
+                                self.check_key, self.key_path,
+                                self.control_path)
+
+    def scp_command_list(self, remote_path, local_path):
+        scp_list = ['scp']
+        scp_list.extend(ssh_options(self.check_key, self.key_path,
+                                    self.control_path))
+        if self.port != 22:
+            scp_list.extend(['-P%s' % self.port])
+        scp_list.extend(['%s@%s:%s' % (self.user, self.hostname, remote_path),
+                         local_path])
+        return scp_list
+
+    def run(self, command, **kwargs):
+        """
+        Run <command> on the remote host (See run_command)
+        """
+        return run_command(self.command_list() + [command], **kwargs)
+
+    def open(self):
+        """
+        Authenticate once and leave the master connection in the background
+        """
+        master_list = self.command_list()
+        master_list[1:1] = ['-M', '-N', '-f', '-o',
+                            'ControlPersist=%s' % SSH_CONTROL_PERSIST]
+        # The backgrounded master keeps any pipes open, so use a file
+        with tempfile.TemporaryFile() as output:
+            try:
+                run_command(master_list, stdout=output, stderr=output,
+                            check_return=True)
+            except Exception:
+                output.seek(0)
+                logger.error("Could not open an SSH connection to %s: %s"
+                             % (self.hostname, output.read()))
+                self.close()
+                raise
+        logger.info("Opened shared SSH connection to %s@%s"
+                    % (self.user, self.hostname))
+        return self
+
+    def close(self):
+        if os.path.exists(self.control_path):
+            exit_list = self.command_list()
+            exit_list[1:1] = ['-O', 'exit']
+            run_command(exit_list)
+            logger.info("Closed shared SSH connection to %s@%s"
+                        % (self.user, self.hostname))
+        shutil.rmtree(self.job_dir, ignore_errors=True)
+
+
+def remove_stale_session_dirs():
+    """
+    Remove the session directories (and private keys) of processes that
+    are no longer running
+    """
+    pattern = os.path.join(tempfile.gettempdir(),
+                           '%s*_*' % SESSION_DIR_PREFIX)
+    for session_dir in glob.glob(pattern):
+        pid = os.path.basename(session_dir)[
+            len(SESSION_DIR_PREFIX):].split('_')[0]
+        if not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        try:
+            os.kill(int(pid), 0)
+            continue
+        except OSError as kill_error:
+            if kill_error.errno != errno.ESRCH:
+                continue  # Alive, owned by another user
+        logger.info("Removing stale SSH session directory %s" % session_dir)
+        shutil.rmtree(session_dir, ignore_errors=True)
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+# One [lock, number of users] per session key. The lock is held while
+# that session connects, and the entry is removed with its last user.
+_connect_locks = {}
+_stale_dirs_removed = False
+
+
+@contextmanager
+def ssh_session(user='root', hostname='localhost', port=22,
+                check_key=False, private_key=None):
+    """
+    Share one SSHSession per (user, host, port, key) within this process.
+    The connection is closed when its last user exits.
+    """
+    global _stale_dirs_removed
+    session_key = (user, hostname, port, check_key,
+                   hashlib.sha1(private_key or '').hexdigest())
+    with _sessions_lock:
+        remove_dirs = not _stale_dirs_removed
+        _stale_dirs_removed = True
+        connect_entry = _connect_locks.setdefault(
+            session_key, [threading.Lock(), 0])
+        connect_entry[1] += 1
+    try:
+        if remove_dirs:
+            remove_stale_session_dirs()
+        # Only jobs for the same host and key wait for a slow handshake
+        with connect_entry[0]:
+            with _sessions_lock:
+                session = _sessions.get(session_key)
+                if session:
+                    session.users += 1
+            if not session:
+                session = SSHSession(user, hostname, port, check_key,
+                                     private_key).open()
+                with _sessions_lock:
+                    session.users += 1
+                    _sessions[session_key] = session
+        try:
+            yield session
+        finally:
+            with _sessions_lock:
+                session.users -= 1
+                last_user = not session.users
+                if last_user:
+                    _sessions.pop(session_key, None)
+            if last_user:
+                session.close()
+    finally:
+        with _sessions_lock:
+            connect_entry[1] -= 1
+            if not connect_entry[1]:
+                del _connect_locks[session_key]
+
+
+def close_all_sessions():
+    """
+    Close the sessions that are still open (at exit)
+    """
+    with _sessions_lock:
+        sessions = _sessions.values()
+        _sessions.clear()
+    for session in sessions:
+        try:
+            session.close()
+        except Exception as close_error:
+            logger.warn("Could not close the SSH session to %s: %s"
+                        % (session.hostname, close_error))
+
+atexit.register(close_all_sessions)
+
+
+def write_private_key(private_key, key_path):
+    """
+    Write <private_key> to <key_path> with the permissions SSH requires
+    """
+    fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as key_file:
+        key_file.write(private_key.strip() + '\n')
+    os.chmod(key_path, 0o600)
+    return key_path
+
+
+def remote_file_size(ssh_list, remote_path):
+    path = pipes.quote(remote_path)
+    out, err = run_command(ssh_list + [
+        "if [ -b %s ]; then blockdev --getsize64 %s; else stat -L -c %%s %s; fi"
+        % (path, path, path)])
+    if not out or not out.strip().isdigit():
+        raise Exception("Could not determine the size of %s on the remote"
+                        " host: %s" % (remote_path, err))
+    return int(out.strip())
+
+
+def remote_block_md5(ssh_list, remote_path, block_number):
+    out, _ = run_command(ssh_list + [
+        "dd if=%s bs=%s skip=%s count=1 2>/dev/null | md5sum"
+        % (pipes.quote(remote_path), BLOCK_SIZE, block_number)])
+    return out.split(' ')[0].strip() if out else None
+
+
+def local_block_md5(local_path, block_number, length=BLOCK_SIZE):
+    return block_digest(local_path, block_number * BLOCK_SIZE, length,
+                        'md5')
+
+
+def local_file_md5(local_path):
+    return hash_file(local_path, ('md5',))['md5']
+
+
+def resume_offset(ssh_list, remote_path, local_path, remote_size):
+    """
+    Return the offset where a transfer into <local_path> can continue.
+    The last whole block before that offset must match the remote copy,
+    otherwise the transfer starts over. A local copy of the full size is
+    only trusted when its last block matches.
+    """
+    if not os.path.exists(local_path):
+        return 0
+    local_size = os.path.getsize(local_path)
+    if local_size > remote_size:
+        logger.warn("Local copy %s is larger than %s. Starting over."
+                    % (local_path, remote_path))
+        return 0
+    if local_size == remote_size:
+        if not remote_size:
+            return 0
+        last_block = (remote_size - 1) / BLOCK_SIZE
+        length = remote_size - last_block * BLOCK_SIZE
+        if remote_block_md5(ssh_list, remote_path, last_block) \
+                != local_block_md5(local_path, last_block, length):
+            logger.warn("Local copy %s does not match %s. Starting over."
+                        % (local_path, remote_path))
+            return 0
+        return remote_size
+    block_count = local_size / BLOCK_SIZE
+    if not block_count:
+        return 0
+    last_block = block_count - 1
+    if remote_block_md5(ssh_list, remote_path, last_block) \
+            != local_block_md5(local_path, last_block):
+        logger.warn("Local copy %s does not match %s. Starting over."
+                    % (local_path, remote_path))
+        return 0
+    return block_count * BLOCK_SIZE
+
+
+def transfer_remote_file(ssh_list, remote_path, local_path,
+                         compression='gzip', sparse=True, resume=True,
+                         verify=True, attempts=3):
+    """
+    Copy <remote_path> to <local_path> over SSH.
+    Optional Args:
+        compression - 'gzip', 'lz4', 'zstd' or None (Compress on the wire)
+        sparse - Write blocks of zeros as holes in the local file
+        resume - Continue a previous (partial) transfer of <local_path>
+        verify - Compare the local md5sum to the remote md5sum
+        attempts - Transfers attempted before giving up
+    """
+    if compression and compression not in COMPRESSION:
+        raise ValueError("Unknown compression '%s'. Expected one of %s"
+                         % (compression, COMPRESSION.keys()))
+    remote_size = remote_file_size(ssh_list, remote_path)
+    remote_md5 = None
+    try:
+        for attempt in range(1, attempts + 1):
+            offset = resume_offset(ssh_list, remote_path, local_path,
+                                   remote_size) if resume else 0
+            if offset < remote_size:
+                logger.info("Transferring %s:%s to %s (%s/%s bytes, attempt"
+                            " %s)" % (ssh_list[-1], remote_path, local_path,
+                                      remote_size - offset, remote_size,
+                                      attempt))
+                try:
+                    _stream_remote_file(ssh_list, remote_path, local_path,
+                                        offset, remote_size,
+                                        compression, sparse)
+                except Exception as transfer_failed:
+                    logger.warn("Transfer of %s interrupted: %s"
+                                % (remote_path, transfer_failed))
+                    resume = True
+                    continue
+            if not verify:
+                return local_path
+            # After the transfer, so the two reads of the remote disk do
+            # not compete. The local copy is hashed meanwhile.
+            remote_md5 = _start_remote_md5(ssh_list, remote_path)
+            local_md5 = hash_file_async(local_path, ('md5',))
+            try:
+                expected = _finish_remote_md5(remote_md5)
+                remote_md5 = None
+                actual = local_md5.result()['md5']
+            finally:
+                local_md5.wait()
+            if expected == actual:
+                logger.info("Transfer of %s verified (md5 %s)"
+                            % (remote_path, actual))
+                return local_path
+            logger.error("Checksum mismatch for %s: remote %s, local %s"
+                         % (local_path, expected, actual))
+            os.remove(local_path)
+    finally:
+        if remote_md5:
+            remote_md5[0].kill()
+            wait_command(remote_md5[0])
+    raise Exception("Could not transfer %s from %s after %s attempts"
+                    % (remote_path, ssh_list[-1], attempts))
+
+
+def _start_remote_md5(ssh_list, remote_path):
+    output = tempfile.TemporaryFile()
+    process = start_command(
+        ssh_list + ["md5sum %s" % pipes.quote(remote_path)],
+        timeout=chromo_settings.SSH_TRANSFER_TIMEOUT,
+        stdout=output, stderr=subprocess.STDOUT)
+    return (process, output)
+
+
+def _finish_remote_md5(remote_md5):
+    process, output = remote_md5
+    try:
+        result = wait_command(process)
+        output.seek(0)
+        out = output.read()
+    finally:
+        output.close()
+    if result.returncode != 0:
+        raise Exception("Remote md5sum failed: %s" % out)
+    return out.split(' ')[0].strip()
+
+
+def _stream_remote_file(ssh_list, remote_path, local_path, offset,
+                        remote_size, compression, sparse):
+    remote_cmd = "dd if=%s bs=%s skip=%s 2>/dev/null" % (
+        pipes.quote(remote_path), BLOCK_SIZE, offset / BLOCK_SIZE)
+    decompress_cmd = None
+    if compression:
+        compress_cmd, decompress_cmd = COMPRESSION[compression]
+        remote_cmd += " | %s" % compress_cmd
+    timeout = chromo_settings.SSH_TRANSFER_TIMEOUT
+    ssh_errors = tempfile.TemporaryFile()
+    ssh_process = start_command(ssh_list + [remote_cmd], timeout=timeout,
+                                stdout=subprocess.PIPE, stderr=ssh_errors)
+    processes = [('ssh', ssh_process)]
+    stream = ssh_process.stdout
+    if decompress_cmd:
+        decompress_process = start_command(decompress_cmd, timeout=timeout,
+                                           stdin=stream,
+                                           stdout=subprocess.PIPE)
+        # Only the decompressor holds the pipe from ssh now
+        stream.close()
+        processes.append((decompress_cmd[0], decompress_process))
+        stream = decompress_process.stdout
+    results = []
+    timeouts = []
+    try:
+        position = _write_stream(stream, local_path, offset, sparse)
+    finally:
+        stream.close()
+        for (name, process) in processes:
+            try:
+                results.append((name, wait_command(process)))
+            except CommandTimeout as timed_out:
+                timeouts.append(timed_out)
+        ssh_errors.seek(0)
+        errors = ssh_errors.read()
+        ssh_errors.close()
+    if timeouts:
+        raise timeouts[0]  # The attempt is retried
+    for (name, result) in results:
+        if result.returncode != 0:
+            raise Exception("%s exited with code %s: %s"
+                            % (name, result.returncode, errors))
+    if position != remote_size:
+        raise Exception("Received %s of %s bytes" % (position, remote_size))
+
+
+def _write_stream(stream, local_path, offset, sparse):
+    """
+    Write <stream> into <local_path> starting at <offset>.
+    Returns the final position (The local file is sized to match)
+    """
+    mode = 'r+b' if os.path.exists(local_path) else 'wb'
+    with open(local_path, mode) as local_file:
+        # Anything past the verified offset is discarded, so that skipped
+        # (sparse) blocks read back as zeros.
+        local_file.truncate(offset)
+        local_file.seek(offset)
+        position = offset
+        while True:
+            chunk = _read_block(stream)
+            if not chunk:
+                break
+            if sparse and chunk == ZERO_BLOCK[:len(chunk)]:
+                local_file.seek(len(chunk), os.SEEK_CUR)
+            else:
+                local_file.write(chunk)
+            position += len(chunk)
+        local_file.truncate(position)
+    return position
+
+
+def _read_block(stream):
+    chunks = []
+    remaining = BLOCK_SIZE
+    while remaining:
+        chunk = stream.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return ''.join(chunks)
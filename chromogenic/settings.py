@@ -25,6 +25,39 @@ USER_SETTINGS = getattr(settings, 'CHROMOGENIC', {})
 DEFAULTS =  {
     # General
     "SSH_KEY": "",
+    # Lock files used to reserve loop/nbd devices (See chromogenic.devices)
+    "DEVICE_LOCK_DIR": "/var/lock/chromogenic",
+    # How mount_and_clean cleans images: 'tools' always runs virt-inspector
+    # and virt-sysprep, 'auto' uses the libguestfs python bindings when they
+    # are installed, and 'guestfs' warns when they are not. The bindings
+    # only run part of the virt-sysprep operations (See chromogenic.sysprep)
+    "CLEAN_ENGINE": "tools",
+    # A fixed libguestfs appliance, built once per host at worker start
+    # (See chromogenic.appliance). None lets libguestfs manage its own.
+    "LIBGUESTFS_APPLIANCE_DIR": "/var/lib/chromogenic/appliance",
+    # Rendered virt-sysprep command files, shared by every job on the host
+    "SYSPREP_RECIPE_DIR": "/var/cache/chromogenic/sysprep",
+    # Seconds a recipe may go unused before it is removed as stale. Workers
+    # still running an older release keep using their own recipes.
+    "SYSPREP_RECIPE_MAX_AGE": 7*24*60*60,
+    # Shrink images to fit their data after cleaning (See
+    # chromogenic.compact). Requests can enable it with 'compact_image'.
+    "COMPACT_IMAGES": False,
+    # Free space left in a compacted root filesystem
+    "COMPACT_HEADROOM_MB": 1024,
+    # Seconds a node controller disk (and its remote md5sum) may stream
+    # over SSH (See chromogenic.remote). A stalled link fails sooner, on
+    # the SSH keepalive.
+    "SSH_TRANSFER_TIMEOUT": 6 * 60 * 60,
+    # Seconds before run_command kills a tool (See chromogenic.command).
+    # Tools that are not listed have no time limit. Never list tools
+    # that repair or change an image (fsck, xfs_repair, virt-sysprep):
+    # killing them half way can leave the image worse than it was.
+    "COMMAND_TIMEOUTS": {
+        "qemu-nbd": 120,
+        "losetup": 120,
+        "virt-inspector": 1800,
+    },
 }
 
 class ReadOnlyAttrDict(dict):
@@ -0,0 +1,479 @@
+"""
+imaging/sysprep.py
+
+Clean an image in one libguestfs session, through the libguestfs Python
+bindings, instead of booting an appliance for 'virt-inspector' and
+another for 'virt-sysprep' (and running 'fsck' before both):
+
+>> with GuestfsSession('/dev/nbd1') as handle:
+>>     guest = handle.prepare()  # fsck, mount and inspect the guest
+>>     handle.sysprep(hostname='centos', commands=commands_text)
+
+SYSPREP_OPERATIONS are the virt-sysprep operations chromogenic runs
+('defaults,kerberos-data,user-account'), limited to what applies to the
+Linux guests we image. Commands use the virt-sysprep '--commands-from-file'
+syntax (See chromogenic.virt_sysprep). Only the directives in COMMANDS are
+understood, and every command is checked before the guest is changed.
+Guests with SELinux enabled get '/.autorelabel', so the files written
+here are relabeled on their first boot (virt-sysprep's 'selinux-relabel').
+The other default virt-sysprep operations (ex: 'customize', 'lvm-uuids')
+are not run, so this engine is opt-in (the CLEAN_ENGINE setting).
+
+Guests this engine can not handle (ex: xfs with an external log) raise
+UnsupportedGuest before they are changed, and are cleaned by virt-sysprep.
+
+The wall time of each session is recorded as a 'libguestfs' command (See
+chromogenic.metrics).
+
+The bindings are optional: when they are not installed (has_guestfs),
+chromogenic.clean runs the tools instead.
+"""
+import crypt
+import logging
+import os
+import random
+import string
+import tempfile
+import time
+from collections import OrderedDict
+
+from chromogenic.command import CommandResult
+from chromogenic.common import run_command, fsck_action
+from chromogenic.detect import read_filesystem_state, xfs_external_log
+from chromogenic.guest import GuestInfo, Package
+from chromogenic.metrics import record_command, record_fsck
+
+try:
+    import guestfs
+    has_guestfs = True
+except ImportError:
+    has_guestfs = False
+
+logger = logging.getLogger(__name__)
+
+# Paths removed by each operation (See 'virt-sysprep --list-operations')
+DELETE_GLOBS = OrderedDict([
+    ('abrt-data', ['/var/spool/abrt/*']),
+    ('bash-history', ['/root/.bash_history', '/home/*/.bash_history']),
+    ('blkid-tab', ['/var/run/blkid.tab', '/var/run/blkid.tab.old',
+                   '/etc/blkid/blkid.tab', '/etc/blkid/blkid.tab.old',
+                   '/etc/blkid.tab', '/etc/blkid.tab.old']),
+    ('crash-data', ['/var/crash/*', '/var/log/dump/*']),
+    ('cron-spool', ['/var/spool/cron/*', '/var/spool/atjobs/*',
+                    '/var/spool/atspool/*', '/var/spool/at/spool/*']),
+    ('dhcp-client-state', ['/var/lib/dhclient/*', '/var/lib/dhcp/*']),
+    ('dhcp-server-state', ['/var/lib/dhcpd/*']),
+    ('dovecot-data', ['/var/lib/dovecot/*']),
+    ('kerberos-data', ['/var/kerberos/krb5kdc/*']),
+    ('logfiles', ['/var/log/*.log*', '/var/log/audit/*', '/var/log/btmp*',
+                  '/var/log/cron*', '/var/log/dmesg*', '/var/log/lastlog*',
+                  '/var/log/maillog*', '/var/log/messages*',
+                  '/var/log/secure*', '/var/log/spooler*',
+                  '/var/log/syslog*', '/var/log/wtmp*',
+                  '/var/log/upstart/*', '/var/log/journal/*',
+                  '/root/install.log*', '/root/anaconda-ks.cfg']),
+    ('mail-spool', ['/var/spool/mail/*', '/var/mail/*']),
+    ('package-manager-cache', ['/var/cache/yum/*', '/var/cache/dnf/*',
+                               '/var/cache/apt/archives/*.deb']),
+    ('pam-data', ['/var/run/console/*', '/var/run/faillock/*',
+                  '/var/run/sepermit/*']),
+    ('passwd-backups', ['/etc/group-', '/etc/gshadow-', '/etc/passwd-',
+                        '/etc/shadow-', '/etc/subuid-', '/etc/subgid-']),
+    ('puppet-data-log', ['/var/log/puppet/*', '/var/lib/puppet/*/*']),
+    ('rh-subscription-manager', ['/etc/pki/consumer/*',
+                                 '/etc/pki/entitlement/*']),
+    ('rhn-systemid', ['/etc/sysconfig/rhn/systemid',
+                      '/etc/sysconfig/rhn/osad-auth.conf']),
+    ('rpm-db', ['/var/lib/rpm/__db.*']),
+    ('samba-db-log', ['/var/log/samba/*', '/var/lib/samba/*/*']),
+    ('smolt-uuid', ['/etc/sysconfig/hw-uuid', '/etc/smolt/uuid',
+                    '/etc/smolt/hw-uuid']),
+    ('ssh-hostkeys', ['/etc/ssh/*_host_*']),
+    ('ssh-userdir', ['/root/.ssh', '/home/*/.ssh']),
+    ('sssd-db-log', ['/var/log/sssd/*', '/var/lib/sss/db/*']),
+    ('tmp-files', ['/tmp/*', '/var/tmp/*']),
+    ('udev-persistent-net', ['/etc/udev/rules.d/70-persistent-net.rules']),
+    ('utmp', ['/var/run/utmp']),
+    ('yum-uuid', ['/var/lib/yum/uuid']),
+])
+
+# Files that are kept, even when a glob above matches them
+KEEP_FILES = ('/var/kerberos/krb5kdc/kadm5.acl',
+              '/var/kerberos/krb5kdc/kdc.conf')
+
+SYSPREP_OPERATIONS = tuple(DELETE_GLOBS.keys()) + (
+    'machine-id', 'net-hostname', 'net-hwaddr', 'pacct-log', 'user-account')
+
+COMMANDS = ('delete', 'edit', 'mkdir', 'root-password', 'run-command',
+            'touch', 'truncate', 'truncate-recursive')
+
+IFCFG_GLOB = '/etc/sysconfig/network-scripts/ifcfg-*'
+# Users with a uid in this range are removed. The guest's
+# /etc/login.defs overrides these defaults.
+UID_MIN = 1000
+UID_MAX = 60000
+SELINUX_CONFIG = '/etc/selinux/config'
+
+
+class UnsupportedGuest(Exception):
+    """
+    The guest needs virt-sysprep. Raised before it is changed.
+    """
+
+
+class GuestfsSession(object):
+    """
+    One libguestfs appliance, with the disk at <disk_path> added
+    """
+
+    def __init__(self, disk_path, disk_format='raw'):
+        if not has_guestfs:
+            raise Exception("The libguestfs python bindings are not installed")
+        self.disk_path = disk_path
+        self.disk_format = disk_format
+        self.handle = None
+        self.root = None
+        self.started = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def open(self):
+        self.started = time.time()
+        handle = guestfs.GuestFS(python_return_dict=True)
+        handle.add_drive_opts(self.disk_path, format=self.disk_format,
+                              readonly=False)
+        handle.launch()
+        logger.info("Launched the libguestfs appliance for %s in %.2fs"
+                    % (self.disk_path, time.time() - self.started))
+        self.handle = handle
+        return self
+
+    def close(self):
+        if not self.handle:
+            return
+        handle, self.handle = self.handle, None
+        returncode = 1
+        try:
+            handle.umount_all()
+            # Flush every change to the disk
+            handle.shutdown()
+            returncode = 0
+        finally:
+            handle.close()
+            record_command(CommandResult(
+                None, None, 'libguestfs %s' % self.disk_path, returncode,
+                time.time() - self.started))
+
+    def prepare(self):
+        """
+        Find the root filesystem, fsck it, mount the guest and return its
+        GuestInfo
+        """
+        roots = self.handle.inspect_os()
+        if not roots:
+            raise Exception("libguestfs did not find an operating system on"
+                            " %s" % self.disk_path)
+        self.root = roots[0]
+        self.fsck(self.root)
+        mountpoints = self.handle.inspect_get_mountpoints(self.root)
+        # Mount '/' before '/boot', and so on
+        for path in sorted(mountpoints, key=len):
+            try:
+                self.handle.mount(mountpoints[path], path)
+            except RuntimeError as mount_error:
+                logger.warn("Could not mount %s at %s: %s"
+                            % (mountpoints[path], path, mount_error))
+        return self.inspect()
+
+    def fsck(self, device):
+        """
+        Check <device>, unless its superblock says that is not needed
+        (See chromogenic.common.fsck_device). A journal (or xfs log) that
+        only needs replaying is replayed when the guest is mounted.
+        """
+        start = time.time()
+        fs_type = self.handle.vfs_type(device)
+
+        def read(offset, length):
+            return self.handle.pread_device(device, length, offset)
+        if fs_type == 'xfs' and xfs_external_log(read):
+            # xfs_repair needs the log device, which we can not tell
+            raise UnsupportedGuest("The xfs filesystem on %s has an"
+                                   " external log" % device)
+        try:
+            state = read_filesystem_state(read)
+        except RuntimeError as read_error:
+            logger.warn("Could not read the filesystem state of %s: %s"
+                        % (device, read_error))
+            state = None
+        action = fsck_action(state)
+        if action == 'full':
+            logger.info("Checking the %s filesystem on %s"
+                        % (fs_type, device))
+            if fs_type.startswith('ext'):
+                self.handle.e2fsck(device, forceall=True)
+            elif fs_type == 'xfs':
+                self.handle.xfs_repair(device)
+            else:
+                self.handle.fsck(fs_type, device)
+        record_fsck(self.disk_path, state.filesystem if state else fs_type,
+                    action, state.reason if state else 'state not read',
+                    time.time() - start)
+
+    def inspect(self):
+        handle, root = self.handle, self.root
+        mountpoints = handle.inspect_get_mountpoints(root)
+        packages = tuple(
+            Package(app['app2_name'], str(app['app2_epoch']),
+                    app['app2_version'], app['app2_release'],
+                    app['app2_arch'])
+            for app in handle.inspect_list_applications2(root))
+        return GuestInfo(
+            root, handle.inspect_get_type(root),
+            handle.inspect_get_distro(root),
+            handle.inspect_get_product_name(root),
+            handle.inspect_get_major_version(root),
+            handle.inspect_get_minor_version(root),
+            handle.inspect_get_arch(root),
+            handle.inspect_get_hostname(root),
+            handle.inspect_get_package_format(root),
+            tuple(sorted(mountpoints.items())), packages)
+
+    def sysprep(self, operations=SYSPREP_OPERATIONS, hostname=None,
+                commands=''):
+        """
+        Run <operations>, set <hostname>, then run <commands>
+        """
+        parsed_commands = parse_commands(commands)
+        for operation in operations:
+            logger.debug("Running sysprep operation %s" % operation)
+            if operation in DELETE_GLOBS:
+                for pattern in DELETE_GLOBS[operation]:
+                    self.delete(pattern)
+            else:
+                getattr(self, '_%s' % operation.replace('-', '_'))()
+        if hostname:
+            self.set_hostname(hostname)
+        for command, argument in parsed_commands:
+            logger.debug("Running sysprep command %s %s"
+                         % (command, argument))
+            getattr(self, '_command_%s' % command.replace('-', '_'))(argument)
+        if self.selinux_enabled():
+            # Files written from the appliance have no SELinux label
+            self.handle.touch('/.autorelabel')
+
+    # Helpers
+
+    def delete(self, pattern):
+        for path in self.handle.glob_expand(pattern):
+            path = path.rstrip('/') or '/'
+            if path not in KEEP_FILES:
+                self.handle.rm_rf(path)
+
+    def read_lines(self, path):
+        return self.handle.read_file(path).splitlines(True)
+
+    def write_lines(self, path, lines):
+        self.handle.write(path, ''.join(lines))
+
+    def remove_matching_lines(self, pattern, prefixes):
+        for path in self.handle.glob_expand(pattern):
+            if not self.handle.is_file(path):
+                continue
+            lines = self.read_lines(path)
+            kept = [line for line in lines
+                    if not line.lstrip().startswith(prefixes)]
+            if kept != lines:
+                self.write_lines(path, kept)
+
+    def uid_range(self):
+        """
+        (UID_MIN, UID_MAX) of the guest's /etc/login.defs, or the defaults
+        """
+        limits = {'UID_MIN': UID_MIN, 'UID_MAX': UID_MAX}
+        if not self.handle.is_file('/etc/login.defs'):
+            return UID_MIN, UID_MAX
+        for line in self.read_lines('/etc/login.defs'):
+            fields = line.split()
+            if len(fields) >= 2 and fields[0] in limits \
+                    and fields[1].isdigit():
+                limits[fields[0]] = int(fields[1])
+        return limits['UID_MIN'], limits['UID_MAX']
+
+    def selinux_enabled(self):
+        """
+        False when the guest has no SELinux config, or SELINUX=disabled
+        """
+        if not self.handle.is_file(SELINUX_CONFIG):
+            return False
+        for line in self.read_lines(SELINUX_CONFIG):
+            name, _, value = line.strip().partition('=')
+            if name.strip() == 'SELINUX':
+                return value.strip().strip('"\'').lower() != 'disabled'
+        return False
+
+    def set_hostname(self, hostname):
+        if self.handle.is_file('/etc/hostname') or \
+                self.handle.inspect_get_package_format(self.root) == 'deb':
+            self.handle.write('/etc/hostname', '%s\n' % hostname)
+        network = '/etc/sysconfig/network'
+        if self.handle.is_file(network):
+            lines = [line for line in self.read_lines(network)
+                     if not line.startswith('HOSTNAME=')]
+            lines.append('HOSTNAME=%s\n' % hostname)
+            self.write_lines(network, lines)
+
+    # Operations that do more than delete files
+
+    def _machine_id(self):
+        if self.handle.is_file('/etc/machine-id'):
+            self.handle.truncate('/etc/machine-id')
+        self.handle.rm_f('/var/lib/dbus/machine-id')
+
+    def _net_hostname(self):
+        self.remove_matching_lines(IFCFG_GLOB, ('HOSTNAME=', 'DHCP_HOSTNAME='))
+
+    def _net_hwaddr(self):
+        self.remove_matching_lines(IFCFG_GLOB, ('HWADDR=',))
+
+    def _pacct_log(self):
+        for pattern in ('/var/account/pacct*', '/var/log/account/pacct*'):
+            for path in self.handle.glob_expand(pattern):
+                self.handle.truncate(path)
+
+    def _user_account(self):
+        """
+        Remove every user in the guest's UID_MIN-UID_MAX, their home and
+        mail spool
+        """
+        if not self.handle.is_file('/etc/passwd'):
+            return
+        uid_min, uid_max = self.uid_range()
+        removed = set()
+        passwd = []
+        for line in self.read_lines('/etc/passwd'):
+            fields = line.split(':')
+            if len(fields) > 5 and fields[2].isdigit() \
+                    and uid_min <= int(fields[2]) <= uid_max:
+                removed.add(fields[0])
+                if fields[5].startswith('/home/'):
+                    self.handle.rm_rf(fields[5])
+                self.delete('/var/spool/mail/%s' % fields[0])
+            else:
+                passwd.append(line)
+        if not removed:
+            return
+        logger.info("Removing user accounts: %s" % ', '.join(sorted(removed)))
+        self.write_lines('/etc/passwd', passwd)
+        if self.handle.is_file('/etc/shadow'):
+            self.write_lines('/etc/shadow', [
+                line for line in self.read_lines('/etc/shadow')
+                if line.split(':')[0] not in removed])
+        for group_path, members_field in (('/etc/group', 3),
+                                          ('/etc/gshadow', 3)):
+            if self.handle.is_file(group_path):
+                self.write_lines(group_path, [
+                    _remove_members(line, removed, members_field)
+                    for line in self.read_lines(group_path)])
+
+    # '--commands-from-file' directives
+
+    def _command_delete(self, path):
+        self.delete(path)
+
+    def _command_mkdir(self, path):
+        self.handle.mkdir_p(path)
+
+    def _command_touch(self, path):
+        self.handle.touch(path)
+
+    def _command_truncate(self, path):
+        self.handle.truncate(path)
+
+    def _command_truncate_recursive(self, path):
+        if not self.handle.is_dir(path):
+            return
+        for name in self.handle.find(path):
+            file_path = os.path.join(path, name)
+            if self.handle.is_file(file_path):
+                self.handle.truncate(file_path)
+
+    def _command_edit(self, argument):
+        """
+        FILE:EXPR, where EXPR is applied to every line by 'perl -p'
+        """
+        path, expression = argument.split(':', 1)
+        if not self.handle.is_file(path):
+            raise Exception("Cannot edit %s: the file does not exist" % path)
+        (fd, local_path) = tempfile.mkstemp(prefix='chromo_edit_')
+        try:
+            with os.fdopen(fd, 'w') as local_file:
+                local_file.write(self.handle.read_file(path))
+            run_command(['perl', '-p', '-i', '-e', expression, local_path],
+                        check_return=True)
+            with open(local_path) as local_file:
+                self.handle.write(path, local_file.read())
+        finally:
+            os.remove(local_path)
+
+    def _command_root_password(self, selector):
+        if selector.startswith('password:'):
+            password = selector[len('password:'):]
+            salt = ''.join(random.SystemRandom().choice(
+                string.ascii_letters + string.digits + './')
+                for _ in range(16))
+            password_hash = crypt.crypt(password, '$6$%s$' % salt)
+        elif selector == 'disabled':
+            password_hash = '*'
+        else:
+            raise Exception("Unsupported root-password selector: %s"
+                            % selector.split(':')[0])
+        lines = []
+        for line in self.read_lines('/etc/shadow'):
+            fields = line.split(':')
+            if fields[0] == 'root' and len(fields) > 1:
+                fields[1] = password_hash
+                line = ':'.join(fields)
+            lines.append(line)
+        self.write_lines('/etc/shadow', lines)
+
+    def _command_run_command(self, command):
+        if command.split() == ['fstrim', '--all']:
+            # Trim from the appliance, so the guest needs no fstrim
+            self.handle.fstrim('/')
+            return
+        self.handle.sh(command)
+
+
+def parse_commands(text):
+    """
+    Return [(command, argument), ...] for a '--commands-from-file' text.
+    Raises an Exception for any directive that is not in COMMANDS.
+    """
+    commands = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        command, _, argument = line.partition(' ')
+        if command not in COMMANDS:
+            raise Exception("Unsupported sysprep command: %s" % command)
+        if command == 'edit' and ':' not in argument:
+            raise Exception("Expected 'edit FILE:EXPR': %s" % line)
+        commands.append((command, argument.strip()))
+    return commands
+
+
+def _remove_members(line, removed, members_field):
+    fields = line.rstrip('\n').split(':')
+    if len(fields) <= members_field:
+        return line
+    members = [member for member in fields[members_field].split(',')
+               if member and member not in removed]
+    fields[members_field] = ','.join(members)
+    return ':'.join(fields) + ('\n' if line.endswith('\n') else '')
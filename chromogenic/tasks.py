@@ -2,13 +2,32 @@ import logging
 from datetime import datetime
 
 from celery.decorators import task
+from celery.signals import worker_process_init
 
 from chromogenic.migrate import migrate_instance
 from chromogenic.export import export_instance
 from chromogenic.drivers.virtualbox import ImageManager as VBoxManager
+from chromogenic.metrics import job_context, log_summary
+from chromogenic.appliance import warm_up
 
 logger = logging.getLogger(__name__)
 
+
+@worker_process_init.connect
+def warm_up_appliance(**kwargs):
+    """
+    Build (and boot, once per host) the libguestfs appliance before the
+    first imaging task
+    """
+    warm_up()
+
+
+def _job_name(task_func):
+    """
+    Tag for the commands run by this task (See chromogenic.metrics)
+    """
+    return "%s-%s" % (task_func.name, task_func.request.id)
+
 @task(name='instance_export_task', queue="imaging", ignore_result=False)
 def instance_export_task(instance_export):
     logger.info("instance_export_task task started at %s." % datetime.now())
@@ -25,8 +44,14 @@ def instance_export_task(instance_export):
         instance_export.export_owner.username,
         timestamp_str = instance_export.start_date.strftime('%m%d%Y_%H%M%S'))
 
-    file_loc, md5_sum = export_instance(orig_managerCls, orig_creds,
-                                     export_managerCls, export_creds)
+    job = _job_name(instance_export_task)
+    try:
+        with job_context(job):
+            file_loc, md5_sum = export_instance(orig_managerCls, orig_creds,
+                                             export_managerCls, export_creds)
+    finally:
+        # Failed jobs are the ones worth reading
+        log_summary(job)
 
     logger.info("instance_export_task task finished at %s." % datetime.now())
     return (file_loc, md5_sum)
@@ -35,9 +60,14 @@ def instance_export_task(instance_export):
 @task(name='migrate_instance_task', queue="imaging", ignore_result=False)
 def migrate_instance_task(origCls, orig_creds, migrateCls, migrate_creds, **imaging_args):
     logger.info("migrate_instance_task task started at %s." % datetime.now())
-    new_image_id = migrate_instance(origCls, orig_creds,
-                     migrateCls, migrate_creds,
-                     **imaging_args)
+    job = _job_name(migrate_instance_task)
+    try:
+        with job_context(job):
+            new_image_id = migrate_instance(origCls, orig_creds,
+                             migrateCls, migrate_creds,
+                             **imaging_args)
+    finally:
+        log_summary(job)
     logger.info("migrate_instance_task task finished at %s." % datetime.now())
     return new_image_id
 
@@ -46,7 +76,12 @@ def machine_imaging_task(managerCls, manager_creds, create_img_args):
     logger.info("machine_imaging_task task started at %s." % datetime.now())
     manager = managerCls(**manager_creds)
     manager.hook = create_img_args.pop('machine_request', None)
-    new_image_id = manager.create_image(**create_img_args)
+    job = _job_name(machine_imaging_task)
+    try:
+        with job_context(job):
+            new_image_id = manager.create_image(**create_img_args)
+    finally:
+        log_summary(job)
     logger.info("machine_imaging_task task finished at %s." % datetime.now())
     return new_image_id
 